@@ -0,0 +1,360 @@
+"""
+A compact, columnar binary format for the scores of a piece, which can be
+loaded with numpy.memmap instead of being parsed. This allows analysing,
+re-encoding and diffing the scores of a run without simulating the piece
+again.
+
+A saved piece is a folder with a header.json and one .npy file per column.
+The notes of all parts are stored one after another, with offset columns
+marking where each part, measure and note's events start:
+
+    part_measure_starts     Per part, the index of its first measure.
+    measure_note_starts     Per measure, the index of its first note.
+    tick                    Per note, its start time in timesteps since the
+                            start of the piece.
+    note, octave            Per note, its Pitch.
+    duration                Per note, its duration in timesteps.
+    flags                   Per note, a combination of the FLAG_ constants.
+    note_event_starts       Per note, the index of its first event.
+    event_kind              Per event, one of the EVENT_ constants.
+    event_string            Per event, the index of the event in the string
+                            table in header.json.
+    event_delay             Per event, the index of the delay of a delayed
+                            event in the string table, or -1.
+
+Each of the offset columns has one more entry than the number of items it
+divides, so item i spans starts[i]:starts[i + 1].
+"""
+
+from array import array
+from itertools import accumulate
+import json
+from pathlib import Path
+
+import numpy as np
+
+from classes import (
+    LilyPondDuration,
+    LilyPondMeasure,
+    LilyPondNote,
+    LilyPondScore,
+    NO_EVENTS,
+    Pitch,
+    TIE_EVENTS,
+    TIMESTEP,
+    write_file_atomically,
+)
+
+
+FORMAT_VERSION = 1
+FLAG_REST, FLAG_TIE, FLAG_EVENTS = 1, 2, 4
+EVENT_BEFORE, EVENT, EVENT_DELAYED, EVENT_END = 0, 1, 2, 3
+COLUMNS = {
+    "part_measure_starts": "I",
+    "measure_note_starts": "I",
+    "tick": "I",
+    "note": "b",
+    "octave": "b",
+    "duration": "I",
+    "flags": "B",
+    "note_event_starts": "I",
+    "event_kind": "B",
+    "event_string": "I",
+    "event_delay": "i",
+}
+
+
+def to_ticks(measures):
+    return round(measures / TIMESTEP)
+
+
+class BinaryScoreWriter:
+    """
+    Collects the notes of any number of parts in columns, to save them or to
+    create a BinaryScore in memory.
+    """
+    def __init__(self):
+        self.columns = {name: array(code) for name, code in COLUMNS.items()}
+        self.part_names = []
+        self.strings = []
+        self.string_indices = {}
+        self.num_events = 0
+
+    def intern(self, string):
+        """
+        Get the index of a string in the string table, adding it if needed.
+        """
+        index = self.string_indices.get(string)
+
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(string)
+            self.string_indices[string] = index
+
+        return index
+
+    def add_event(self, kind, event, delay=None):
+        self.columns["event_kind"].append(kind)
+        self.columns["event_string"].append(self.intern(event))
+        self.columns["event_delay"].append(
+            -1 if delay is None else self.intern(delay.as_lilypond())
+        )
+        self.num_events += 1
+
+    def add_note_events(self, note):
+        """
+        Add a note's events and get the note's flags.
+        """
+        first_event = self.num_events
+
+        for event in note.events_before:
+            self.add_event(EVENT_BEFORE, event)
+
+        for event in note.events:
+            self.add_event(EVENT, event)
+
+        for delay, event in note.delayed_events:
+            self.add_event(EVENT_DELAYED, event, delay)
+
+        for event in note.end_events:
+            self.add_event(EVENT_END, event)
+
+        flags = FLAG_TIE if note.has_tie() else 0
+
+        if self.num_events != first_event:
+            flags |= FLAG_EVENTS
+
+        return flags
+
+    def add_part(self, name, score):
+        """
+        Add the notes of a LilyPondScore as a part with the given name.
+        """
+        columns = self.columns
+        self.part_names.append(name)
+        columns["part_measure_starts"].append(len(columns["measure_note_starts"]))
+        first_note = len(columns["tick"])
+        notes = []
+
+        for measure in score.measures:
+            columns["measure_note_starts"].append(first_note + len(notes))
+            notes += measure.notes
+
+        # Build the columns with comprehensions rather than one note at a
+        # time, as parts can have tens of thousands of notes.
+        durations = [to_ticks(note.duration) for note in notes]
+        columns["duration"].extend(durations)
+        columns["tick"].extend(
+            accumulate(durations, initial=to_ticks(score.first_measure))
+        )
+        del columns["tick"][first_note + len(notes):]
+        columns["note"].extend([note.pitch.note for note in notes])
+        columns["octave"].extend([note.pitch.octave for note in notes])
+        note_event_starts = columns["note_event_starts"]
+        flags = columns["flags"]
+
+        for note in notes:
+            note_event_starts.append(self.num_events)
+            rest_flag = FLAG_REST if note.pitch.note == Pitch.REST else 0
+
+            # Most notes have no events or only a tie (see NO_EVENTS).
+            if (
+                note.events_before is NO_EVENTS and
+                note.delayed_events is NO_EVENTS and
+                note.end_events is NO_EVENTS
+            ):
+                if note.events is NO_EVENTS:
+                    flags.append(rest_flag)
+                    continue
+                elif note.events is TIE_EVENTS:
+                    self.add_event(EVENT, "~")
+                    flags.append(rest_flag | FLAG_TIE | FLAG_EVENTS)
+                    continue
+
+            flags.append(self.add_note_events(note) | rest_flag)
+
+    def get_header(self):
+        return {
+            "version": FORMAT_VERSION,
+            "timestep": TIMESTEP,
+            "parts": self.part_names,
+            "strings": self.strings,
+        }
+
+    def get_columns(self):
+        """
+        Get all columns as NumPy arrays. Closes the offset columns, so no
+        parts can be added afterwards.
+        """
+        columns = self.columns
+        columns["part_measure_starts"].append(len(columns["measure_note_starts"]))
+        columns["measure_note_starts"].append(len(columns["tick"]))
+        columns["note_event_starts"].append(self.num_events)
+
+        return {
+            name: np.frombuffer(values, dtype=values.typecode)
+            for name, values in columns.items()
+        }
+
+    def save(self, folder_name):
+        """
+        Save all parts added so far to the given folder.
+        """
+        folder = Path(folder_name)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        for name, values in self.get_columns().items():
+            np.save(folder / f"{name}.npy", values)
+
+        write_file_atomically(
+            str(folder / "header.json"),
+            json.dumps(self.get_header())
+        )
+
+
+def save_piece(piece, folder_name):
+    """
+    Save the scores of all instruments in a piece to the given folder.
+    """
+    writer = BinaryScoreWriter()
+
+    for instrument in piece.get_instruments():
+        writer.add_part(instrument.name, instrument.score)
+
+    writer.save(folder_name)
+
+
+class BinaryScore:
+    """
+    The columns of a saved piece. Use BinaryScore.load to memory-map a saved
+    piece, so nothing is read from disk until it is used, or
+    BinaryScore.new_from_piece to convert a piece in memory.
+    """
+    def __init__(self, header, columns):
+        if header["version"] != FORMAT_VERSION:
+            raise Exception(f"BinaryScore: unsupported version {header['version']}.")
+
+        self.timestep = header["timestep"]
+        self.part_names = header["parts"]
+        self.strings = header["strings"]
+
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def load(folder_name):
+        folder = Path(folder_name)
+
+        with open(folder / "header.json") as file:
+            header = json.load(file)
+
+        columns = {
+            name: np.load(folder / f"{name}.npy", mmap_mode="r")
+            for name in COLUMNS
+        }
+
+        return BinaryScore(header, columns)
+
+    def new_from_piece(piece):
+        writer = BinaryScoreWriter()
+
+        for instrument in piece.get_instruments():
+            writer.add_part(instrument.name, instrument.score)
+
+        return BinaryScore(writer.get_header(), writer.get_columns())
+
+    def get_num_parts(self):
+        return len(self.part_names)
+
+    def get_part_index(self, name):
+        return self.part_names.index(name)
+
+    def get_measure_range(self, part_index):
+        """
+        Get the indices of the first measure of a part and the measure after
+        its last measure.
+        """
+        return (
+            int(self.part_measure_starts[part_index]),
+            int(self.part_measure_starts[part_index + 1])
+        )
+
+    def get_note_range(self, part_index):
+        """
+        Get the indices of the first note of a part and the note after its
+        last note.
+        """
+        first_measure, end_measure = self.get_measure_range(part_index)
+
+        return (
+            int(self.measure_note_starts[first_measure]),
+            int(self.measure_note_starts[end_measure])
+        )
+
+    def get_note_events(self, note_index):
+        """
+        Get a note's events as a list of (kind, event, delay) tuples, where
+        delay is None for events that are not delayed.
+        """
+        start = self.note_event_starts[note_index]
+        end = self.note_event_starts[note_index + 1]
+        events = []
+
+        for i in range(start, end):
+            delay = int(self.event_delay[i])
+            events.append((
+                int(self.event_kind[i]),
+                self.strings[self.event_string[i]],
+                None if delay == -1 else self.strings[delay]
+            ))
+
+        return events
+
+    def to_lilypond_note(self, note_index):
+        note = LilyPondNote(
+            Pitch.shared(int(self.note[note_index]), int(self.octave[note_index])),
+            duration=int(self.duration[note_index]) * self.timestep
+        )
+
+        if not self.flags[note_index] & FLAG_EVENTS:
+            return note
+
+        lists = {kind: [] for kind in (EVENT_BEFORE, EVENT, EVENT_DELAYED, EVENT_END)}
+
+        for kind, event, delay in self.get_note_events(note_index):
+            if kind == EVENT_DELAYED:
+                lists[kind].append([LilyPondDuration(delay), event])
+            else:
+                lists[kind].append(event)
+
+        # Set the lists directly, so events are restored exactly as saved.
+        for kind, attribute in (
+            (EVENT_BEFORE, "events_before"),
+            (EVENT, "events"),
+            (EVENT_DELAYED, "delayed_events"),
+            (EVENT_END, "end_events"),
+        ):
+            if len(lists[kind]) != 0:
+                setattr(note, attribute, lists[kind])
+
+        return note
+
+    def to_lilypond_score(self, part_index):
+        """
+        Rebuild the LilyPondScore of a part, e.g. to encode it in LilyPond
+        notation again.
+        """
+        score = LilyPondScore()
+        first_measure, end_measure = self.get_measure_range(part_index)
+
+        if end_measure != first_measure:
+            first_tick = int(self.tick[self.measure_note_starts[first_measure]])
+            score.first_measure = round(first_tick * self.timestep)
+
+        for measure_index in range(first_measure, end_measure):
+            measure = LilyPondMeasure()
+            start = self.measure_note_starts[measure_index]
+            end = self.measure_note_starts[measure_index + 1]
+            measure.notes = [self.to_lilypond_note(i) for i in range(start, end)]
+            score.measures.append(measure)
+
+        return score
@@ -0,0 +1,201 @@
+"""
+Verifies that the generated parts give every musician time to breathe: no
+phrase may be longer than the player's max_note_length, and every rest
+between two phrases must be at least rest_time long. A phrase is a run of
+consecutive notes without any rest in between, regardless of ties.
+
+The analysis works on the columns of a BinaryScore, so it can run directly
+after generation or on a saved piece, and is vectorized over all parts at
+once.
+
+Usage:
+    report = analyze_piece(piece)
+    report.print_summary()
+"""
+
+import numpy as np
+
+from binary_score import BinaryScore, FLAG_REST
+
+
+PHRASE_TOO_LONG, REST_TOO_SHORT = "phrase too long", "rest too short"
+
+
+class Violation:
+    def __init__(self, part_name, kind, measure, length, limit):
+        self.part_name = part_name
+        self.kind = kind
+        self.measure = measure  # Counted from 1.
+        self.length = length  # In measures.
+        self.limit = limit  # In measures.
+
+    def __str__(self):
+        return (
+            f'{self.part_name}, measure {self.measure}: {self.kind} '
+            f'({self.length} measures, limit {self.limit})'
+        )
+
+
+class BreathingReport:
+    """
+    The result of a breathing analysis. All per-part values are arrays in the
+    order of part_names, with lengths in measures. Parts without any phrases
+    have a longest phrase of 0, and parts without rests between phrases have
+    a shortest rest of infinity.
+    """
+    def __init__(
+            self,
+            part_names,
+            longest_phrases,
+            shortest_rests,
+            play_ratios,
+            violations
+        ):
+        self.part_names = part_names
+        self.longest_phrases = longest_phrases
+        self.shortest_rests = shortest_rests
+        self.play_ratios = play_ratios
+        self.violations = violations
+
+    def print_summary(self):
+        for i, name in enumerate(self.part_names):
+            print(
+                f'{name}: longest phrase {self.longest_phrases[i]}, '
+                f'shortest rest {self.shortest_rests[i]}, '
+                f'playing {self.play_ratios[i] * 100:.1f}% of the time'
+            )
+
+        print(f'{len(self.violations)} violations.')
+
+        for violation in self.violations:
+            print(f'    {violation}')
+
+
+def analyze(binary_score, max_note_lengths, min_rests):
+    """
+    Analyze the phrases and rests of all parts in a BinaryScore.
+
+    @param max_note_lengths:    Per part, the longest allowed phrase in
+                                measures.
+    @param min_rests:           Per part, the shortest allowed rest between
+                                phrases in measures.
+    @returns:                   A BreathingReport.
+    """
+    timestep = binary_score.timestep
+    num_parts = binary_score.get_num_parts()
+    measure_note_starts = np.asarray(binary_score.measure_note_starts)
+    part_note_starts = measure_note_starts[
+        np.asarray(binary_score.part_measure_starts)
+    ]
+    num_notes = int(part_note_starts[-1])
+    duration = np.asarray(binary_score.duration[:num_notes], dtype=np.int64)
+    sounding = (np.asarray(binary_score.flags[:num_notes]) & FLAG_REST) == 0
+    part = np.repeat(np.arange(num_parts), np.diff(part_note_starts))
+    longest_phrases = np.zeros(num_parts)
+    shortest_rests = np.full(num_parts, np.inf)
+    play_ratios = np.zeros(num_parts)
+
+    if num_notes == 0:
+        return BreathingReport(
+            binary_score.part_names,
+            longest_phrases,
+            shortest_rests,
+            play_ratios,
+            []
+        )
+
+    # Split the notes into runs of sounding notes (phrases) and rests.
+    run_starts = np.flatnonzero(np.concatenate((
+        [True],
+        (sounding[1:] != sounding[:-1]) | (part[1:] != part[:-1])
+    )))
+    run_lengths = np.add.reduceat(duration, run_starts) * timestep
+    run_sounding = sounding[run_starts]
+    run_part = part[run_starts]
+    # Rests at the start or end of a part are not between two phrases.
+    first_of_part = np.concatenate(([True], run_part[1:] != run_part[:-1]))
+    last_of_part = np.concatenate((run_part[1:] != run_part[:-1], [True]))
+    is_phrase = run_sounding
+    is_rest = ~run_sounding & ~first_of_part & ~last_of_part
+
+    np.maximum.at(longest_phrases, run_part[is_phrase], run_lengths[is_phrase])
+    np.minimum.at(shortest_rests, run_part[is_rest], run_lengths[is_rest])
+    total_time = np.bincount(part, weights=duration, minlength=num_parts)
+    play_time = np.bincount(
+        part,
+        weights=duration * sounding,
+        minlength=num_parts
+    )
+    play_ratios = np.divide(
+        play_time,
+        total_time,
+        out=np.zeros(num_parts),
+        where=total_time != 0
+    )
+
+    max_note_lengths = np.asarray(max_note_lengths, dtype=float)
+    min_rests = np.asarray(min_rests, dtype=float)
+    # Compare in timesteps, to prevent floating point rounding errors.
+    run_ticks = np.rint(run_lengths / timestep)
+    too_long = is_phrase & (
+        run_ticks > np.rint(max_note_lengths[run_part] / timestep)
+    )
+    too_short = is_rest & (
+        run_ticks < np.rint(min_rests[run_part] / timestep)
+    )
+    violating_runs = np.flatnonzero(too_long | too_short)
+    measures = np.searchsorted(
+        measure_note_starts,
+        run_starts[violating_runs],
+        side="right"
+    )
+    part_first_measures = np.asarray(binary_score.part_measure_starts)
+    violations = []
+
+    for run, measure in zip(violating_runs, measures):
+        part_index = run_part[run]
+        violations.append(Violation(
+            binary_score.part_names[part_index],
+            PHRASE_TOO_LONG if too_long[run] else REST_TOO_SHORT,
+            int(measure - part_first_measures[part_index]),
+            float(run_lengths[run]),
+            float(
+                max_note_lengths[part_index]
+                if too_long[run]
+                else min_rests[part_index]
+            )
+        ))
+
+    return BreathingReport(
+        binary_score.part_names,
+        longest_phrases,
+        shortest_rests,
+        play_ratios,
+        violations
+    )
+
+
+def analyze_piece(piece, min_rests=None):
+    """
+    Analyze all parts of a piece against their instrument's max_note_length
+    and, unless min_rests is given, their texture's current rest_time.
+
+    @param min_rests:   Optionally, the shortest allowed rest in measures,
+                        either for all parts or as a list per part. Useful
+                        when rest_time changes during the piece.
+    """
+    instruments = piece.get_instruments()
+
+    if min_rests is None:
+        min_rests = [
+            getattr(instrument.instrument_group.texture, "rest_time", 0)
+            for instrument in instruments
+        ]
+    elif np.isscalar(min_rests):
+        min_rests = [min_rests] * len(instruments)
+
+    return analyze(
+        BinaryScore.new_from_piece(piece),
+        [instrument.max_note_length for instrument in instruments],
+        min_rests
+    )
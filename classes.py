@@ -7,12 +7,23 @@ TODO
 - Cleanup (refer to TODOs dotted throughout this file)
 """
 
+import atexit
+import bisect
+from collections import OrderedDict
+import hashlib
+import heapq
+import json
 import math
+import os
 from copy import copy, deepcopy
 from pathlib import Path
+import sys
+import tempfile
 import time
 import pprint
 
+from lilypond_compiler import LilyPondCompiler, find_jobs, write_score_files
+
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -20,22 +31,315 @@ pp = pprint.PrettyPrinter(indent=4)
 # Globals to easily edit some parameters.
 TIMESTEP = 0.125  # TODO: move to Piece class
 # FOLDER_NAME = None
-DEBUG_MODE = False
+DEBUG_MODE = False  # Enables all tracing subsystems, see Tracer.
 SHOW_WARNINGS = False
+HEADLESS = False  # Skips progress output and the delays that pace it.
 # FONT_SIZE_RANGE = (-4, 20)
 FONT_SIZE_RANGE = None
 # MIDI_EXPR_RANGE = (0, 1)
 MIDI_EXPR_RANGE = None
 
+# Shared stand-ins for the most common lists of note events: no events at all,
+# and only a tie. Notes only get a list of their own once another event is
+# added, so that the many sustained notes and rests do not each allocate their
+# own lists. Never modify these; use writable_events() to get a list that can
+# be modified.
+NO_EVENTS = ()
+TIE_EVENTS = ("~",)
+
+
+class Tracer:
+    """
+    Debug output of the simulation, with a separate verbosity per subsystem
+    (0 disables a subsystem). Level 1 traces changes, such as instruments
+    starting and stopping or a texture's density changing, and level 2 also
+    traces the state of textures and dynamic changes on every timestep. Call
+    sites check the verbosity of their subsystem before building any message,
+    so disabled tracing costs no more than an attribute lookup:
+
+        if TRACER.instrument:
+            TRACER.write(" %s starts playing %s", self, self.pitch)
+
+    Messages are formatted only when written, and collected in a buffer that
+    is written to the sink in large chunks. All messages of one timestep are
+    written on one line.
+    """
+    SUBSYSTEMS = ["piece", "texture", "instrument", "dynamic"]
+
+    def __init__(self, sink=None, buffer_size=65536):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered_length = 0
+        self.wrote_this_step = False
+
+        for subsystem in Tracer.SUBSYSTEMS:
+            setattr(self, subsystem, 0)
+
+    def configure(self, **verbosity):
+        """
+        Set the verbosity of one or more subsystems, e.g.
+        TRACER.configure(instrument=1, dynamic=2).
+        """
+        for subsystem, level in verbosity.items():
+            if subsystem not in Tracer.SUBSYSTEMS:
+                raise Exception(f"Tracer: unknown subsystem {subsystem}.")
+
+            setattr(self, subsystem, level)
+
+    def enable_all(self, level=1):
+        self.configure(**dict.fromkeys(Tracer.SUBSYSTEMS, level))
+
+    def write(self, message, *args):
+        """
+        Format the message with the given arguments (using %-formatting) and
+        add it to the buffer.
+        """
+        if len(args) != 0:
+            message = message % args
+
+        self.buffer.append(message)
+        self.buffered_length += len(message)
+        self.wrote_this_step = True
+
+        if self.buffered_length >= self.buffer_size:
+            self.flush()
+
+    def end_step(self):
+        """
+        End the line of the current timestep, if anything was written.
+        """
+        if self.wrote_this_step:
+            self.write("\n")
+            self.wrote_this_step = False
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        sink = self.sink if self.sink is not None else sys.stdout
+        sink.write("".join(self.buffer))
+        sink.flush()
+        self.buffer.clear()
+        self.buffered_length = 0
+
+
+TRACER = Tracer()
+atexit.register(TRACER.flush)
+
+
+class TransitionLog:
+    """
+    An opt-in log of the simulation's state transitions, such as instruments
+    starting or stopping and dynamic changes, with one compact JSON record
+    per line. Each record contains the tick ("t", the number of timesteps
+    since the start of the piece), the transition ("e") and, where they apply,
+    the texture index ("tx"), instrument group name ("g") and instrument name
+    ("i"), followed by transition-specific fields.
+
+    Like the Tracer, call sites check whether the log is enabled before
+    building a record. Records are written through a large file buffer, and
+    recording stops after max_records records so a runaway piece cannot fill
+    the disk. Use query_transitions.py to filter a log.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.max_records = 0
+        self.num_records = 0
+
+    def open(self, path, max_records=10000000, buffer_size=1048576):
+        self.close()
+        self.file = open(path, "w", buffering=buffer_size)
+        self.max_records = max_records
+        self.num_records = 0
+        self.enabled = True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+        self.file = None
+        self.enabled = False
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def record(self, time, event, **fields):
+        """
+        Write a record for a transition at the given time in measures.
+        """
+        if self.num_records >= self.max_records:
+            self.file.write(json.dumps({"e": "truncated"}) + "\n")
+            self.close()
+            return
+
+        record = {"t": round(time / TIMESTEP), "e": event}
+        record.update(fields)
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.num_records += 1
+
+    def record_texture(self, event, texture, **fields):
+        self.record(
+            texture.piece.time,
+            event,
+            tx=texture.piece.texture_registry.order.get(texture),
+            **fields
+        )
+
+    def record_instrument(self, event, instrument, **fields):
+        texture = instrument.instrument_group.texture
+        self.record_texture(
+            event,
+            texture,
+            g=instrument.instrument_group.name,
+            i=instrument.name,
+            **fields
+        )
+
+    def record_dynamic(self, event, dynamic, **fields):
+        if isinstance(dynamic.parent, Instrument):
+            self.record_instrument(event, dynamic.parent, **fields)
+        else:
+            self.record_texture(event, dynamic.parent, **fields)
+
+
+TRANSITIONS = TransitionLog()
+atexit.register(TRANSITIONS.close)
+
 
 def debug(x, end="\n"):
     if DEBUG_MODE:
-        print(x, end=end)
+        TRACER.write(str(x) + end)
 
 
 def warn(x, end="\n"):
     if SHOW_WARNINGS:
-        print(x, end=end)
+        TRACER.write(str(x) + end)
+
+
+def writable_events(events):
+    """
+    Get a version of a list of events that is safe to modify in place.
+
+    @param events:  A list of events, or one of the shared event tuples.
+    @returns:       The given list, or a new list if a shared tuple was given.
+    """
+    return list(events) if type(events) is tuple else events
+
+
+def copy_events(events):
+    """
+    Copy a list of events. The shared event tuples are immutable, so they are
+    not copied.
+    """
+    return events if type(events) is tuple else list(events)
+
+
+def find_repeats(items, get_saving, max_length=8):
+    """
+    Split a list into runs of a sequence of items repeated back to back, from
+    left to right, choosing at every position the run with the largest
+    saving. Runs are found with a rolling hash of the items, so each position
+    is checked in constant time per sequence length.
+
+    @param get_saving:  A function of (start, length, count) that gets how
+                        much writing a run once instead of count times saves.
+                        Runs that save nothing are not used.
+    @param max_length:  The maximum length of the repeated sequences.
+    @returns:           A list of (start, length, count) tuples covering the
+                        list, with count 1 where nothing repeats.
+    """
+    modulus = (1 << 61) - 1
+    base = 1000003
+    ids = {}
+    prefix_hashes = [0]
+    powers = [1]
+
+    for item in items:
+        prefix_hashes.append(
+            (prefix_hashes[-1] * base + ids.setdefault(item, len(ids) + 1)) % modulus
+        )
+        powers.append(powers[-1] * base % modulus)
+
+    def get_hash(start, length):
+        return (
+            prefix_hashes[start + length] - prefix_hashes[start] * powers[length]
+        ) % modulus
+
+    runs = []
+    start = 0
+
+    while start < len(items):
+        best_run = (start, 1, 1)
+        best_saving = 0
+
+        for length in range(1, max_length + 1):
+            if start + 2 * length > len(items):
+                break
+
+            sequence_hash = get_hash(start, length)
+            count = 1
+
+            while (
+                start + (count + 1) * length <= len(items) and
+                get_hash(start + count * length, length) == sequence_hash and
+                items[start + count * length:start + (count + 1) * length] ==
+                items[start:start + length]
+            ):
+                count += 1
+
+            if count > 1:
+                saving = get_saving(start, length, count)
+
+                if saving > best_saving:
+                    best_run = (start, length, count)
+                    best_saving = saving
+
+        runs.append(best_run)
+        start += best_run[1] * best_run[2]
+
+    return runs
+
+
+# The process's umask can only be read by setting it.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_file_atomically(path, content):
+    """
+    Write content to a file by writing it to a temporary file in the same
+    folder first and renaming that, so the file is never left half-written.
+    """
+    folder = os.path.dirname(path) or "."
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+
+    try:
+        with os.fdopen(file_descriptor, "w") as file:
+            file.write(content)
+
+        # Temporary files are only readable by their owner; give the output
+        # file the permissions a regular open() would.
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def write_output_file(path, content, manifest=None):
+    """
+    Write an output file, skipping files whose content did not change since
+    the previous run if a manifest is given.
+    """
+    if manifest is not None:
+        manifest.write_file(path, content)
+        return
+
+    with open(path, "w+") as file:
+        file.write(content)
 
 
 def duration_to_lilypond(time):
@@ -138,6 +442,7 @@ class Pitch:
     NOTE_NAMES = ["c", "des", "d", "es", "e", "f", "ges", "g", "as", "a",
                       "bes", "b", "r"]
     C, DES, D, ES, E, F, GES, G, AS, A, BES, B, REST = 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, -1
+    _shared_pitches = {}
 
     def __init__(self, note, octave, is_invisible_rest=False):
         """
@@ -168,6 +473,25 @@ class Pitch:
 
         return Pitch(Pitch.NOTE_NAMES.index(note_name), octave)
 
+    def shared(note, octave):
+        """
+        Get a Pitch object for the given note and octave that is shared by all
+        notes in all scores. This prevents allocating a new Pitch for every
+        note. Shared pitches must never be modified.
+
+        @param note:    A number from 0 to 11 for C, C#, etc, or -1 for a rest.
+        @param octave:  The octave number, where 0 is the sub-contra octave.
+        @returns:       A shared Pitch object.
+        """
+        key = octave * 13 + note
+        pitch = Pitch._shared_pitches.get(key)
+
+        if pitch is None:
+            pitch = Pitch(note, octave)
+            Pitch._shared_pitches[key] = pitch
+
+        return pitch
+
     def __str__(self):
         return self.to_lilypond()
 
@@ -252,23 +576,76 @@ class Pitch:
     def is_rest(self):
         return self.note == Pitch.REST
 
+    def sort_key(self):
+        """
+        Get a number that orders pitches the same way as this class's
+        comparison operators: by octave, then by note, with rests lowest.
+
+        @returns:   An integer that can be used to sort pitches.
+        """
+        if self.is_rest():
+            return -1
+
+        return self.octave * 12 + self.note
+
 
 class LilyPondNote:
     """
     This class is used to track notes' pitch, duration and events such as ties
     and changes in dynamics.
     """
-    def __init__(self, pitch, events_before=[], events=[], duration=TIMESTEP):
+    # A note is created for every instrument on every timestep, so keep them
+    # as small as possible.
+    __slots__ = (
+        "pitch", "duration", "events_before", "events", "delayed_events",
+        "end_events"
+    )
+
+    def __init__(
+            self,
+            pitch,
+            events_before=NO_EVENTS,
+            events=NO_EVENTS,
+            duration=TIMESTEP
+        ):
+        self.reinitialize(pitch, events_before, events, duration)
+
+    def reinitialize(
+            self,
+            pitch,
+            events_before=NO_EVENTS,
+            events=NO_EVENTS,
+            duration=TIMESTEP
+        ):
+        """
+        Reset this note to a new pitch, duration and events, discarding any
+        events it had before. The given event lists are copied, so they can be
+        reused by the caller.
+        """
         self.pitch = pitch
         self.duration = duration
-        self.events_before = events_before
-        self.events = []
+        self.events_before = list(events_before) if events_before else NO_EVENTS
+        self.events = NO_EVENTS
 
         for event in events:
             self.add_event(event)
 
-        self.delayed_events = []
-        self.end_events = []
+        self.delayed_events = NO_EVENTS
+        self.end_events = NO_EVENTS
+
+    def __copy__(self):
+        """
+        Copy this note with its own event lists, so either copy can be changed
+        without affecting the other.
+        """
+        note = LilyPondNote.__new__(LilyPondNote)
+        note.pitch = self.pitch
+        note.duration = self.duration
+        note.events_before = copy_events(self.events_before)
+        note.events = copy_events(self.events)
+        note.delayed_events = copy_events(self.delayed_events)
+        note.end_events = copy_events(self.end_events)
+        return note
 
     def __str__(self):
         note = str(self.pitch) + str(self.duration_as_lilypond())
@@ -288,6 +665,7 @@ class LilyPondNote:
         return "~" in self.events
 
     def remove_tie(self):
+        self.events = writable_events(self.events)
         self.events.remove("~")
 
     def can_merge(self, note_after):
@@ -312,6 +690,9 @@ class LilyPondNote:
         """
 
 
+        self.delayed_events = writable_events(self.delayed_events)
+        self.events_before = writable_events(self.events_before)
+
         if self.has_tie() and not note.has_tie():
             self.remove_tie()
 
@@ -385,13 +766,17 @@ class LilyPondNote:
         """
         Add a tie to the next note.
         """
-        if "~" not in self.events:
+        if self.events is NO_EVENTS:
+            self.events = TIE_EVENTS
+        elif "~" not in self.events:
+            self.events = writable_events(self.events)
             self.events.insert(0, "~")
 
     def remove_hairpin(self):
         """
         Remove any hairpin dynamics markings if they exist.
         """
+        self.events = writable_events(self.events)
 
         if ("\\>" in self.events):
             self.events.remove("\\>")
@@ -400,6 +785,8 @@ class LilyPondNote:
             self.events.remove("\\<")
 
     def add_event(self, event):
+        self.events = writable_events(self.events)
+
         if event in ["\\<", "\\>"]:
             # Newest (de)crescendo has priority
             if "\\<" in self.events:
@@ -410,6 +797,182 @@ class LilyPondNote:
         if event not in self.events:
             self.events.append(event)
 
+    def add_end_event(self, event):
+        """
+        Add an event that happens at the end of this note.
+        """
+        self.end_events = writable_events(self.end_events)
+        self.end_events.append(event)
+
+    def structural_key(self):
+        """
+        Get a hashable representation of everything that determines how this
+        note is merged and encoded.
+        """
+        return (
+            self.pitch.note,
+            self.pitch.octave,
+            self.duration,
+            tuple(self.events_before),
+            tuple(self.events),
+            tuple((delay.as_lilypond(), event) for delay, event in self.delayed_events),
+            tuple(self.end_events)
+        )
+
+
+class LilyPondMeasureCache:
+    """
+    A bounded least-recently-used cache of encoded measures, keyed by the
+    structural key of the measures' notes. Parts often contain long stretches
+    of identical measures, which only need to be merged and encoded once.
+
+    If an OutputManifest is given, measures that are not in the cache are
+    looked up in the measures encoded during the previous run, and newly
+    encoded measures are stored in the manifest for the next run.
+    """
+    def __init__(self, max_size=4096, manifest=None):
+        self.max_size = max_size
+        self.manifest = manifest
+        self.encoded_measures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.manifest_hits = 0
+
+    def get(self, key):
+        """
+        Get the encoded measure for the given key, or None if it is not cached.
+        """
+        lilypond_string = self.encoded_measures.get(key)
+
+        if lilypond_string is not None:
+            self.hits += 1
+            self.encoded_measures.move_to_end(key)
+            return lilypond_string
+
+        if self.manifest is not None:
+            lilypond_string = self.manifest.get_measure(key)
+
+        if lilypond_string is None:
+            self.misses += 1
+        else:
+            self.manifest_hits += 1
+            self.put(key, lilypond_string, False)
+
+        return lilypond_string
+
+    def put(self, key, lilypond_string, store_in_manifest=True):
+        """
+        Cache an encoded measure, evicting the least recently used measure if
+        the cache is full.
+        """
+        if store_in_manifest and self.manifest is not None:
+            self.manifest.put_measure(key, lilypond_string)
+
+        self.encoded_measures[key] = lilypond_string
+        self.encoded_measures.move_to_end(key)
+
+        if len(self.encoded_measures) > self.max_size:
+            self.encoded_measures.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.manifest_hits + self.misses
+        return (self.hits + self.manifest_hits) / lookups if lookups != 0 else 0
+
+
+class OutputManifest:
+    """
+    Tracks the content hash, size and modification time of every output file
+    and the encoding of every measure of the previous run in a JSON file in
+    the output folder. This allows skipping files whose content did not
+    change, so their modification time stays the same and LilyPond builds
+    only recompile what changed, and reusing measure encodings without
+    encoding them again.
+
+    Increase VERSION whenever the way measures are encoded changes, so that
+    encodings from older runs are not reused.
+    """
+    FILENAME = ".encoding_manifest.json"
+    VERSION = 2
+
+    def __init__(self, folder_name):
+        self.folder_name = folder_name
+        self.path = os.path.join(folder_name, OutputManifest.FILENAME)
+        self.old_files = {}
+        self.old_measures = {}
+        self.files = {}
+        self.measures = {}
+        self.files_written = 0
+        self.files_unchanged = 0
+
+        try:
+            with open(self.path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if manifest.get("version") == OutputManifest.VERSION:
+            self.old_files = manifest["files"]
+            self.old_measures = manifest["measures"]
+
+    def measure_hash(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get_measure(self, key):
+        """
+        Get the encoding of a measure with the given structural key from the
+        previous run, or None if it was not encoded then.
+        """
+        measure_hash = OutputManifest.measure_hash(key)
+        lilypond_string = self.old_measures.get(measure_hash)
+
+        if lilypond_string is not None:
+            self.measures[measure_hash] = lilypond_string
+
+        return lilypond_string
+
+    def put_measure(self, key, lilypond_string):
+        self.measures[OutputManifest.measure_hash(key)] = lilypond_string
+
+    def write_file(self, path, content):
+        """
+        Write the content to the file at the given path, unless the file
+        already has exactly this content according to the previous run. Files
+        whose size or modification time changed since the previous run, e.g.
+        because they were edited by hand, are always written.
+        """
+        name = os.path.relpath(path, self.folder_name)
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        old_file = self.old_files.get(name)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+
+        if (
+            old_file is not None and
+            stat is not None and
+            old_file == [content_hash, stat.st_size, stat.st_mtime_ns]
+        ):
+            self.files[name] = old_file
+            self.files_unchanged += 1
+            return
+
+        write_file_atomically(path, content)
+        stat = os.stat(path)
+        self.files[name] = [content_hash, stat.st_size, stat.st_mtime_ns]
+        self.files_written += 1
+
+    def save(self):
+        """
+        Save the manifest, keeping only the files and measures of this run.
+        """
+        write_file_atomically(self.path, json.dumps({
+            "version": OutputManifest.VERSION,
+            "files": self.files,
+            "measures": self.measures
+        }))
+
 
 class LilyPondMeasure:
     """
@@ -417,12 +980,49 @@ class LilyPondMeasure:
     """
     def __init__(self):
         self.notes = []
+        # Shared measures belong to more than one score after Piece.fork, and
+        # are copied by LilyPondScore.get_writable_measure before changing.
+        self.is_shared = False
+
+    def __copy__(self):
+        measure = LilyPondMeasure()
+        measure.notes = [copy(note) for note in self.notes]
+        return measure
+
+    def add_note(
+            self,
+            pitch,
+            events=NO_EVENTS,
+            events_before=NO_EVENTS,
+            duration=TIMESTEP
+        ):
+        """
+        Add a new note to this measure. The given events are copied.
+        """
+        self.notes.append(LilyPondNote(
+            Pitch.shared(pitch.note, pitch.octave),
+            events_before,
+            events,
+            duration
+        ))
 
-    def add_note(self, pitch, events=[], events_before=[], duration=TIMESTEP):
+    def replace_last_note(
+            self,
+            pitch,
+            events=NO_EVENTS,
+            events_before=NO_EVENTS,
+            duration=TIMESTEP
+        ):
         """
-        Add a new note to this measure.
+        Replace the last note in this measure with a new note, reusing the
+        existing LilyPondNote object. The given events are copied.
         """
-        self.notes.append(LilyPondNote(copy(pitch), events_before, events, duration))
+        self.notes[-1].reinitialize(
+            Pitch.shared(pitch.note, pitch.octave),
+            events_before,
+            events,
+            duration
+        )
 
     def get_length(self):
         return len(self.notes)
@@ -467,23 +1067,49 @@ class LilyPondMeasure:
                     merged_this_round = False
 
 
-    def lilypond_encode(self):
+    def structural_key(self):
+        """
+        Get a hashable representation of this measure's notes. Measures with
+        equal keys are encoded identically.
+        """
+        return tuple(note.structural_key() for note in self.notes)
+
+    def lilypond_encode(self, cache=None):
         """
-        First merge the notes in this measure, then convert it to readable
-        lilypond code.
+        Merge the notes of a copy of this measure, then convert it to
+        readable lilypond code. The measure itself is not changed, so encoding
+        leaves the score the same whether or not the cache was used.
+
+        @param cache:   An optional LilyPondMeasureCache. If an identical
+                        measure was encoded before, its encoding is reused.
 
         TODO    This should be split into a number of separate functions, but
                 more important features will get priority.
         """
-        self.merge_notes()  # Comment this for midi velocity
+        key = None
+
+        if cache is not None:
+            key = self.structural_key()
+            lilypond_string = cache.get(key)
+
+            if lilypond_string is not None:
+                return lilypond_string
+
+        measure = copy(self)
+        measure.merge_notes()  # Comment this for midi velocity
         # This is where the actual encoding begins.
         # TODO: everything above this point should be a separate function.
         lilypond_string = ""
 
-        for note in self.notes:
+        for note in measure.notes:
             lilypond_string += f'{note} '
 
-        return lilypond_string + "| "  # Add barline at the end of the measure.
+        lilypond_string += "| "  # Add barline at the end of the measure.
+
+        if cache is not None:
+            cache.put(key, lilypond_string)
+
+        return lilypond_string
 
     def is_empty(self):
         for note in self.notes:
@@ -499,6 +1125,9 @@ class LilyPondScore:
     """
     def __init__(self):
         self.measures = []
+        # The index of self.measures[0] in the piece. Measures before it were
+        # removed by remove_measures_before, e.g. by sectional generation.
+        self.first_measure = 0
 
     def new_measure(self):
         """
@@ -508,43 +1137,124 @@ class LilyPondScore:
 
     def get_last_measure(self):
         """
-        Helper function for legibility. Returns the last measure in this score.
+        Helper function for legibility. Returns the last measure in this score,
+        which may be changed.
+        """
+        return self.get_writable_measure(-1)
+
+    def get_writable_measure(self, index):
+        """
+        Get the measure at the given index to change it, replacing it with a
+        copy first if it is shared with a fork of the piece. Negative indices
+        count from the end.
+        """
+        if index >= 0:
+            index -= self.first_measure
+
+        measure = self.measures[index]
+
+        if measure.is_shared:
+            measure = copy(measure)
+            self.measures[index] = measure
+
+        return measure
+
+    def share_measures(self):
+        """
+        Mark all measures as shared, so they are copied before they are changed
+        by this score or any copy of it.
         """
-        return self.measures[-1]
+        for measure in self.measures:
+            measure.is_shared = True
 
-    def encode_lilypond(self):
+    def encode_lilypond(self, cache=None, compress_repeats=False):
         """
         Get a string representing this score in LilyPond notation.
 
-        @returns:   A string containing this score in LilyPond notation.
+        @param cache:               An optional LilyPondMeasureCache to reuse
+                                    the encoding of identical measures.
+        @param compress_repeats:    See join_measures.
+        @returns:                   A string containing this score in LilyPond
+                                    notation.
+        """
+        encoded_measures = []
+
+        for measure in self.measures:
+            encoded_measures.append(measure.lilypond_encode(cache))
+
+        return LilyPondScore.join_measures(
+            encoded_measures,
+            self.first_measure,
+            compress_repeats
+        )
+
+    def join_measures(encoded_measures, first_measure=0, compress_repeats=False):
+        """
+        Join encoded measures, each followed by its measure_separator.
+
+        @param first_measure:       The index of the first measure.
+        @param compress_repeats:    Write runs of a repeated sequence of
+                                    measures once, in a \\repeat unfold
+                                    block, where that is shorter. This
+                                    engraves the same as writing every measure.
         """
         lilypond_string = ""
 
-        for index, measure in enumerate(self.measures):
-            lilypond_string += measure.lilypond_encode()
+        if not compress_repeats:
+            for index, measure in enumerate(encoded_measures):
+                lilypond_string += measure
+                lilypond_string += LilyPondScore.measure_separator(first_measure + index)
+
+            return lilypond_string
+
+        def get_saving(start, length, count):
+            sequence_length = sum(
+                len(measure) for measure in encoded_measures[start:start + length]
+            )
+            return (count - 1) * sequence_length - len(f"\\repeat unfold {count} {{ }} ")
+
+        for start, length, count in find_repeats(encoded_measures, get_saving):
+            end = start + length * count
+
+            if count == 1:
+                lilypond_string += encoded_measures[start]
+            else:
+                lilypond_string += f"\\repeat unfold {count} {{ "
+                lilypond_string += "".join(encoded_measures[start:start + length])
+                lilypond_string += "} "
 
-            # Add a newline on every fourth bar for legibility.
-            if index % 4 == 3:
-                lilypond_string += "\n"
+            lilypond_string += LilyPondScore.measure_separator(first_measure + end - 1)
 
         return lilypond_string
 
+    def measure_separator(index):
+        """
+        Get the string that follows the measure at the given index when
+        encoding: a newline on every fourth bar for legibility.
+        """
+        return "\n" if index % 4 == 3 else ""
+
     def get_num_measures(self):
         """
-        Get the number of measures in this score.
+        Get the number of measures in this score, including measures that
+        were removed by remove_measures_before.
         """
-        return len(self.measures)
+        return self.first_measure + len(self.measures)
 
     def get_last_note(self):
+        """
+        Get the last note in this score, which may be changed, or None if
+        there are no notes.
+        """
         if len(self.measures[-1].notes) != 0:
-            return self.measures[-1].notes[-1]
-        elif self.get_num_measures() > 1:
-            return self.measures[-2].notes[-1]
+            return self.get_writable_measure(-1).notes[-1]
+        elif len(self.measures) > 1:
+            return self.get_writable_measure(-2).notes[-1]
         else:
             return None
 
     def get_measure(self, index):
-        return self.measures[index]
+        return self.measures[index - self.first_measure]
 
     def remove_hairpin(self, start_time, current_time):
         """
@@ -558,7 +1268,8 @@ class LilyPondScore:
 
         measure_index = math.floor(start_time)
         note_index = round((start_time % 1) / TIMESTEP)
-        self.get_measure(measure_index).get_note(note_index).remove_hairpin()
+        measure = self.get_writable_measure(measure_index)
+        measure.get_note(note_index).remove_hairpin()
 
     def get_num_trailing_empty_measures(self):
         num_trailing_empty_measures = 0
@@ -576,6 +1287,19 @@ class LilyPondScore:
         start_index = end_index - num_measures
         del self.measures[start_index:end_index]
 
+    def remove_measures_before(self, index):
+        """
+        Remove all measures before the given index from this score, keeping
+        the indices of the remaining measures.
+
+        @returns:   A list of the removed measures.
+        """
+        removed = self.measures[:index - self.first_measure]
+        del self.measures[:index - self.first_measure]
+        self.first_measure = max(self.first_measure, index)
+
+        return removed
+
 
 class Dynamic:
     """
@@ -661,6 +1385,18 @@ class Dynamic:
 
             self.parent.handle_dynamics()
 
+        if isinstance(self.parent, Instrument) and (self.is_changing or time == 0):
+            self.parent.report_change()
+
+        if TRANSITIONS.enabled and (self.is_changing or time == 0):
+            TRANSITIONS.record_dynamic(
+                "start_change",
+                self,
+                value=round(self.value, 3),
+                target=target,
+                duration=time
+            )
+
     def stop_change(self):
         """
         Stop any dynamic change. This can be used both when a change's target
@@ -675,7 +1411,11 @@ class Dynamic:
         self.start_dynamic = None
         self.time_to_reach_target = 0
         self.change_start_time = None
-        debug(f"{self.parent} reached dynamic", end="")
+        if TRACER.dynamic:
+            TRACER.write(" %s reached dynamic", self.parent)
+
+        if TRANSITIONS.enabled:
+            TRANSITIONS.record_dynamic("stop_change", self, value=self.value)
 
     def reached_target(self, step_size):
         if not self.is_changing:
@@ -723,6 +1463,14 @@ class Dynamic:
 
             self.value += dynamic_step
 
+            if TRACER.dynamic >= 2:
+                TRACER.write(
+                    " %s at %.2f towards %s",
+                    self.parent,
+                    self.value,
+                    self.target_dynamic
+                )
+
         elif isinstance(self.parent, Instrument):
             if self.parent.pitch == Pitch.REST:
                 return
@@ -795,11 +1543,22 @@ class Instrument:
     def __str__(self):
         return f'[Instrument: {self.name}]'
 
+    def report_change(self):
+        """
+        Let the piece's MetricsRecorder, if any, know that this instrument
+        starts or stops playing or changes its dynamic.
+        """
+        metrics_recorder = self.instrument_group.texture.piece.metrics_recorder
+
+        if metrics_recorder is not None:
+            metrics_recorder.activate(self)
+
     def start_playing(self):
         self.is_playing = True
         self.play_time = 0
         self.instrument_group.num_playing += 1
-        self.pitch = self.instrument_group.texture.get_pitch()
+        self.pitch = self.instrument_group.texture.get_pitch(self)
+        self.report_change()
 
         if self.dynamic is None:
             self.dynamic = Dynamic(Dynamic.PPP, self)
@@ -810,10 +1569,20 @@ class Instrument:
             self.instrument_group.texture.fade_time
         )
 
-        debug(
-            f'{self} starts playing {self.pitch} on {self.dynamic}',
-            end=""
-        )
+        if TRACER.instrument:
+            TRACER.write(
+                " %s starts playing %s on %s",
+                self,
+                self.pitch,
+                self.dynamic
+            )
+
+        if TRANSITIONS.enabled:
+            TRANSITIONS.record_instrument(
+                "start_playing",
+                self,
+                pitch=self.pitch.to_lilypond()
+            )
 
     def stop_playing(self, skip_stopping_process=False):
         if not skip_stopping_process:
@@ -824,15 +1593,26 @@ class Instrument:
                 self.instrument_group.texture.fade_time
             )
 
-            debug((f"{self} is stopping with {self.dynamic}"), end="")
+            if TRACER.instrument:
+                TRACER.write(" %s is stopping with %s", self, self.dynamic)
         else:
             self.is_stopping = False
             self.is_playing = False
             self.pitch.note = -1
-            debug(f"{self} has stopped", end="")
+            self.report_change()
+
+            if TRACER.instrument:
+                TRACER.write(" %s has stopped", self)
 
         self.instrument_group.num_playing -= 1
 
+        if TRANSITIONS.enabled:
+            TRANSITIONS.record_instrument(
+                "stop_playing",
+                self,
+                fade=not skip_stopping_process
+            )
+
     def should_stop(self):
         max_play_time = self.max_note_length - self.instrument_group.texture.fade_time
 
@@ -847,8 +1627,13 @@ class Instrument:
         self.is_playing = False
         self.play_time = 0
         self.pitch.note = -1
+        self.report_change()
+
+        if TRACER.instrument:
+            TRACER.write(" %s has stopped", self)
 
-        debug(f"{self} has stopped", end="")
+        if TRANSITIONS.enabled:
+            TRANSITIONS.record_instrument("become_quiet", self)
 
     def step(self, step_callback, should_start_new_measure, replace_last_note=False):
         """
@@ -868,9 +1653,14 @@ class Instrument:
 
         if self.is_playing and self.rested:
             self.rested = False
-            self.events += [x["event"] for x in self.after_rest_events if not x["place_before"]]
-            self.events_before += [x["event"] for x in self.after_rest_events if x["place_before"]]
-            self.after_rest_events = []
+
+            for after_rest_event in self.after_rest_events:
+                if after_rest_event["place_before"]:
+                    self.events_before.append(after_rest_event["event"])
+                else:
+                    self.events.append(after_rest_event["event"])
+
+            self.after_rest_events.clear()
         elif not self.is_playing and not self.rested:
             self.rested = True
 
@@ -882,8 +1672,7 @@ class Instrument:
             self.score.new_measure()
 
         if replace_last_note:
-            self.score.get_last_measure().notes.pop(-1)
-            self.score.get_last_measure().add_note(self.pitch, self.events, self.events_before)
+            self.score.get_last_measure().replace_last_note(self.pitch, self.events, self.events_before)
         else:
             previous_note = self.score.get_last_note()
 
@@ -896,9 +1685,20 @@ class Instrument:
 
             self.score.get_last_measure().add_note(self.pitch, self.events, self.events_before)
 
-        self.events = []
-        self.events_before = []
+        # The notes copy the events, so the buffers can be reused.
+        self.events.clear()
+        self.events_before.clear()
 
+    def copy_idle_state(self, instrument):
+        """
+        Take over what an idle instrument will play from another one, e.g.
+        the representative of an InstrumentBucket.
+        """
+        self.rested = instrument.rested
+        self.pitch = Pitch(instrument.pitch.note, instrument.pitch.octave)
+        self.events = list(instrument.events)
+        self.events_before = list(instrument.events_before)
+        self.after_rest_events = [dict(event) for event in instrument.after_rest_events]
 
     def can_start_playing(self):
         # If the instrument is not playing, play_time tracks the length of the
@@ -908,7 +1708,7 @@ class Instrument:
         elif self.play_time is None:
             return True
 
-        ready_to_start = self.play_time >= self.instrument_group.texture.rest_time
+        ready_to_start = self.play_time >= self.instrument_group.texture.get_rest_time(self)
         return ready_to_start and not self.is_playing
 
     def counts_as_playing(self):
@@ -925,13 +1725,24 @@ class Instrument:
 
         return "".join(varname_list) + "notes"
 
-    def encode_lilypond(self, folder_name):
-        print(f'\x1b[2KEncoding score for {self.name} in lilypond...', end="\r")
-        time.sleep(0.05)
-        filename = self.name.replace(" ", "") + ".ly"
+    def get_lilypond_filename(self):
+        return self.name.replace(" ", "") + ".ly"
+
+    def encode_lilypond(
+            self,
+            folder_name,
+            cache=None,
+            manifest=None,
+            compress_repeats=False
+        ):
+        if not HEADLESS:
+            print(f'\x1b[2KEncoding score for {self.name} in lilypond...', end="\r")
+            time.sleep(0.05)
+
+        filename = self.get_lilypond_filename()
         lilypond_score = ""
         lilypond_score += "{" if folder_name is not None else ""
-        lilypond_score += self.score.encode_lilypond()
+        lilypond_score += self.score.encode_lilypond(cache, compress_repeats)
         lilypond_score += "}\n" if folder_name is not None else "\n"
 
         if folder_name is None:
@@ -940,8 +1751,7 @@ class Instrument:
             print("------------------------------")
             return
 
-        with open(f'{folder_name}/{filename}', 'w+') as file:
-            file.write(lilypond_score)
+        write_output_file(f'{folder_name}/{filename}', lilypond_score, manifest)
 
     def add_dynamic_event(self):
         lilypond = self.dynamic.as_lilypond()
@@ -960,7 +1770,7 @@ class Instrument:
         # Dynamics marks at a rest are added to the previous note.
         if self.pitch.note == -1:
             last_note = self.score.get_last_note()
-            last_note.end_events.append(self.dynamic.as_lilypond())
+            last_note.add_end_event(self.dynamic.as_lilypond())
         elif (
             self.dynamic.start_dynamic is not None and
             self.dynamic.start_dynamic == self.dynamic.value and
@@ -985,8 +1795,8 @@ class Instrument:
 
     def add_event_after_rest(self, event, place_before=False):
         """
-        Add a note event after the next rest.
-        TODO: implement place before.
+        Add a note event to the first note after the next rest, before the
+        note if place_before is set.
         """
         self.after_rest_events.append({
             "event": event,
@@ -1003,8 +1813,115 @@ class Instrument:
         self.max_note_length = max_note_length
 
 
-class InstrumentGroup:
-    def __init__(
+class InstrumentBucket:
+    """
+    Idle players of an aggregated InstrumentGroup that are in the same state,
+    simulated as one representative instrument. From the measure a player
+    joined at, its music is that of the representative, whose measures are
+    shared with the player's score when the bucket is flushed.
+    """
+    def __init__(self, instrument, measure_index):
+        self.representative = Instrument(
+            f"{instrument.instrument_group.name} (idle)",
+            instrument.pitch_range,
+            instrument.instrument_group,
+            instrument.max_note_length,
+            instrument.can_solo
+        )
+        self.representative.copy_idle_state(instrument)
+        self.representative.allowed_to_play = instrument.allowed_to_play
+
+        if instrument.dynamic is not None:
+            self.representative.dynamic = copy(instrument.dynamic)
+            self.representative.dynamic.parent = self.representative
+
+        self.representative.play_time = 0  # Counts the steps of the bucket.
+        self.representative.score.first_measure = measure_index
+        # Index -> (instrument, measure joined at, representative's play_time
+        # at joining, instrument's play_time at joining).
+        self.members = {}
+        self.member_indices = []  # A heap, which may hold removed members.
+
+    def add(self, index, instrument, measure_index):
+        self.members[index] = (
+            instrument,
+            measure_index,
+            self.representative.play_time,
+            instrument.play_time
+        )
+        heapq.heappush(self.member_indices, index)
+
+    def get_first_index(self):
+        """
+        Get the lowest index of the players in this bucket, or None if it is
+        empty.
+        """
+        while len(self.member_indices) != 0 and self.member_indices[0] not in self.members:
+            heapq.heappop(self.member_indices)
+
+        return self.member_indices[0] if len(self.member_indices) != 0 else None
+
+    def flush_member(self, index):
+        """
+        Update the score of a player with the measures of the representative
+        since it joined.
+        """
+        instrument, measure_index, _, _ = self.members[index]
+        score = self.representative.score
+        measures = score.measures[measure_index - score.first_measure:]
+
+        for measure in measures:
+            measure.is_shared = True
+
+        instrument.score.measures[measure_index - instrument.score.first_measure:] = measures
+
+    def flush(self):
+        """
+        Update the scores of all players in this bucket, and forget the
+        representative's measures that all of them have.
+        """
+        score = self.representative.score
+        last_measure_index = score.get_num_measures() - 1
+
+        for index in self.members:
+            self.flush_member(index)
+            instrument, _, play_time, instrument_play_time = self.members[index]
+            self.members[index] = (instrument, last_measure_index, play_time, instrument_play_time)
+
+        score.remove_measures_before(last_measure_index)
+
+    def remove(self, index):
+        """
+        Take a player out of this bucket, updating its score and state, to be
+        simulated on its own from now on.
+        """
+        self.flush_member(index)
+        instrument, _, play_time, instrument_play_time = self.members.pop(index)
+        instrument.copy_idle_state(self.representative)
+
+        if instrument_play_time is None:
+            instrument.play_time = None
+        else:
+            instrument.play_time = instrument_play_time + (
+                self.representative.play_time - play_time
+            )
+
+        return instrument
+
+
+class InstrumentGroup:
+    """
+    A group of identical instruments, such as the trumpets.
+
+    An aggregated group simulates its idle players, those that are ready to
+    play or not allowed to, in buckets of players in the same state, so a
+    simulation step takes time in the number of distinct states instead of
+    the number of players. The scores of the players are updated from the
+    buckets by flush_buckets, which Piece does whenever it stops simulating.
+    Aggregated groups always let the players that are ready enter in order,
+    so they can not be used with look-ahead planning or a random entry order.
+    """
+    def __init__(
             self,
             groupname,
             instrument_name,
@@ -1012,7 +1929,8 @@ class InstrumentGroup:
             max_note_length,
             size,
             texture = None,
-            number_start = 1
+            number_start = 1,
+            aggregate = False
         ):
         self.name = groupname
         self.texture = texture
@@ -1038,10 +1956,163 @@ class InstrumentGroup:
         self.num_playing = 0
         self.time_since_start = 10000
         self.max_playing = 0
+        self.aggregate = aggregate
+        # The indices of the instruments that are simulated on their own, in
+        # order, and the buckets of the others.
+        self.individual_indices = list(range(size))
+        self.buckets = []
+        self.instrument_buckets = {}  # Index -> InstrumentBucket.
 
     def __str__(self):
         return f'[Instrument group: {self.name}]'
 
+    def get_simulated_instruments(self):
+        """
+        Get the instruments to simulate: all instruments, or for an aggregated
+        group, the instruments that are not idle and the representatives of
+        the buckets of the others.
+        """
+        if not self.aggregate:
+            return self.instruments
+
+        return [self.instruments[index] for index in self.individual_indices] + [
+            bucket.representative for bucket in self.get_buckets()
+        ]
+
+    def get_buckets(self):
+        """
+        Get the buckets that have instruments.
+        """
+        if any(len(bucket.members) == 0 for bucket in self.buckets):
+            self.buckets = [bucket for bucket in self.buckets if len(bucket.members) != 0]
+
+        return self.buckets
+
+    def get_idle_key(self, instrument, is_representative=False):
+        """
+        Get the state of an instrument that determines what it will play, if
+        it is idle and can be put in a bucket, or None.
+
+        @param is_representative:   Whether the instrument represents a
+                                    bucket, whose players are all ready.
+        """
+        if instrument.is_playing:
+            return None
+        elif (
+            not is_representative and
+            instrument.allowed_to_play and
+            instrument.play_time is not None and
+            instrument.play_time < self.texture.get_rest_time(instrument)
+        ):
+            return None
+        elif instrument.dynamic is not None and (
+            instrument.dynamic.is_changing or
+            instrument.dynamic.change_start_time is not None
+        ):
+            return None
+
+        return (
+            instrument.allowed_to_play,
+            instrument.rested,
+            instrument.pitch.note,
+            instrument.pitch.octave,
+            None if instrument.dynamic is None else instrument.dynamic.value,
+            instrument.max_note_length,
+            tuple(instrument.events),
+            tuple(instrument.events_before),
+            tuple(
+                (event["event"], event["place_before"])
+                for event in instrument.after_rest_events
+            ),
+        )
+
+    def update_buckets(self, measure_index):
+        """
+        Put the idle instruments in buckets, at the start of the measure with
+        the given index, before it is simulated.
+        """
+        buckets = {}
+
+        for bucket in self.get_buckets():
+            key = self.get_idle_key(bucket.representative, True)
+            other_bucket = buckets.get(key)
+
+            if other_bucket is None:
+                buckets[key] = bucket
+                continue
+
+            # Both buckets will play the same from now on.
+            bucket.flush()
+
+            for index in list(bucket.members):
+                instrument = bucket.remove(index)
+                other_bucket.add(index, instrument, measure_index)
+                self.instrument_buckets[index] = other_bucket
+
+        individual_indices = []
+
+        for index in self.individual_indices:
+            instrument = self.instruments[index]
+            key = self.get_idle_key(instrument)
+
+            if key is None:
+                individual_indices.append(index)
+                continue
+            elif key not in buckets:
+                buckets[key] = InstrumentBucket(instrument, measure_index)
+
+            buckets[key].add(index, instrument, measure_index)
+            self.instrument_buckets[index] = buckets[key]
+
+        self.individual_indices = individual_indices
+        self.buckets = list(buckets.values())
+
+    def remove_from_bucket(self, index):
+        """
+        Simulate the instrument at the given index on its own again.
+        """
+        bucket = self.instrument_buckets.pop(index, None)
+
+        if bucket is not None:
+            bucket.remove(index)
+            bisect.insort(self.individual_indices, index)
+
+        return self.instruments[index]
+
+    def flush_buckets(self):
+        """
+        Update the scores of the instruments in buckets.
+        """
+        for bucket in self.get_buckets():
+            bucket.flush()
+
+    def get_entry_candidates(self):
+        """
+        Get the instruments that may start playing in this step of an
+        aggregated group, in order, for as long as the group should start
+        playing. Ready players are taken out of their bucket one at a time.
+        """
+        candidates = [(index, 0, None) for index in self.individual_indices]
+
+        for bucket in self.get_buckets():
+            if bucket.representative.allowed_to_play:
+                candidates.append((bucket.get_first_index(), id(bucket), bucket))
+
+        heapq.heapify(candidates)
+
+        while len(candidates) != 0 and self.should_start_playing():
+            index, _, bucket = heapq.heappop(candidates)
+
+            if bucket is None:
+                yield self.instruments[index]
+                continue
+
+            yield self.remove_from_bucket(index)
+            next_index = bucket.get_first_index()
+
+            if next_index is not None:
+                heapq.heappush(candidates, (next_index, id(bucket), bucket))
+
     def __gt__(self, other):
         return self.get_num_instruments() > other.get_num_instruments()
 
@@ -1070,22 +2141,38 @@ class InstrumentGroup:
     def set_texture(self, texture):
         self.texture = texture
 
-    def encode_lilypond(self, folder_name):
+    def get_lilypond_filename(self):
+        """
+        Get the path of the file with this group's texture score, relative to
+        the output folder.
+        """
+        return "group_scores/" + self.name + ".ly"
+
+    def encode_lilypond(
+            self,
+            folder_name,
+            cache=None,
+            manifest=None,
+            compress_repeats=False
+        ):
         for instrument in self.instruments:
-            instrument.encode_lilypond(folder_name)
+            instrument.encode_lilypond(folder_name, cache, manifest, compress_repeats)
 
     def add_note_event(self, event, place_before=False):
         """
         Add a note event, such as an instruction or rehearsal mark, to all
         instruments in this group.
         """
-        for instrument in self.instruments:
+        for instrument in self.get_simulated_instruments():
             instrument.add_note_event(event, place_before)
 
     def allow_instrument(self, index, allowed):
         """
         Allow the instrument at the given index to start playing.
         """
+        if self.aggregate and self.instruments[index].allowed_to_play != allowed:
+            self.remove_from_bucket(index)
+
         self.instruments[index].allowed_to_play = allowed
 
     def set_num_allowed_to_play(self, num):
@@ -1100,7 +2187,7 @@ class InstrumentGroup:
         return len(self.instruments)
 
     def add_event_after_rest(self, event, place_before=False):
-        for instrument in self.instruments:
+        for instrument in self.get_simulated_instruments():
             instrument.add_event_after_rest(event, place_before=place_before)
 
     def get_num_trailing_empty_measures(self):
@@ -1120,6 +2207,8 @@ class InstrumentGroup:
 
 
 class Texture:
+    INVISIBLE_REST = Pitch(Pitch.REST, 0, is_invisible_rest=True)
+
     def __init__(
             self,
             pitches,
@@ -1224,6 +2313,18 @@ class Texture:
     def set_max_playing(self, new_value):
         self.max_playing = new_value
         self.update_groups_max_playing()
+        self.update_texture_registry()
+
+        if TRANSITIONS.enabled and self.piece is not None:
+            TRANSITIONS.record_texture("set_max_playing", self, value=new_value)
+
+    def update_texture_registry(self):
+        """
+        Let the piece know that this texture's pitches, density or max_playing
+        have changed.
+        """
+        if self.piece is not None:
+            self.piece.texture_registry.update(self)
 
     def step(self, should_start_new_measure):
         self.dynamic.step()
@@ -1234,11 +2335,19 @@ class Texture:
                 should_start_new_measure
             )
 
+            if TRACER.texture >= 2:
+                TRACER.write(
+                    " %s: %s of %s playing",
+                    instrument_group.name,
+                    instrument_group.num_playing,
+                    instrument_group.max_playing
+                )
+
         if should_start_new_measure:
             self.score.new_measure()
 
-        self.score.get_last_measure().add_note(Pitch(Pitch.REST, 0, is_invisible_rest=True), self.dynamic_events, [])
-        self.dynamic_events = []
+        self.score.get_last_measure().add_note(Texture.INVISIBLE_REST, self.dynamic_events)
+        self.dynamic_events.clear()
 
     def instrument_group_step(self, instrument_group, should_start_new_measure):
         raise Exception(
@@ -1253,17 +2362,31 @@ class Texture:
     def get_pitch(self, *_):
         raise Exception(f'Texture {self} get_pitch not implemented.')
 
-    def encode_lilypond(self, folder_name):
+    def encode_lilypond(
+            self,
+            folder_name,
+            cache=None,
+            manifest=None,
+            compress_repeats=False
+        ):
         score = "{" if folder_name is not None else ""
-        score += self.score.encode_lilypond()
+        score += self.score.encode_lilypond(cache, compress_repeats)
         score += "}\n" if folder_name is not None else ""
 
         for instrument_group in self.instrument_groups:
-            instrument_group.encode_lilypond(folder_name)
+            instrument_group.encode_lilypond(
+                folder_name,
+                cache,
+                manifest,
+                compress_repeats
+            )
 
             if folder_name is not None:
-                with open(folder_name + "/group_scores/" + instrument_group.name + ".ly", "+w") as file:
-                    file.write(score)
+                write_output_file(
+                    folder_name + "/" + instrument_group.get_lilypond_filename(),
+                    score,
+                    manifest
+                )
 
 
     def handle_dynamics(self):
@@ -1314,6 +2437,14 @@ class Texture:
         for instrument_group in self.instrument_groups:
             instrument_group.set_num_allowed_to_play(density)
 
+        self.update_texture_registry()
+
+        if TRACER.texture and self.piece is not None:
+            TRACER.write(" %s has density %s", self, density)
+
+        if TRANSITIONS.enabled and self.piece is not None:
+            TRANSITIONS.record_texture("set_density", self, value=density)
+
     def add_player(self):
         if self.density < self.max_playing:
             self.set_density(self.density + 1)
@@ -1327,9 +2458,9 @@ class Texture:
         self.set_density(0)
         self.set_max_playing(0)
 
-    def add_event_after_rest(self, event, placeBefore=False):
+    def add_event_after_rest(self, event, place_before=False):
         for instrument_group in self.instrument_groups:
-            instrument_group.add_event_after_rest(event, placeBefore=placeBefore)
+            instrument_group.add_event_after_rest(event, place_before=place_before)
 
     def remove_player(self):
         if self.density > self.max_playing:
@@ -1367,6 +2498,47 @@ class Texture:
             instrument_group.remove_measures_from_end(num_measures)
 
 
+def get_random(seed, *keys):
+    """
+    Get a pseudorandom number that only depends on a seed and keys, such as a
+    texture, an instrument and a timestep. There is no generator whose state
+    has to be passed on, so any process computes the same numbers on its own
+    and in any order, however the simulation is split into sections, forked
+    or spread over processes.
+
+    @returns:   A float in [0, 1).
+    """
+    digest = hashlib.blake2b(repr((seed,) + keys).encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big") / 2**64
+
+
+class RotationPlan:
+    """
+    The planned entries of the instruments of one InstrumentGroup in a Line,
+    in timesteps since the start of the piece, up to end_tick.
+
+    Instruments that would stop together with others are planned to stop
+    earlier, before they reach their max_note_length, in stops.
+
+    A plan is valid as long as the parameters of the texture it was planned
+    with do not change and every planned entry is possible when it comes up.
+    """
+    def __init__(self, parameters, end_tick):
+        self.parameters = parameters
+        self.end_tick = end_tick
+        self.entries = {}  # Tick -> list of instruments.
+        self.stops = {}  # Tick -> list of instruments.
+        self.is_valid = True
+
+
+def to_ticks(time_in_measures):
+    """
+    Get the number of whole timesteps needed to reach the given time.
+    """
+    return max(0, math.ceil(time_in_measures / TIMESTEP - 1e-9))
+
+
 class Line(Texture):
     """
     A line is a note that is being sustained by multiple instrument(group)s.
@@ -1375,6 +2547,17 @@ class Line(Texture):
 
     A line has a pitch, a dynamic, and a group of instrument types. The change
     rate variable is used to morph the line between instrument groups.
+
+    By default, whether instruments start playing is decided on every
+    timestep. With look_ahead set, the entries are planned that many measures
+    ahead instead (see plan_rotation), and the timesteps only follow the plan,
+    which also stops instruments early to stagger their exits.
+
+    With a seed, a line can vary the length of rests by up to rest_time_jitter
+    measures, the order in which its instruments enter and which of its
+    pitches they play. The random numbers are keyed by the seed, the line's
+    name, the instrument and the timestep (see get_random), so the same seed
+    gives the same piece.
     """
     def __init__(
             self,
@@ -1386,7 +2569,13 @@ class Line(Texture):
             change_rate=0,
             rest_time=0.5,
             fade_time=0.5,
-            density=0
+            density=0,
+            look_ahead=None,
+            name=None,
+            seed=None,
+            rest_time_jitter=0,
+            random_entry_order=False,
+            random_pitches=False
         ):
 
         super().__init__(pitches, dynamic, instrument_groups, piece, max_playing, density=density)
@@ -1396,6 +2585,14 @@ class Line(Texture):
         self.piece = piece
         self.manual_rest_time = True
         self.rest_time_range = (None, None)
+        self.look_ahead = look_ahead
+        self.rotation_plans = {}  # InstrumentGroup -> RotationPlan.
+        self.name = name
+        self.seed = seed
+        self.rest_time_jitter = rest_time_jitter
+        self.random_entry_order = random_entry_order
+        self.random_pitches = random_pitches
+        self.check_aggregated_groups()
 
     def __str__(self):
         return f'[Line with pitches {self.pitches}]'
@@ -1405,15 +2602,36 @@ class Line(Texture):
         The part of an InstrumentGroup's simulation step that is specific to
         the Line texture.
         """
-        for instrument in instrument_group.instruments:
+        if instrument_group.aggregate and should_start_new_measure:
+            instrument_group.update_buckets(round(self.piece.time))
+
+        for instrument in instrument_group.get_simulated_instruments():
             instrument.step(self.instrument_step, should_start_new_measure)
 
-        for instrument in instrument_group.instruments:
+        if self.look_ahead is not None:
+            self.follow_rotation_plan(instrument_group)
+            return
+
+        instruments = instrument_group.instruments
+
+        if instrument_group.aggregate:
+            instruments = instrument_group.get_entry_candidates()
+        elif self.seed is not None and self.random_entry_order:
+            tick = self.get_tick()
+            instruments = sorted(
+                instruments,
+                key=lambda instrument: self.get_random("entry", instrument, tick)
+            )
+
+        for instrument in instruments:
             if instrument_group.should_start_playing():
                 if instrument.can_start_playing():
-                    instrument.start_playing()
-                    instrument.step(self.instrument_step, False, True)
-                    instrument_group.time_since_start = 0
+                    self.start_instrument(instrument)
+
+    def start_instrument(self, instrument):
+        instrument.start_playing()
+        instrument.step(self.instrument_step, False, True)
+        instrument.instrument_group.time_since_start = 0
 
     def instrument_step(self, instrument):
         """
@@ -1426,6 +2644,322 @@ class Line(Texture):
         if instrument.should_stop():
             instrument.stop_playing()
 
+    def get_tick(self):
+        """
+        Get the current time in timesteps since the start of the piece.
+        """
+        return round(self.piece.time / TIMESTEP)
+
+    def get_random(self, purpose, instrument, tick):
+        return get_random(self.seed, self.name, purpose, instrument.name, tick)
+
+    def get_rest_time(self, instrument, rest_start_tick=None):
+        """
+        Get the time an instrument has to rest for before it can play again,
+        varied by up to rest_time_jitter for every rest if the line has a
+        seed.
+
+        @param rest_start_tick: The timestep the rest started at, by default
+                                that of the instrument's current rest.
+        """
+        if self.seed is None or self.rest_time_jitter == 0:
+            return self.rest_time
+
+        if rest_start_tick is None:
+            rest_start_tick = self.get_tick() - round(instrument.play_time / TIMESTEP)
+
+        offset = (2 * self.get_random("rest", instrument, rest_start_tick) - 1) * self.rest_time_jitter
+
+        return max(0, round((self.rest_time + offset) / TIMESTEP) * TIMESTEP)
+
+    def set_look_ahead(self, look_ahead):
+        """
+        Plan entries look_ahead measures ahead, or decide them on every
+        timestep if look_ahead is None.
+        """
+        self.look_ahead = look_ahead
+        self.rotation_plans = {}
+        self.check_aggregated_groups()
+
+    def check_aggregated_groups(self):
+        if self.look_ahead is None and not (self.seed is not None and self.random_entry_order):
+            return
+
+        for instrument_group in self.instrument_groups:
+            if instrument_group.aggregate:
+                raise Exception(
+                    f"Aggregated group {instrument_group.name} can not be used "
+                    "with look_ahead or random_entry_order."
+                )
+
+    def get_rotation_parameters(self, instrument_group):
+        """
+        Get everything a RotationPlan of the instrument group depends on,
+        except the rest time: a rest time linked to the dynamic changes on
+        almost every timestep of a dynamic change. A plan made with a shorter
+        rest time becomes invalid when an instrument is not ready to enter
+        yet, and one made with a longer rest time only enters instruments
+        later than needed.
+        """
+        return (
+            self.look_ahead,
+            self.max_playing,
+            self.density,
+            instrument_group.max_playing,
+            self.rest_time_jitter,
+            self.fade_time,
+            tuple(instrument.max_note_length for instrument in instrument_group.instruments)
+        )
+
+    def follow_rotation_plan(self, instrument_group):
+        """
+        Stop and start the instruments that are planned to stop and start on
+        this timestep, planning again first if needed.
+        """
+        tick = self.get_tick()
+        plan = self.rotation_plans.get(instrument_group)
+
+        if (
+            plan is None or
+            not plan.is_valid or
+            tick >= plan.end_tick or
+            plan.parameters != self.get_rotation_parameters(instrument_group)
+        ):
+            plan = self.plan_rotation(instrument_group, tick, plan)
+            self.rotation_plans[instrument_group] = plan
+
+        for instrument in plan.stops.pop(tick, ()):
+            if instrument.is_playing and not instrument.is_stopping:
+                instrument.stop_playing()
+
+        for instrument in plan.entries.pop(tick, ()):
+            if instrument_group.should_start_playing() and instrument.can_start_playing():
+                self.start_instrument(instrument)
+            else:
+                plan.is_valid = False
+
+    def plan_rotation(self, instrument_group, tick, previous_plan=None):
+        """
+        Plan the entries of an instrument group from the given timestep until
+        look_ahead measures later, from the current state of its instruments.
+
+        Every place among the group's max_playing is filled again as soon as
+        its instrument stops, by the allowed instrument that has been
+        available the longest, keeping the entries fade_time apart and the
+        rests rest_time long, like the timesteps would. The times
+        instruments become available are kept in a heap, so planning does not
+        check every instrument on every timestep.
+
+        Unlike the timesteps, the plan staggers the exits (see
+        stagger_exits): instruments that enter a fade time apart would reach
+        their max_note_length together and leave while the instruments to
+        replace them are still resting, so the earlier ones stop early.
+
+        @param previous_plan:   The plan being replaced, whose early stops
+                                of the instruments still playing are kept.
+        @returns:               A RotationPlan.
+        """
+        fade = to_ticks(self.fade_time)
+        plan = RotationPlan(
+            self.get_rotation_parameters(instrument_group),
+            tick + max(1, to_ticks(self.look_ahead))
+        )
+        num_places = min(
+            math.ceil(instrument_group.max_playing - 1e-9),
+            math.ceil(self.max_playing - 1e-9)
+        )
+        spacing = self.get_exit_spacing(instrument_group, num_places)
+        early_stops = {}  # Instrument -> tick.
+        # [tick the place becomes free, its instrument, the tick the
+        # instrument entered, the tick it would stop at by itself]
+        places = []
+        # (tick, entry key, instrument), of which only the latest tick of an
+        # instrument, in rest_ends, is still valid.
+        available = []
+        rest_ends = {}  # Instrument -> tick.
+        indices = {
+            instrument: index
+            for index, instrument in enumerate(instrument_group.instruments)
+        }
+
+        if previous_plan is not None:
+            for stop, instruments in previous_plan.stops.items():
+                if stop >= tick:
+                    for instrument in instruments:
+                        # The earliest one is that of the current note.
+                        early_stops[instrument] = min(
+                            stop, early_stops.get(instrument, stop)
+                        )
+
+        for index, instrument in enumerate(instrument_group.instruments):
+            # How long the instrument has played, faded out or rested.
+            elapsed = 0 if instrument.play_time is None else round(instrument.play_time / TIMESTEP)
+
+            if instrument.is_playing and not instrument.is_stopping:
+                natural_stop = tick - elapsed + 1 + self.get_tenure(instrument)
+                stop = min(natural_stop, early_stops.get(instrument, natural_stop))
+                places.append([
+                    stop,
+                    instrument,
+                    natural_stop - self.get_tenure(instrument),
+                    natural_stop
+                ])
+                quiet = stop + fade
+            elif instrument.is_playing:
+                quiet = tick - elapsed + fade
+            else:
+                quiet = tick - elapsed
+
+            if not instrument.allowed_to_play:
+                continue
+            elif instrument.play_time is None:
+                rest_ends[instrument] = tick
+                heapq.heappush(available, (tick, self.get_entry_key(instrument, tick, index), instrument))
+            else:
+                rest_end = quiet + self.get_rest_ticks(instrument, quiet)
+                rest_ends[instrument] = max(tick, rest_end)
+                heapq.heappush(
+                    available,
+                    (max(tick, rest_end), self.get_entry_key(instrument, rest_end, index), instrument)
+                )
+
+        for _ in range(num_places - len(places)):
+            places.append([tick, None, None, tick])
+
+        last_start = tick - round(instrument_group.time_since_start / TIMESTEP)
+
+        while len(places) != 0:
+            while len(available) != 0 and rest_ends[available[0][2]] != available[0][0]:
+                heapq.heappop(available)
+
+            if len(available) == 0:
+                break
+
+            place = min(places, key=lambda place: place[0])
+            start = max(place[0], last_start + fade, available[0][0])
+
+            if start >= plan.end_tick:
+                break
+
+            self.add_early_stop(plan, place)
+            _, _, instrument = heapq.heappop(available)
+            stop = start + self.get_tenure(instrument)
+            place[:] = [stop, instrument, start, stop]
+            plan.entries.setdefault(start, []).append(instrument)
+            last_start = start
+            rest_end = stop + fade + self.get_rest_ticks(instrument, stop + fade)
+            rest_ends[instrument] = rest_end
+            heapq.heappush(
+                available,
+                (rest_end, self.get_entry_key(instrument, rest_end, indices[instrument]), instrument)
+            )
+
+            for moved in self.stagger_exits(places, place, spacing, tick):
+                _, instrument, _, _ = moved
+                rest_end = moved[0] + fade + self.get_rest_ticks(instrument, moved[0] + fade)
+                rest_ends[instrument] = rest_end
+                heapq.heappush(available, (
+                    rest_end,
+                    self.get_entry_key(instrument, rest_end, indices[instrument]),
+                    instrument
+                ))
+
+        for place in places:
+            self.add_early_stop(plan, place)
+
+        return plan
+
+    def add_early_stop(self, plan, place):
+        """
+        Add the stop of the instrument in a place of plan_rotation to the plan
+        if it stops before its max_note_length.
+        """
+        stop, instrument, _, natural_stop = place
+
+        if instrument is not None and stop < natural_stop:
+            plan.stops.setdefault(stop, []).append(instrument)
+
+    def stagger_exits(self, places, place, spacing, tick):
+        """
+        Move the exits of the instruments that are still playing in the other
+        places of plan_rotation when an instrument enters the given place
+        earlier, so they stop at least spacing timesteps before it and each
+        other, as far as they can: an instrument plays for at least one
+        timestep and can not stop before the current timestep.
+
+        @returns:   The places whose exits moved.
+        """
+        moved = []
+        next_stop = place[0]
+        others = sorted(
+            (
+                other for other in places
+                if other is not place and place[2] < other[0] <= next_stop
+            ),
+            key=lambda other: other[0],
+            reverse=True
+        )
+
+        for other in others:
+            if next_stop - other[0] >= spacing:
+                break
+
+            stop = next_stop - spacing
+
+            if stop < max(other[2] + 1, tick):
+                break
+
+            other[0] = stop
+            moved.append(other)
+            next_stop = stop
+
+        return moved
+
+    def get_exit_spacing(self, instrument_group, num_places):
+        """
+        Get the number of timesteps plan_rotation keeps between the exits of
+        the instruments of a group, which spreads them evenly over the time
+        between two entries in a place: an instrument's note if enough
+        instruments are resting to replace it right away, or else the time it
+        takes the instruments to play, fade out and rest in turns.
+        """
+        instruments = [
+            instrument for instrument in instrument_group.instruments
+            if instrument.allowed_to_play
+        ]
+
+        if len(instruments) == 0:
+            return 0
+
+        tenure = max(self.get_tenure(instrument) for instrument in instruments)
+        cycle = tenure + to_ticks(self.fade_time) + to_ticks(self.rest_time)
+        place_cycle = max(tenure, math.ceil(cycle * num_places / len(instruments)))
+
+        return math.ceil(place_cycle / max(1, num_places))
+
+    def get_rest_ticks(self, instrument, rest_start_tick):
+        return to_ticks(self.get_rest_time(instrument, rest_start_tick))
+
+    def get_entry_key(self, instrument, tick, index):
+        """
+        Get the key that orders the instruments that can enter at the same
+        timestep in a plan: their index, or a random order if the line has
+        random_entry_order.
+        """
+        if self.seed is not None and self.random_entry_order:
+            return (self.get_random("entry", instrument, tick), index)
+
+        return (index,)
+
+    def get_tenure(self, instrument):
+        """
+        Get the number of timesteps an instrument plays before it starts to
+        fade out (see Instrument.should_stop).
+        """
+        return max(0, math.floor(
+            (instrument.max_note_length - self.fade_time) / TIMESTEP + 1e-9
+        ))
+
     def set_rest_time_from_dynamic(self):# Interpolate rest time from range based on dynamic.
         if self.dynamic.value <= self.dynamic_range_for_rest_time[0]:
             self.rest_time = self.rest_time_range[0]
@@ -1451,13 +2985,21 @@ class Line(Texture):
 
     def add_pitch(self, pitch):
         self.pitches.insert(0, pitch)
+        self.update_texture_registry()
 
-    def get_pitch(self):
+    def get_pitch(self, instrument=None):
         """
-        Get the next pitch to be performed for this texture.
+        Get the next pitch to be performed for this texture, or with
+        random_pitches, a random one of its pitches.
 
-        @returns:   A Pitch object.
+        @param instrument:  The instrument that will play the pitch.
+        @returns:           A Pitch object.
         """
+        if self.seed is not None and self.random_pitches and instrument is not None:
+            index = int(self.get_random("pitch", instrument, self.get_tick()) * len(self.pitches))
+            pitch = self.pitches[index]
+            return Pitch(pitch.note, pitch.octave)
+
         pitch = self.pitches.pop(0)
         self.pitches.append(pitch)
         return Pitch(pitch.note, pitch.octave)
@@ -1469,7 +3011,7 @@ class Line(Texture):
         """
 
         for instrument_group in self.instrument_groups:
-            for instrument in instrument_group.instruments:
+            for instrument in instrument_group.get_simulated_instruments():
 
                 if instrument.is_playing and not instrument.is_stopping:
                     # Change the instrument's target dynamic to this Line's
@@ -1505,7 +3047,7 @@ class Line(Texture):
             new_line.dynamic.parent = new_line
             new_line.pitches = deepcopy(self.pitches)
             instrument_group.texture = new_line
-            new_line.piece.textures.append(new_line)
+            new_line.piece.add_texture(new_line)
             new_line.score = deepcopy(self.score)
             new_line.dynamic_events = copy(self.dynamic_events)
             new_line.set_density(
@@ -1537,6 +3079,9 @@ class Line(Texture):
     def set_fade_time(self, fade_time):
         self.fade_time = fade_time
 
+    def set_rest_time_jitter(self, rest_time_jitter):
+        self.rest_time_jitter = rest_time_jitter
+
     def link_rest_time_to_dynamic(
             self,
             range,
@@ -1548,6 +3093,7 @@ class Line(Texture):
 
     def set_pitches(self, pitches):
         self.pitches = pitches
+        self.update_texture_registry()
 
 
 class MusicEvent:
@@ -1561,40 +3107,201 @@ class MusicEvent:
         self.args = args
 
     def execute(self):
+        if TRANSITIONS.enabled:
+            TRANSITIONS.record(
+                self.time,
+                "music_event",
+                action=getattr(self.action, "__qualname__", str(self.action))
+            )
+
         if self.args is None:
             self.action()
         else:
             self.action(*self.args)
 
 
+class TickDelta:
+    """
+    What changed for the players of a piece during one timestep: which
+    instruments started and stopped sounding, and whose dynamic changed.
+    Instruments are listed with their pitch key (see Pitch.sort_key) and
+    dynamic value.
+    """
+    def __init__(self, time):
+        self.time = time
+        self.started = []  # (instrument, pitch key, dynamic) tuples.
+        self.stopped = []  # (instrument, pitch key) tuples.
+        self.dynamic_changes = []  # (instrument, dynamic) tuples.
+
+    def get_state(instrument):
+        """
+        Get what a player is doing: the pitch key it is sounding (or -1) and
+        its dynamic.
+        """
+        if not instrument.is_playing:
+            return (-1, None)
+
+        return (instrument.pitch.sort_key(), instrument.dynamic.value)
+
+    def add_change(self, instrument, old_state, new_state):
+        old_key, _ = old_state
+        new_key, dynamic = new_state
+
+        if old_key != new_key:
+            if old_key != -1:
+                self.stopped.append((instrument, old_key))
+
+            if new_key != -1:
+                self.started.append((instrument, new_key, dynamic))
+        elif new_key != -1:
+            self.dynamic_changes.append((instrument, dynamic))
+
+    def is_empty(self):
+        return (
+            len(self.started) == 0 and
+            len(self.stopped) == 0 and
+            len(self.dynamic_changes) == 0
+        )
+
+
+class TextureRegistry:
+    """
+    Keeps track of a piece's active textures, i.e. textures with a density and
+    max_playing above zero, ordered by their lowest and highest pitch. This
+    allows finding the active texture with the lowest or highest pitch in
+    logarithmic time.
+
+    The textures are kept in two heaps. Entries are not removed from the heaps
+    when a texture changes; instead, outdated entries are discarded once they
+    reach the top of a heap.
+    """
+    def __init__(self):
+        self.order = {}  # Texture -> registration number, used to break ties.
+        self.active = {}  # Texture -> (lowest pitch key, highest pitch key).
+        self.lowest = []
+        self.highest = []
+        self.num_pushed = 0
+
+    def add(self, texture):
+        """
+        Register a texture and add it to the index if it is active.
+        """
+        if texture not in self.order:
+            self.order[texture] = len(self.order)
+
+        self.update(texture)
+
+    def update(self, texture):
+        """
+        Update a registered texture's entries after its pitches, density or
+        max_playing changed.
+        """
+        if texture not in self.order:
+            return
+
+        if (
+            texture.density <= 0 or
+            texture.max_playing <= 0 or
+            len(texture.pitches) == 0
+        ):
+            self.active.pop(texture, None)
+            return
+
+        keys = (
+            min(pitch.sort_key() for pitch in texture.pitches),
+            max(pitch.sort_key() for pitch in texture.pitches)
+        )
+
+        if self.active.get(texture) == keys:
+            return
+
+        self.active[texture] = keys
+        order = self.order[texture]
+        self.num_pushed += 1
+        heapq.heappush(self.lowest, (keys[0], order, self.num_pushed, texture))
+        heapq.heappush(self.highest, (-keys[1], order, self.num_pushed, texture))
+
+        if len(self.lowest) > 2 * len(self.active) + 16:
+            self.compact()
+
+    def compact(self):
+        """
+        Rebuild both heaps from the active textures, dropping outdated entries.
+        """
+        self.lowest = []
+        self.highest = []
+
+        for texture, keys in self.active.items():
+            order = self.order[texture]
+            self.num_pushed += 1
+            self.lowest.append((keys[0], order, self.num_pushed, texture))
+            self.highest.append((-keys[1], order, self.num_pushed, texture))
+
+        heapq.heapify(self.lowest)
+        heapq.heapify(self.highest)
+
+    def peek(self, heap, key_index, sign):
+        while len(heap) != 0:
+            key, _, _, texture = heap[0]
+            keys = self.active.get(texture)
+
+            if keys is not None and keys[key_index] * sign == key:
+                return texture
+
+            heapq.heappop(heap)
+
+        return None
+
+    def lowest_texture(self):
+        """
+        Get the active texture with the lowest pitch, or None if no texture is
+        active. Ties are won by the texture that was registered first.
+        """
+        return self.peek(self.lowest, 0, 1)
+
+    def highest_texture(self):
+        """
+        Get the active texture with the highest pitch, or None if no texture is
+        active. Ties are won by the texture that was registered first.
+        """
+        return self.peek(self.highest, 1, -1)
+
+
 class Piece:
     """
     This class is used to generate the piece. It manages the timeline and
     ensures the music is executed correctly.
     """
     def __init__(self, tempo, time_signature, num_measures, events, textures):
-        self.time = 0  # The time in measures.
+        self.time = 0.0  # The time in measures.
         self.tempo = tempo
         self.time_signature = time_signature  # Does nothing as of yet.
         self.num_measures = num_measures
         self.events = events
         self.textures = textures
+        self.texture_registry = TextureRegistry()
+        self.encode_stats = {}
+        self.metrics_recorder = None  # See metrics.MetricsRecorder.
 
         for texture in self.textures:
             texture.piece = self
+            self.texture_registry.add(texture)
 
     def show(self):
-        debug("%3f" % self.time, end="")
-
-        if self.time.is_integer():
-            debug("---------", end="")
+        """
+        Trace the current time, marking the start of each measure and beat.
+        """
+        if self.time % 1 == 0:
+            marker = "---------"
         elif self.time % 0.25 == 0:
-            debug("-", end="")
+            marker = "-"
         else:
-            debug(".", end="")
+            marker = "."
+
+        TRACER.write("%3f%s", self.time, marker)
 
     def start(self, num_measures=None):
-        if self.time == 0:
+        if self.time == 0 and not HEADLESS:
             print("Generating piece...")
 
         self.events.sort(key=lambda x: x.time)
@@ -1602,20 +3309,94 @@ class Piece:
         if num_measures is None:
             num_measures = self.num_measures
 
-        while self.time < num_measures:
-            self.show()
-            self.step()
-            debug("")
+        if DEBUG_MODE:
+            TRACER.enable_all()
 
-            self.time += TIMESTEP
+        while self.time < num_measures:
+            self.advance()
 
-            if self.time % 1 == 0:
+            if self.time % 1 == 0 and not HEADLESS:
                 time.sleep(0.02)  # This makes for a prettier demonstration vid.
                 print(f"\x1b[2KGenerating measure {int(self.time)}", end="\r")
 
-        if self.time == self.num_measures:
+        self.flush_buckets()
+        TRACER.flush()
+        TRANSITIONS.flush()
+
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.save()
+
+        if self.time == self.num_measures and not HEADLESS:
             print("\x1b[2K\rPiece finished.")
 
+    def advance(self):
+        """
+        Simulate one timestep, including tracing and recording metrics, and
+        move on to the next.
+        """
+        if TRACER.piece:
+            self.show()
+
+        self.step()
+        TRACER.end_step()
+
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.record()
+
+        self.time += TIMESTEP
+
+    def flush_buckets(self):
+        """
+        Update the scores of the instruments that aggregated groups simulate
+        in buckets (see InstrumentGroup).
+        """
+        for texture in self.textures:
+            for instrument_group in texture.instrument_groups:
+                if instrument_group.aggregate:
+                    instrument_group.flush_buckets()
+
+    def ticks(self, num_measures=None):
+        """
+        A generator that simulates the piece one timestep per iteration, for
+        driving it live, e.g. with playback.PlaybackEngine. Unlike start, this
+        prints nothing and does not wait.
+
+        @param num_measures:    The time to stop at, in measures. Defaults to
+                                the end of the piece.
+        @returns:               A generator of TickDeltas, one per timestep.
+        """
+        self.events.sort(key=lambda x: x.time)
+
+        if num_measures is None:
+            num_measures = self.num_measures
+
+        if DEBUG_MODE:
+            TRACER.enable_all()
+
+        instruments = self.get_instruments()
+        states = [TickDelta.get_state(instrument) for instrument in instruments]
+
+        try:
+            while self.time < num_measures:
+                delta = TickDelta(self.time)
+                self.advance()
+
+                for i, instrument in enumerate(instruments):
+                    state = TickDelta.get_state(instrument)
+
+                    if state != states[i]:
+                        delta.add_change(instrument, states[i], state)
+                        states[i] = state
+
+                yield delta
+        finally:
+            self.flush_buckets()
+            TRACER.flush()
+            TRANSITIONS.flush()
+
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.save()
+
     def step(self):
         # Time is measured in bars/measures.
         should_start_new_measure = self.time.is_integer()
@@ -1626,6 +3407,46 @@ class Piece:
         for texture in self.textures:
             texture.step(should_start_new_measure)
 
+    def fork(self):
+        """
+        Create an independent copy of this piece in its current state, e.g. to
+        try out several endings from the same point in time by adding
+        different events to each fork and starting them.
+
+        The measures written so far are not copied, but shared between this
+        piece and the fork until one of them changes a measure, which then
+        gets its own copy (see LilyPondScore.get_writable_measure). Everything
+        else, including the textures' back-references and the events that
+        have not happened yet, is copied, so a fork can be simulated and
+        encoded without affecting this piece. Events are only redirected to
+        the fork if their action is a method of an object in the piece, as in
+        MusicEvent(10, line.add_player).
+
+        The fork has no MetricsRecorder. Note that TRACER and TRANSITIONS are
+        shared by all pieces.
+
+        @returns:   A new Piece.
+        """
+        memo = {id(self.metrics_recorder): None}
+
+        for texture in self.textures:
+            scores = [texture.score] + [
+                instrument.score
+                for instrument_group in texture.instrument_groups
+                for instrument in instrument_group.instruments
+            ]
+
+            for score in scores:
+                score.share_measures()
+
+                for measure in score.measures:
+                    memo[id(measure)] = measure
+
+        fork = deepcopy(self, memo)
+        fork.encode_stats = {}
+
+        return fork
+
     def remove_trailing_empty_measures(self):
         num_trailing_empty_measures = self.num_measures
 
@@ -1639,20 +3460,127 @@ class Piece:
         for texture in self.textures:
             texture.remove_measures_from_end(num_trailing_empty_measures)
 
-    def encode_lilypond(self, folder_name, remove_trailing_empty_measures=False):
+    def encode_lilypond(
+            self,
+            folder_name,
+            remove_trailing_empty_measures=False,
+            measure_cache_size=4096,
+            use_manifest=True,
+            compress_repeats=False
+        ):
+        """
+        Encode all textures in LilyPond notation and write them to the given
+        folder, or print them if folder_name is None. Statistics about the
+        encoding are stored in self.encode_stats.
+
+        @param measure_cache_size:  The maximum number of encoded measures to
+                                    remember for reuse in identical measures.
+                                    Set to 0 to disable the cache.
+        @param use_manifest:        Keep an OutputManifest in the output
+                                    folder, so files that did not change
+                                    since the previous run are not rewritten.
+        @param compress_repeats:    Write runs of repeated measures once in a
+                                    \\repeat unfold block, see
+                                    LilyPondScore.join_measures.
+        """
+        cache = None
+        manifest = None
+
         if folder_name is not None:
             Path(folder_name).mkdir(exist_ok=True)
             Path(folder_name + "/group_scores").mkdir(exist_ok=True)
 
-        print("Encoding piece in LilyPond...")
+            if use_manifest:
+                manifest = OutputManifest(folder_name)
+
+        if measure_cache_size > 0:
+            cache = LilyPondMeasureCache(measure_cache_size, manifest)
+
+        if not HEADLESS:
+            print("Encoding piece in LilyPond...")
 
         if remove_trailing_empty_measures:
             self.remove_trailing_empty_measures()
 
         for texture in self.textures:
-            texture.encode_lilypond(folder_name)
+            texture.encode_lilypond(folder_name, cache, manifest, compress_repeats)
+
+        if not HEADLESS:
+            print("\x1b[2K\rLilyPond encoding finished.")
+
+        if cache is not None:
+            self.encode_stats["measure_cache_hits"] = cache.hits
+            self.encode_stats["measure_manifest_hits"] = cache.manifest_hits
+            self.encode_stats["measure_cache_misses"] = cache.misses
+            self.encode_stats["measure_cache_hit_rate"] = cache.hit_rate()
+
+            if not HEADLESS:
+                print(
+                    f"Measure cache: {cache.hits} hits, {cache.manifest_hits} "
+                    f"from previous run, {cache.misses} misses "
+                    f"({cache.hit_rate() * 100:.1f}% hit rate)."
+                )
+
+        if manifest is not None:
+            manifest.save()
+            self.encode_stats["files_written"] = manifest.files_written
+            self.encode_stats["files_unchanged"] = manifest.files_unchanged
+
+            if not HEADLESS:
+                print(
+                    f"{manifest.files_written} files written, "
+                    f"{manifest.files_unchanged} unchanged."
+                )
+
+    def compile_lilypond(
+            self,
+            folder_name,
+            output_folder=None,
+            max_workers=None,
+            executable="lilypond"
+        ):
+        """
+        Write a score file for every part and for the full score, which
+        include the files written by encode_lilypond (see
+        lilypond_compiler.write_score_files), and compile them in parallel,
+        together with any other LilyPond file in folder_name that contains a
+        \\score or \\book block. Compile times per file are stored in
+        self.encode_stats.
+
+        @param folder_name:     The folder containing the files to compile.
+        @param output_folder:   The folder to write PDF and MIDI files to.
+                                Defaults to folder_name.
+        @param executable:      The LilyPond executable to use.
+        @returns:               A list of CompilationResults.
+        """
+        compiler = LilyPondCompiler(
+            output_folder or folder_name,
+            max_workers,
+            executable
+        )
+
+        if not compiler.is_available():
+            print(f"{executable} not found, skipping compilation.")
+            return []
+
+        groups = [
+            (
+                instrument_group.name,
+                [
+                    (instrument.name, instrument.get_lilypond_filename())
+                    for instrument in instrument_group.instruments
+                ]
+            )
+            for texture in self.textures
+            for instrument_group in texture.instrument_groups
+        ]
+        jobs = write_score_files(folder_name, groups) + find_jobs(folder_name)
+        results = compiler.compile(jobs)
+        self.encode_stats["compile_seconds"] = {
+            result.job.name: result.seconds for result in results
+        }
 
-        print("\x1b[2K\rLilyPond encoding finished.")
+        return results
 
     def seconds_to_measures(self, seconds):
         """
@@ -1693,31 +3621,24 @@ class Piece:
 
     def add_texture(self, texture):
         self.textures.append(texture)
+        self.texture_registry.add(texture)
 
     def remove_player_from_top(self):
         """
         Remove one player from the active texture with the highest pitch,
         determined by highest pitch in texture.pitches.
         """
-        raise Exception("Piece.remove_player_from_top not implemented yet.")
+        highest_pitch_texture = self.texture_registry.highest_texture()
+
+        if highest_pitch_texture is not None:
+            highest_pitch_texture.remove_player()
 
     def remove_player_from_bottom(self):
         """
         Remove one player from the active texture with the lowest pitch,
         determined by lowest pitch in texture.pitches.
         """
-        lowest_pitch_texture = None
-
-        for texture in self.textures:
-            if (
-                texture.density > 0 and
-                texture.max_playing > 0
-            ):
-                if (
-                    lowest_pitch_texture is None or
-                    min(texture.pitches) < min(lowest_pitch_texture.pitches)
-                ):
-                    lowest_pitch_texture = texture
+        lowest_pitch_texture = self.texture_registry.lowest_texture()
 
         if lowest_pitch_texture is not None:
             lowest_pitch_texture.remove_player()
@@ -1729,3 +3650,15 @@ class Piece:
             num_instruments += texture.get_num_instruments()
 
         return num_instruments
+
+    def get_instruments(self):
+        """
+        Get all instruments performing in this piece, in the order of the
+        textures and instrument groups.
+        """
+        return [
+            instrument
+            for texture in self.textures
+            for instrument_group in texture.instrument_groups
+            for instrument in instrument_group.instruments
+        ]
@@ -0,0 +1,314 @@
+"""
+Keeps a piece loaded and regenerates its LilyPond files whenever its spec
+file changes, so edits can be heard and seen without starting over.
+
+The timeline of the spec is split into units that can be simulated on their
+own: one per texture, unless the piece has events that choose between
+textures (remove_player_from_top and remove_player_from_bottom), which put
+all textures in one unit. When the spec changes, only the units whose
+timeline changed are simulated again. A unit is simulated in sections, and
+the state of its piece at the start of every section is kept with the
+encoded measures of the section, so when only events change, the unit
+continues from the last section that started before the first changed event
+instead of from the first measure. Files whose content did not change are
+not written again (see OutputManifest).
+
+Usage:
+    python main.py piece.toml --watch
+
+    GenerationDaemon("piece.toml", "output").run()
+"""
+
+import json
+import os
+import sys
+import time
+
+from sections import (
+    encode_batch,
+    get_first_open_measure,
+    remove_closed_measures,
+    stitch_batches,
+    write_files,
+)
+from spec import build_events, build_piece, load_timeline
+
+
+# Piece actions whose effect depends on all textures of the piece.
+COUPLING_ACTIONS = {"remove_player_from_top", "remove_player_from_bottom"}
+
+
+def split_timeline(timeline):
+    """
+    Split a timeline into the timelines of units that can be simulated
+    independently.
+
+    @returns:   A list of timelines.
+    """
+    for event in timeline["events"]:
+        if event["texture"] is None and event["action"] in COUPLING_ACTIONS:
+            return [timeline]
+
+    units = []
+
+    for i, texture in enumerate(timeline["textures"]):
+        unit = dict(timeline)
+        unit["groups"] = [timeline["groups"][j] for j in texture["groups"]]
+        unit["textures"] = [dict(texture, groups=list(range(len(texture["groups"]))))]
+        # Events of the piece, such as add_note_event, act on every texture.
+        unit["events"] = [
+            dict(event, texture=None if event["texture"] is None else 0)
+            for event in timeline["events"]
+            if event["texture"] in (i, None)
+        ]
+        units.append(unit)
+
+    return units
+
+
+def get_static_key(timeline):
+    """
+    Get a key of everything in a timeline except its events, which identifies
+    a unit across changes to the spec.
+    """
+    return json.dumps(
+        {key: value for key, value in timeline.items() if key != "events"},
+        sort_keys=True
+    )
+
+
+def get_first_changed_time(old_events, new_events):
+    """
+    Get the earliest time of an event that was added, removed or changed, as
+    a piece time (from 0, see MusicEvent), or None if the events are the
+    same. Events are sorted by time.
+    """
+    for old_event, new_event in zip(old_events, new_events):
+        if old_event != new_event:
+            return min(old_event["measure"], new_event["measure"]) - 1
+
+    if len(old_events) == len(new_events):
+        return None
+
+    num_common_events = min(len(old_events), len(new_events))
+
+    return max(old_events, new_events, key=len)[num_common_events]["measure"] - 1
+
+
+class GeneratedUnit:
+    """
+    The generated measures of a unit, as one EncodedBatch per section, and a
+    fork of its piece at the start of every section.
+    """
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.static_key = get_static_key(timeline)
+        self.checkpoints = []
+        self.batches = []
+        self.resume_time = 0  # The time the last generation started at.
+
+
+def generate_unit(timeline, previous=None, section_length=16):
+    """
+    Simulate and encode a unit, continuing from the previous generation of
+    the same unit where its events did not change.
+
+    @param previous:    The GeneratedUnit of the previous version of the
+                        unit's timeline, or None.
+    @returns:           A GeneratedUnit, which is previous itself if the
+                        timeline did not change.
+    """
+    unit = GeneratedUnit(timeline)
+    piece = None
+
+    if previous is not None and previous.static_key == unit.static_key:
+        change_time = get_first_changed_time(
+            previous.timeline["events"],
+            timeline["events"]
+        )
+
+        if change_time is None:
+            return previous
+
+        # Continue from the last section that started before the changed
+        # event, with the new events that have not happened yet.
+        index = len(previous.checkpoints) - 1
+
+        while index > 0 and previous.checkpoints[index].time > change_time:
+            index -= 1
+
+        if index > 0:
+            checkpoint = previous.checkpoints[index]
+            unit.checkpoints = previous.checkpoints[:index]
+            unit.batches = previous.batches[:index]
+            piece = checkpoint.fork()
+            piece.events = [
+                event
+                for event in build_events(timeline, piece)
+                if event.time >= checkpoint.time
+            ]
+
+    if piece is None:
+        piece = build_piece(timeline)
+
+    unit.resume_time = piece.time
+
+    while piece.time < piece.num_measures:
+        unit.checkpoints.append(piece.fork())
+        piece.start(min(int(piece.time) + section_length, piece.num_measures))
+
+        if piece.time >= piece.num_measures:
+            end_index = piece.num_measures
+        else:
+            end_index = get_first_open_measure(piece)
+
+        batch = remove_closed_measures(piece, end_index, len(unit.batches))
+        unit.batches.append(encode_batch(batch))
+
+    return unit
+
+
+class RegenerationReport:
+    """
+    What one regeneration did and how long it took.
+    """
+    def __init__(self):
+        self.num_textures = 0
+        self.num_regenerated_textures = 0
+        self.first_regenerated_measure = None
+        self.files_written = 0
+        self.files_unchanged = 0
+        self.seconds = 0
+
+    def print_summary(self):
+        if self.num_regenerated_textures == 0:
+            regenerated = "nothing changed"
+        else:
+            regenerated = (
+                f"regenerated {self.num_regenerated_textures} of "
+                f"{self.num_textures} textures from measure "
+                f"{int(self.first_regenerated_measure) + 1}"
+            )
+
+        print(
+            f"{time.strftime('%H:%M:%S')} {regenerated} in {self.seconds:.2f}s, "
+            f"{self.files_written} files written, "
+            f"{self.files_unchanged} unchanged."
+        )
+
+
+class GenerationDaemon:
+    """
+    Watches a spec file and regenerates the output folder when it changes.
+
+    @param num_measures:    Optionally, overrides the number of measures in
+                            the spec.
+    @param section_length:  The number of measures between the states kept to
+                            continue from.
+    @param poll_interval:   The number of seconds between checks of the spec
+                            file.
+    """
+    def __init__(
+            self,
+            spec_path,
+            folder_name,
+            num_measures=None,
+            remove_trailing_empty_measures=False,
+            section_length=16,
+            poll_interval=0.25,
+            compress_repeats=False
+        ):
+        self.spec_path = spec_path
+        self.folder_name = folder_name
+        self.num_measures = num_measures
+        self.remove_trailing_empty_measures = remove_trailing_empty_measures
+        self.section_length = section_length
+        self.poll_interval = poll_interval
+        self.compress_repeats = compress_repeats
+        self.units = []
+        self.filenames = set()  # The files written by the last regeneration.
+
+    def regenerate(self):
+        """
+        Load the spec and regenerate the units whose timeline changed since
+        the previous regeneration. If anything fails, the previous units are
+        kept.
+
+        @returns:   A RegenerationReport.
+        """
+        start_time = time.perf_counter()
+        report = RegenerationReport()
+        timeline = load_timeline(self.spec_path, use_cache=False)
+
+        if self.num_measures is not None:
+            timeline["num_measures"] = self.num_measures
+
+        previous_units = {unit.static_key: unit for unit in self.units}
+        units = []
+
+        for unit_timeline in split_timeline(timeline):
+            previous = previous_units.pop(get_static_key(unit_timeline), None)
+            unit = generate_unit(unit_timeline, previous, self.section_length)
+            num_textures = len(unit_timeline["textures"])
+            report.num_textures += num_textures
+
+            if unit is not previous:
+                report.num_regenerated_textures += num_textures
+
+                if (
+                    report.first_regenerated_measure is None or
+                    unit.resume_time < report.first_regenerated_measure
+                ):
+                    report.first_regenerated_measure = unit.resume_time
+
+            units.append(unit)
+
+        contents = stitch_batches(
+            [batch for unit in units for batch in unit.batches],
+            self.remove_trailing_empty_measures,
+            self.compress_repeats
+        )
+        manifest = write_files(self.folder_name, contents)
+
+        # Remove the files of instruments that were removed from the spec.
+        for filename in self.filenames - contents.keys():
+            try:
+                os.remove(f"{self.folder_name}/{filename}")
+            except OSError:
+                pass
+
+        self.units = units
+        self.filenames = set(contents)
+        report.files_written = manifest.files_written
+        report.files_unchanged = manifest.files_unchanged
+        report.seconds = time.perf_counter() - start_time
+
+        return report
+
+    def get_spec_stat(self):
+        try:
+            stat = os.stat(self.spec_path)
+        except OSError:
+            return None  # E.g. while an editor replaces the file.
+
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def run(self):
+        """
+        Regenerate whenever the spec file changes, until interrupted.
+        """
+        print(f"Watching {self.spec_path}, press Ctrl+C to stop.")
+        spec_stat = None
+
+        while True:
+            new_spec_stat = self.get_spec_stat()
+
+            if new_spec_stat is not None and new_spec_stat != spec_stat:
+                spec_stat = new_spec_stat
+
+                try:
+                    self.regenerate().print_summary()
+                except Exception as error:
+                    print(f"{self.spec_path}: {error}", file=sys.stderr)
+
+            time.sleep(self.poll_interval)
@@ -0,0 +1,317 @@
+"""
+Compiles the LilyPond files that include the generated parts (the full score
+and the individual parts) in parallel, and caches the resulting PDF and MIDI
+files by the content of the compiled file and everything it includes.
+
+The generated part files are not complete LilyPond files, so they are not
+compiled themselves. Instead, write_score_files writes a file with a \\score
+block for every part and one for the full score, which include them. Any other
+LilyPond file in the output folder containing a \\score or \\book block, such
+as a hand-written score, is compiled as well (see find_jobs).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+INCLUDE_PATTERN = re.compile(r'\\include\s+"([^"]+)"')
+TOP_LEVEL_PATTERN = re.compile(r'\\(score|book)\b')
+CACHE_FOLDER_NAME = ".compile_cache"
+SCORE_FOLDER_NAME = "scores"  # The subfolder of the written score files.
+FULL_SCORE_NAME = "full_score"
+LILYPOND_VERSION = "2.24.0"  # The first version with \\after.
+
+
+class CompilationJob:
+    """
+    One LilyPond file to be compiled, such as the full score or a part.
+    """
+    def __init__(self, ly_file, include_paths=()):
+        self.ly_file = Path(ly_file)
+        self.name = self.ly_file.stem
+        self.include_paths = [Path(path) for path in include_paths]
+
+    def __str__(self):
+        return f'[CompilationJob {self.name}]'
+
+    def find_include(self, name, including_file):
+        """
+        Find an included file the way LilyPond does: relative to the including
+        file, the compiled file or one of the include paths.
+        """
+        folders = [including_file.parent, self.ly_file.parent]
+        folders += self.include_paths
+
+        for folder in folders:
+            path = folder / name
+
+            if path.is_file():
+                return path
+
+        return None
+
+    def get_input_files(self):
+        """
+        Get the compiled file and all files it (indirectly) includes.
+
+        @returns:   A list of paths, starting with the compiled file.
+        """
+        input_files = []
+        to_visit = [self.ly_file]
+        visited = set()
+
+        while len(to_visit) != 0:
+            path = to_visit.pop()
+            resolved = path.resolve()
+
+            if resolved in visited:
+                continue
+
+            visited.add(resolved)
+            input_files.append(path)
+
+            for name in INCLUDE_PATTERN.findall(path.read_text()):
+                include = self.find_include(name, path)
+
+                if include is not None:
+                    to_visit.append(include)
+
+        return input_files
+
+    def get_hash(self, executable):
+        """
+        Hash the content of all input files, together with the executable
+        used to compile them.
+        """
+        job_hash = hashlib.sha256(executable.encode())
+
+        for path in self.get_input_files():
+            job_hash.update(os.path.relpath(path, self.ly_file.parent).encode())
+            job_hash.update(hashlib.sha256(path.read_bytes()).digest())
+
+        return job_hash.hexdigest()
+
+
+class CompilationResult:
+    def __init__(self, job, output_files, seconds, from_cache, error=None):
+        self.job = job
+        self.output_files = output_files
+        self.seconds = seconds
+        self.from_cache = from_cache
+        self.error = error
+
+    def __str__(self):
+        if self.error is not None:
+            return f'{self.job.name}: failed after {self.seconds:.2f}s'
+        elif self.from_cache:
+            return f'{self.job.name}: unchanged (cached)'
+
+        return f'{self.job.name}: compiled in {self.seconds:.2f}s'
+
+
+def get_staff(name, filename):
+    """
+    Get a staff with the music of a part file, included from the score
+    folder.
+    """
+    return (
+        f'\\new Staff \\with {{ instrumentName = "{name}" }} '
+        f'\\include "../{filename}"'
+    )
+
+
+def get_score(music, title=None):
+    """
+    Get the content of a LilyPond file with a \\score block of the given
+    music, which is engraved and written to MIDI.
+    """
+    header = "" if title is None else f'\\header {{ title = "{title}" }}\n'
+
+    return (
+        f'\\version "{LILYPOND_VERSION}"\n'
+        f"{header}"
+        f"\\score {{\n"
+        f"  {music}\n"
+        f"  \\layout {{ }}\n"
+        f"  \\midi {{ }}\n"
+        f"}}\n"
+    )
+
+
+def write_score_files(folder_name, groups, title=None):
+    """
+    Write a LilyPond file for every part and for the full score, which
+    include the part files written by Piece.encode_lilypond, to the scores
+    subfolder of folder_name. Files whose content did not change are not
+    written again.
+
+    @param groups:  A list of (group name, parts) tuples in score order, where
+                    parts is a list of (part name, part filename) tuples.
+    @param title:   Optionally, the title of the full score.
+    @returns:       A list of CompilationJobs: one per part, then the full
+                    score.
+    """
+    folder = Path(folder_name) / SCORE_FOLDER_NAME
+    folder.mkdir(exist_ok=True)
+    files = {}
+    group_staffs = []
+
+    for group_name, parts in groups:
+        staffs = []
+
+        for name, filename in parts:
+            staff = get_staff(name, filename)
+            files[Path(filename).stem] = get_score(staff)
+            staffs.append(staff)
+
+        group_staffs.append(
+            f'\\new StaffGroup \\with {{ instrumentName = "{group_name}" }} <<\n'
+            + "".join(f"      {staff}\n" for staff in staffs)
+            + "    >>"
+        )
+
+    full_score = "<<\n" + "".join(f"    {staff}\n" for staff in group_staffs) + "  >>"
+    files[FULL_SCORE_NAME] = get_score(full_score, title)
+    jobs = []
+
+    for name, content in files.items():
+        path = folder / f"{name}.ly"
+
+        if not path.is_file() or path.read_text() != content:
+            path.write_text(content)
+
+        jobs.append(CompilationJob(path))
+
+    return jobs
+
+
+def find_jobs(folder_name, include_paths=()):
+    """
+    Find all LilyPond files in the given folder (not its subfolders) that
+    contain a \\score or \\book block.
+
+    @returns:   A list of CompilationJobs, sorted by filename.
+    """
+    jobs = []
+
+    for path in sorted(Path(folder_name).glob("*.ly")):
+        if TOP_LEVEL_PATTERN.search(path.read_text()):
+            jobs.append(CompilationJob(path, include_paths))
+
+    return jobs
+
+
+def run_lilypond(executable, ly_file, include_paths, output_folder):
+    """
+    Run LilyPond on a single file, writing its output to output_folder.
+
+    @returns:   A tuple with LilyPond's return code and its output.
+    """
+    command = [executable]
+
+    for path in include_paths:
+        command += ["-I", str(path)]
+
+    command += ["-o", os.path.join(output_folder, Path(ly_file).stem)]
+    command.append(str(ly_file))
+    process = subprocess.run(
+        command,
+        cwd=Path(ly_file).parent,
+        capture_output=True,
+        text=True
+    )
+
+    return process.returncode, process.stdout + process.stderr
+
+
+class LilyPondCompiler:
+    """
+    Compiles CompilationJobs in parallel, with at most max_workers LilyPond
+    processes running at the same time. Results are cached in
+    <output folder>/.compile_cache, keyed by the hash of the job's input
+    files, so unchanged scores and parts are not compiled again.
+
+    Any executable that accepts LilyPond's -I and -o options can be used, e.g.
+    a stub script for testing without LilyPond installed.
+    """
+    def __init__(self, output_folder, max_workers=None, executable="lilypond"):
+        self.output_folder = Path(output_folder).resolve()
+        self.cache_folder = self.output_folder / CACHE_FOLDER_NAME
+        self.max_workers = max_workers or os.cpu_count()
+        self.executable = executable
+
+    def is_available(self):
+        return shutil.which(self.executable) is not None
+
+    def copy_outputs(self, source_folder, name):
+        output_files = []
+
+        for path in sorted(Path(source_folder).glob(name + ".*")):
+            destination = self.output_folder / path.name
+            shutil.copyfile(path, destination)
+            output_files.append(destination)
+
+        return output_files
+
+    def compile_job(self, job):
+        start_time = time.perf_counter()
+        job_hash = job.get_hash(self.executable)
+        cached_folder = self.cache_folder / job_hash
+
+        if cached_folder.is_dir():
+            output_files = self.copy_outputs(cached_folder, job.name)
+            return CompilationResult(job, output_files, 0, True)
+
+        temp_folder = tempfile.mkdtemp(dir=self.cache_folder)
+
+        try:
+            return_code, output = run_lilypond(
+                self.executable,
+                job.ly_file.resolve(),
+                [path.resolve() for path in job.include_paths],
+                temp_folder
+            )
+            seconds = time.perf_counter() - start_time
+
+            if return_code != 0:
+                return CompilationResult(job, [], seconds, False, output)
+
+            output_files = self.copy_outputs(temp_folder, job.name)
+
+            # Another run may have cached the same job in the meantime.
+            try:
+                os.rename(temp_folder, cached_folder)
+            except OSError:
+                pass
+
+            return CompilationResult(job, output_files, seconds, False)
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    def compile(self, jobs):
+        """
+        Compile the given jobs in parallel and report the time per job.
+
+        @returns:   A list of CompilationResults, in the order of the jobs.
+        """
+        self.output_folder.mkdir(exist_ok=True)
+        self.cache_folder.mkdir(exist_ok=True)
+        print(f"Compiling {len(jobs)} LilyPond files...")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.compile_job, jobs))
+
+        for result in results:
+            print(f"    {result}")
+
+            if result.error is not None:
+                print(result.error)
+
+        return results
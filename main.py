@@ -0,0 +1,192 @@
+"""
+Generates the LilyPond notation of a piece described by a spec file (see
+spec.py and example_spec.toml).
+
+Usage:
+    python main.py <spec> [num_measures] [--output FOLDER] [--jobs N]
+        [--headless] [--profile] [--compile] [--no-cache]
+        [--remove-trailing-empty-measures] [--compress-repeats] [--watch]
+        [--musicxml FILE] [--transition-log FILE]
+
+With --watch, the spec is watched and the output regenerated whenever it
+changes, see daemon.py. With --transition-log, the state transitions of the
+simulation are logged to a JSONL file, which query_transitions.py filters.
+"""
+
+import argparse
+import cProfile
+import pstats
+import sys
+import time
+
+import classes
+from daemon import GenerationDaemon
+from musicxml import export_musicxml
+from pipeline import generate_pipelined
+from spec import load_piece
+
+
+def generate(piece, args):
+    """
+    Simulate and encode the piece, and compile it if requested.
+
+    @returns:   A list of (phase, seconds) tuples.
+    """
+    timings = []
+    start_time = time.perf_counter()
+
+    if args.jobs > 1:
+        generate_pipelined(
+            piece,
+            args.output,
+            args.remove_trailing_empty_measures,
+            num_workers=args.jobs - 1,
+            compress_repeats=args.compress_repeats
+        )
+        timings.append(("simulate and encode", time.perf_counter() - start_time))
+    else:
+        piece.start()
+        timings.append(("simulate", time.perf_counter() - start_time))
+        start_time = time.perf_counter()
+        piece.encode_lilypond(
+            args.output,
+            args.remove_trailing_empty_measures,
+            compress_repeats=args.compress_repeats
+        )
+        timings.append(("encode", time.perf_counter() - start_time))
+
+    if args.musicxml is not None:
+        start_time = time.perf_counter()
+        export_musicxml(piece, args.musicxml)
+        timings.append(("export MusicXML", time.perf_counter() - start_time))
+
+    if args.compile:
+        start_time = time.perf_counter()
+        piece.compile_lilypond(args.output, max_workers=args.jobs)
+        timings.append(("compile", time.perf_counter() - start_time))
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the LilyPond notation of a piece from a spec file."
+    )
+    parser.add_argument("spec", help="A .toml or .json piece specification.")
+    parser.add_argument(
+        "num_measures",
+        nargs="?",
+        type=int,
+        help="Override the number of measures in the spec."
+    )
+    parser.add_argument("-o", "--output", default="output")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Processes to use. With more than one, encoding runs alongside "
+             "the simulation, and LilyPond files are compiled in parallel."
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Skip progress output and the delays that pace it."
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time of each phase and the slowest functions."
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the output with LilyPond."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Compile the spec even if a cached timeline exists."
+    )
+    parser.add_argument("--remove-trailing-empty-measures", action="store_true")
+    parser.add_argument(
+        "--compress-repeats",
+        action="store_true",
+        help="Write runs of repeated measures once, in \\repeat unfold blocks."
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and regenerate only what changed whenever the spec "
+             "changes."
+    )
+    parser.add_argument(
+        "--musicxml",
+        metavar="FILE",
+        help="Also export the instrument parts to a MusicXML file."
+    )
+    parser.add_argument(
+        "--transition-log",
+        metavar="FILE",
+        help="Log the state transitions of the simulation to a JSONL file."
+    )
+    args = parser.parse_args()
+
+    if args.musicxml is not None and (args.jobs > 1 or args.watch):
+        parser.error("--musicxml can not be combined with --jobs or --watch.")
+
+    if args.transition_log is not None and args.watch:
+        parser.error("--transition-log can not be combined with --watch.")
+
+    classes.HEADLESS = args.headless or args.watch
+
+    if args.watch:
+        daemon = GenerationDaemon(
+            args.spec,
+            args.output,
+            args.num_measures,
+            args.remove_trailing_empty_measures,
+            compress_repeats=args.compress_repeats
+        )
+
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+
+        return
+
+    profiler = cProfile.Profile() if args.profile else None
+    start_time = time.perf_counter()
+
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        piece = load_piece(args.spec, not args.no_cache)
+    except Exception as error:
+        print(f"{args.spec}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    timings = [("load spec", time.perf_counter() - start_time)]
+
+    if args.num_measures is not None:
+        piece.num_measures = args.num_measures
+
+    if args.transition_log is not None:
+        classes.TRANSITIONS.open(args.transition_log)
+
+    timings += generate(piece, args)
+    classes.TRANSITIONS.close()
+
+    if profiler is not None:
+        profiler.disable()
+
+        for phase, seconds in timings:
+            print(f"{phase}: {seconds:.3f}s")
+
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Records metrics of a running Piece on every timestep in NumPy arrays, to be
+plotted afterwards: the number of sounding players per InstrumentGroup, each
+Texture's dynamic and rest time, and each Instrument's dynamic.
+
+Usage:
+    piece.metrics_recorder = MetricsRecorder(piece, "metrics.npz")
+    piece.start()  # Saves metrics.npz when finished.
+
+Recording is cheap enough to leave on for production runs: a timestep only
+reads the instruments that started or stopped playing or are changing their
+dynamic, and copies one row of values into a preallocated array.
+"""
+
+from array import array
+
+import numpy as np
+
+from classes import TIMESTEP
+
+
+NAN = float("nan")
+
+
+class MetricsRecorder:
+    """
+    Keeps the values of the current timestep in a row with a column per value:
+    the time, whether each instrument is playing and its dynamic, and each
+    texture's dynamic and rest time. Every timestep, the row is updated and
+    copied into an array with a row for every remaining timestep of the
+    piece, which doubles in size if the piece is extended. Values that do not
+    exist (yet), such as the dynamic of an instrument that has not played,
+    are stored as NaN.
+
+    Instruments are only read when they change: Instrument.report_change
+    calls activate when an instrument starts or stops playing or starts a
+    dynamic change, which writes its values to the row, and the dynamics of
+    instruments that are changing are read every timestep until they stop
+    changing. Instruments holding a note or resting, and the idle players
+    that an aggregated InstrumentGroup simulates in buckets, are not read at
+    all.
+
+    Textures added while the piece is running, e.g. by
+    Line.split_instrument_groups, get new columns that are NaN before they
+    were added.
+    """
+    def __init__(self, piece, path):
+        self.piece = piece
+        self.path = path
+        self.num_rows = 0
+        self.groups = [
+            group
+            for texture in piece.textures
+            for group in texture.instrument_groups
+        ]
+        self.instruments = [
+            instrument
+            for group in self.groups
+            for instrument in group.instruments
+        ]
+        # Index of each group's first instrument, to sum per group.
+        self.group_starts = np.cumsum(
+            [0] + [len(group.instruments) for group in self.groups[:-1]]
+        )
+        self.textures = list(piece.textures)
+        # Instrument -> its playing column, followed by its dynamic column.
+        self.instrument_columns = {
+            instrument: 1 + 2 * i for i, instrument in enumerate(self.instruments)
+        }
+        # Instrument -> dynamic column, of the instruments whose dynamic is
+        # changing.
+        self.changing_instruments = {}
+        self.texture_start = 1 + 2 * len(self.instruments)
+        self.row = array("d", [NAN]) * (self.texture_start + 2 * len(self.textures))
+        # A NumPy view of the row, to copy it without converting each value.
+        self.texture_columns = []
+        self.add_texture_columns(self.textures)
+
+        # The piece may be running already.
+        for instrument in self.instruments:
+            self.activate(instrument)
+
+        num_timesteps = round((piece.num_measures - piece.time) / TIMESTEP)
+        self.set_rows(np.empty((max(num_timesteps, 1), len(self.row))))
+
+    def set_rows(self, rows):
+        """
+        Replace the array of rows, e.g. after adding columns or rows.
+        """
+        self.rows = rows
+        # A flat view of the rows, to copy the row into without converting
+        # each value.
+        self.flat_rows = memoryview(rows.reshape(-1))
+
+    def add_texture_columns(self, textures):
+        """
+        Remember the dynamic and rest time columns of new textures. Textures
+        without a rest time keep NaN in their rest time column.
+        """
+        column = self.texture_start + 2 * len(self.texture_columns)
+
+        for texture in textures:
+            self.texture_columns.append((
+                texture.dynamic,
+                texture if hasattr(texture, "rest_time") else None,
+                column
+            ))
+            column += 2
+
+    def activate(self, instrument):
+        """
+        Update the values of an instrument that started or stopped playing or
+        started a dynamic change, and read its dynamic on every timestep while
+        it is changing.
+        """
+        column = self.instrument_columns.get(instrument)
+
+        if column is None:
+            return
+
+        dynamic = instrument.dynamic
+        self.row[column] = instrument.is_playing
+
+        if dynamic is not None:
+            self.row[column + 1] = dynamic.value
+
+            if dynamic.is_changing:
+                self.changing_instruments[instrument] = column + 1
+
+    def add_textures(self):
+        """
+        Add columns for textures that were added to the piece since the last
+        timestep.
+        """
+        new_textures = self.piece.textures[len(self.textures):]
+        self.textures += new_textures
+        columns = np.full((len(self.rows), 2 * len(new_textures)), np.nan)
+        self.set_rows(np.hstack((self.rows, columns)))
+        self.row = self.row + array("d", [NAN]) * (2 * len(new_textures))
+        self.add_texture_columns(new_textures)
+
+    def record(self):
+        """
+        Record the current state of the piece.
+        """
+        if len(self.piece.textures) != len(self.textures):
+            self.add_textures()
+
+        row = self.row
+        row[0] = self.piece.time
+        stopped_changing = None
+
+        for instrument, column in self.changing_instruments.items():
+            dynamic = instrument.dynamic
+            row[column] = dynamic.value
+
+            if not dynamic.is_changing:
+                if stopped_changing is None:
+                    stopped_changing = []
+
+                stopped_changing.append(instrument)
+
+        if stopped_changing is not None:
+            for instrument in stopped_changing:
+                del self.changing_instruments[instrument]
+
+        for dynamic, texture, column in self.texture_columns:
+            row[column] = dynamic.value
+
+            if texture is not None:
+                row[column + 1] = texture.rest_time
+
+        if self.num_rows == len(self.rows):
+            self.set_rows(np.concatenate((self.rows, np.empty_like(self.rows))))
+
+        start = self.num_rows * len(row)
+        self.flat_rows[start:start + len(row)] = row
+        self.num_rows += 1
+
+    def get_arrays(self):
+        """
+        Get the recorded rows as one array per metric, together with the names
+        of the instrument groups, textures and instruments of each column.
+        Textures without a name are named by their column.
+
+        @returns:   A dictionary of NumPy arrays.
+        """
+        rows = self.rows[:self.num_rows]
+        playing = rows[:, 1:self.texture_start:2]
+        group_sounding = np.zeros((len(rows), len(self.groups)), np.int16)
+
+        if len(self.instruments) != 0:
+            group_sounding[:] = np.add.reduceat(playing, self.group_starts, axis=1)
+
+        return {
+            "time": rows[:, 0],
+            "group_names": np.array([group.name for group in self.groups]),
+            "group_sounding": group_sounding,
+            "texture_names": np.array([
+                getattr(texture, "name", None) or f"texture {i}"
+                for i, texture in enumerate(self.textures)
+            ]),
+            "texture_dynamics": rows[:, self.texture_start::2],
+            "texture_rest_times": rows[:, self.texture_start + 1::2],
+            "instrument_names": np.array([
+                instrument.name for instrument in self.instruments
+            ]),
+            "instrument_dynamics": rows[:, 2:self.texture_start:2],
+        }
+
+    def save(self):
+        """
+        Save all recorded rows to an .npz file (see get_arrays).
+        """
+        np.savez(self.path, **self.get_arrays())
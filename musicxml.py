@@ -0,0 +1,348 @@
+"""
+Exports the instrument parts of a generated piece to a MusicXML file, for
+notation software that does not read LilyPond.
+
+The notes are taken from the same LilyPondScore data that encode_lilypond
+uses: each measure is merged (see LilyPondMeasure.merge_notes) and its notes'
+pitches, durations, ties, dynamics and hairpins are converted. Events are
+placed where LilyPond would place them: events and events_before at the
+start of a note, delayed_events after their delay and end_events at three
+quarters of the note. Hairpins end at the next dynamic, hairpin or \\!, like
+in LilyPond.
+
+The file is written part by part and measure by measure with a small
+streaming writer, without building a document tree, so memory use does not
+grow with the size of the score.
+
+Usage:
+    piece.start()
+    export_musicxml(piece, "piece.musicxml")
+"""
+
+from copy import copy
+from xml.sax.saxutils import escape, quoteattr
+
+from classes import Pitch
+
+
+DIVISIONS = 8  # Per quarter note: the shortest delayed events are 32nds.
+# The MusicXML step and alteration of every note number, spelled like
+# Pitch.NOTE_NAMES.
+STEPS = [
+    ("C", 0), ("D", -1), ("D", 0), ("E", -1), ("E", 0), ("F", 0),
+    ("G", -1), ("G", 0), ("A", -1), ("A", 0), ("B", -1), ("B", 0),
+]
+NOTE_TYPES = {1: "whole", 2: "half", 4: "quarter", 8: "eighth", 16: "16th", 32: "32nd"}
+DYNAMICS = {
+    "ppp", "pp", "p", "mp", "mf", "f", "ff", "fff",
+    "fp", "sf", "sfz", "sfp", "fz", "rf", "rfz",
+}
+WEDGES = {"\\<": "crescendo", "\\>": "diminuendo"}
+# Events that only change how LilyPond draws or plays the notes.
+IGNORED_EVENT_PREFIXES = ("\\override", "\\revert", "\\set", "\\unset", "\\once")
+MARK_LETTERS = "ABCDEFGHJKLMNOPQRSTUVWXYZ"  # Without I, as in LilyPond.
+
+
+class XMLWriter:
+    """
+    Writes XML elements to a file as they are started and ended, with
+    indentation.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.open_tags = []
+
+    def write_attributes(self, attributes):
+        return "".join(
+            f" {name}={quoteattr(str(value))}" for name, value in attributes.items()
+        )
+
+    def start(self, tag, **attributes):
+        self.file.write(
+            f"{'  ' * len(self.open_tags)}<{tag}{self.write_attributes(attributes)}>\n"
+        )
+        self.open_tags.append(tag)
+
+    def end(self):
+        tag = self.open_tags.pop()
+        self.file.write(f"{'  ' * len(self.open_tags)}</{tag}>\n")
+
+    def element(self, tag, text=None, **attributes):
+        """
+        Write an element with only text, or an empty element if text is None.
+        """
+        indent = "  " * len(self.open_tags)
+
+        if text is None:
+            self.file.write(f"{indent}<{tag}{self.write_attributes(attributes)}/>\n")
+        else:
+            self.file.write(
+                f"{indent}<{tag}{self.write_attributes(attributes)}>"
+                f"{escape(str(text))}</{tag}>\n"
+            )
+
+
+def to_divisions(measures):
+    return round(measures * 4 * DIVISIONS)
+
+
+def get_mark_text(index):
+    return MARK_LETTERS[index % len(MARK_LETTERS)] * (index // len(MARK_LETTERS) + 1)
+
+
+def get_clef(measures):
+    """
+    Get the clef of a part: bass if its notes are below middle C on average.
+
+    @returns:   A (sign, line) tuple.
+    """
+    total = 0
+    count = 0
+
+    for measure in measures:
+        for note in measure.notes:
+            if not note.pitch.is_rest():
+                total += note.pitch.sort_key()
+                count += 1
+
+    if count != 0 and total / count < Pitch(Pitch.C, 5).sort_key():
+        return ("F", 4)
+
+    return ("G", 2)
+
+
+def get_note_events(note):
+    """
+    Get the events of a merged note that MusicXML shows as directions, with
+    their time in measures from the start of the note, in order.
+    """
+    events = [(0, event) for event in note.events_before]
+    events += [(0, event) for event in note.events if event != "~"]
+    events += [(delay.in_measures(), event) for delay, event in note.delayed_events]
+    events += [(note.duration * 0.75, event) for event in note.end_events]
+    events.sort(key=lambda event: event[0])
+
+    return events
+
+
+class PartWriter:
+    """
+    Writes the measures of one part, tracking the ties, hairpins and
+    rehearsal marks that continue from one measure to the next.
+    """
+    def __init__(self, writer, part_id):
+        self.writer = writer
+        self.part_id = part_id
+        self.is_tied = False
+        self.is_wedge_open = False
+        self.num_marks = 0
+
+    def write_direction(self, offset, placement, write_type):
+        self.writer.start("direction", placement=placement)
+        self.writer.start("direction-type")
+        write_type()
+        self.writer.end()
+
+        if offset != 0:
+            self.writer.element("offset", offset)
+
+        self.writer.end()
+
+    def write_wedge(self, offset, wedge_type):
+        self.write_direction(
+            offset,
+            "below",
+            lambda: self.writer.element("wedge", type=wedge_type)
+        )
+
+    def stop_wedge(self, offset):
+        if self.is_wedge_open:
+            self.write_wedge(offset, "stop")
+            self.is_wedge_open = False
+
+    def write_dynamics(self, name):
+        self.writer.start("dynamics")
+        self.writer.element(name)
+        self.writer.end()
+
+    def write_event(self, offset, event):
+        name = event[1:] if event.startswith("\\") else event
+
+        if name in DYNAMICS:
+            self.stop_wedge(offset)
+            self.write_direction(offset, "below", lambda: self.write_dynamics(name))
+        elif event in WEDGES:
+            self.stop_wedge(offset)
+            self.write_wedge(offset, WEDGES[event])
+            self.is_wedge_open = True
+        elif event == "\\!":
+            self.stop_wedge(offset)
+        elif event == "\\mark \\default":
+            text = get_mark_text(self.num_marks)
+            self.num_marks += 1
+            self.write_direction(
+                offset,
+                "above",
+                lambda: self.writer.element("rehearsal", text)
+            )
+        elif not event.startswith(IGNORED_EVENT_PREFIXES) and event.strip() != "":
+            self.write_direction(
+                offset,
+                "above",
+                lambda: self.writer.element("words", name)
+            )
+
+    def write_note(self, note, is_measure_rest):
+        for time, event in get_note_events(note):
+            self.write_event(to_divisions(time), event)
+
+        writer = self.writer
+        writer.start("note")
+
+        if note.pitch.is_rest():
+            if is_measure_rest:
+                writer.element("rest", measure="yes")
+            else:
+                writer.element("rest")
+        else:
+            step, alter = STEPS[note.pitch.note]
+            writer.start("pitch")
+            writer.element("step", step)
+
+            if alter != 0:
+                writer.element("alter", alter)
+
+            writer.element("octave", note.pitch.octave - 1)
+            writer.end()
+
+        writer.element("duration", to_divisions(note.duration))
+        is_tie_stop = self.is_tied and not note.pitch.is_rest()
+        is_tie_start = note.has_tie() and not note.pitch.is_rest()
+
+        if is_tie_stop:
+            writer.element("tie", type="stop")
+
+        if is_tie_start:
+            writer.element("tie", type="start")
+
+        writer.element("voice", 1)
+
+        if not is_measure_rest:
+            writer.element("type", NOTE_TYPES[round(1 / note.duration)])
+
+        if is_tie_stop or is_tie_start:
+            writer.start("notations")
+
+            if is_tie_stop:
+                writer.element("tied", type="stop")
+
+            if is_tie_start:
+                writer.element("tied", type="start")
+
+            writer.end()
+
+        writer.end()
+        self.is_tied = is_tie_start
+
+    def write_measure(self, measure, number, attributes=None, is_last=False):
+        """
+        Write a measure, merging the notes of a copy of it.
+
+        @param attributes:  Optionally, a function that writes the contents
+                            of the measure's attributes element.
+        @param is_last:     Whether this is the last measure of the part, at
+                            the end of which open hairpins end.
+        """
+        measure = copy(measure)
+        measure.merge_notes()
+        self.writer.start("measure", number=number)
+
+        if attributes is not None:
+            self.writer.start("attributes")
+            attributes()
+            self.writer.end()
+
+        is_measure_rest = (
+            len(measure.notes) == 1 and
+            measure.notes[0].pitch.is_rest() and
+            measure.notes[0].duration == 1
+        )
+
+        for note in measure.notes:
+            self.write_note(note, is_measure_rest)
+
+        if is_last:
+            self.stop_wedge(0)
+
+        self.writer.end()
+
+
+def write_part(writer, part_id, instrument, time_signature):
+    """
+    Write the part of an instrument.
+    """
+    measures = instrument.score.measures
+    clef_sign, clef_line = get_clef(measures)
+    part_writer = PartWriter(writer, part_id)
+
+    def write_attributes():
+        writer.element("divisions", DIVISIONS)
+        writer.start("time")
+        writer.element("beats", time_signature[0])
+        writer.element("beat-type", time_signature[1])
+        writer.end()
+        writer.start("clef")
+        writer.element("sign", clef_sign)
+        writer.element("line", clef_line)
+        writer.end()
+
+    writer.start("part", id=part_id)
+
+    for index, measure in enumerate(measures):
+        part_writer.write_measure(
+            measure,
+            instrument.score.first_measure + index + 1,
+            write_attributes if index == 0 else None,
+            index == len(measures) - 1
+        )
+
+    writer.end()
+
+
+def export_musicxml(piece, path, title=None):
+    """
+    Write the instrument parts of a piece, after it was simulated, to a
+    MusicXML (partwise) file.
+
+    @param title:   Optionally, the title of the piece.
+    """
+    instruments = piece.get_instruments()
+
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            '<!DOCTYPE score-partwise PUBLIC '
+            '"-//Recordare//DTD MusicXML 4.0 Partwise//EN" '
+            '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+        )
+        writer = XMLWriter(file)
+        writer.start("score-partwise", version="4.0")
+
+        if title is not None:
+            writer.start("work")
+            writer.element("work-title", title)
+            writer.end()
+
+        writer.start("part-list")
+
+        for i, instrument in enumerate(instruments):
+            writer.start("score-part", id=f"P{i + 1}")
+            writer.element("part-name", instrument.name)
+            writer.end()
+
+        writer.end()
+
+        for i, instrument in enumerate(instruments):
+            write_part(writer, f"P{i + 1}", instrument, piece.time_signature)
+
+        writer.end()
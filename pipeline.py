@@ -0,0 +1,160 @@
+"""
+Generates a piece while encoding it: the simulation runs in the main process
+and hands every batch of finished measures to a pool of encoding worker
+processes through a bounded queue. If the encoders fall behind, the queue
+fills up and the simulation waits for them, so at most max_queued_batches
+batches are held in memory. The output is byte for byte the same as
+piece.start() followed by piece.encode_lilypond().
+
+Only measures that can no longer change are handed to the encoders, see
+sections.get_first_open_measure. Like sections.generate_in_sections, this
+sends measures to the workers with pickle.
+
+Usage:
+    generate_pipelined(piece, "output")
+"""
+
+from multiprocessing import Process, Queue
+import os
+import time
+import traceback
+
+import classes
+from sections import (
+    encode_batch,
+    get_first_open_measure,
+    remove_closed_measures,
+    stitch_batches,
+    write_files,
+)
+
+
+def encode_batches(batches, results):
+    """
+    The worker process of an encoder: encode MeasureBatches until None is
+    received.
+    """
+    while True:
+        batch = batches.get()
+
+        if batch is None:
+            return
+
+        try:
+            results.put(encode_batch(batch))
+        except Exception:
+            results.put(traceback.format_exc())
+
+
+def generate_pipelined(
+        piece,
+        folder_name,
+        remove_trailing_empty_measures=False,
+        batch_size=8,
+        num_workers=None,
+        max_queued_batches=None,
+        use_manifest=True,
+        compress_repeats=False
+    ):
+    """
+    Simulate a piece from its current time to the end while encoding it, and
+    write the same files as piece.start() followed by
+    piece.encode_lilypond(folder_name, remove_trailing_empty_measures,
+    compress_repeats=compress_repeats). Encoded measures are removed from the
+    piece's scores.
+
+    @param batch_size:          The number of measures to simulate before
+                                handing the finished measures to the
+                                encoders.
+    @param num_workers:         The number of encoding processes. Defaults to
+                                the number of CPUs minus the one used for the
+                                simulation.
+    @param max_queued_batches:  The number of batches that may wait for an
+                                encoder before the simulation waits.
+                                Defaults to twice the number of workers.
+    @returns:                   A dictionary of statistics, also stored in
+                                piece.encode_stats.
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) - 1)
+
+    if max_queued_batches is None:
+        max_queued_batches = 2 * num_workers
+
+    start_time = time.perf_counter()
+    batches = Queue(max_queued_batches)
+    results = Queue()
+    workers = [
+        Process(target=encode_batches, args=(batches, results))
+        for _ in range(num_workers)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    num_batches = 0
+    simulate_seconds = 0
+    wait_seconds = 0
+
+    try:
+        while piece.time < piece.num_measures:
+            simulate_start_time = time.perf_counter()
+            piece.start(min(int(piece.time) + batch_size, piece.num_measures))
+
+            if piece.time >= piece.num_measures:
+                end_index = piece.num_measures
+            else:
+                end_index = get_first_open_measure(piece)
+
+            batch = remove_closed_measures(piece, end_index, num_batches)
+            simulate_seconds += time.perf_counter() - simulate_start_time
+
+            if end_index > batch.first_measure:
+                wait_start_time = time.perf_counter()
+                batches.put(batch)
+                wait_seconds += time.perf_counter() - wait_start_time
+                num_batches += 1
+    finally:
+        for _ in workers:
+            batches.put(None)
+
+    encoded_batches = []
+    errors = []
+
+    for _ in range(num_batches):
+        result = results.get()
+
+        if isinstance(result, str):
+            errors.append(result)
+        else:
+            encoded_batches.append(result)
+
+    for worker in workers:
+        worker.join()
+
+    if len(errors) != 0:
+        raise Exception(f"generate_pipelined: encoding failed:\n{errors[0]}")
+
+    encoded_batches.sort(key=lambda batch: batch.index)
+    contents = stitch_batches(
+        encoded_batches,
+        remove_trailing_empty_measures,
+        compress_repeats
+    )
+    write_files(folder_name, contents, use_manifest)
+    piece.encode_stats["pipeline"] = {
+        "batches": num_batches,
+        "simulate_seconds": simulate_seconds,
+        "encode_seconds": sum(batch.encode_seconds for batch in encoded_batches),
+        "wait_seconds": wait_seconds,
+        "total_seconds": time.perf_counter() - start_time,
+    }
+
+    if not classes.HEADLESS:
+        print(
+            f"Simulated in {simulate_seconds:.2f}s, waited {wait_seconds:.2f}s "
+            f"for {num_workers} encoders, "
+            f"{piece.encode_stats['pipeline']['total_seconds']:.2f}s in total."
+        )
+
+    return piece.encode_stats["pipeline"]
@@ -0,0 +1,200 @@
+"""
+Plays a piece live: an asyncio scheduler steps the piece at its tempo with
+Piece.ticks and sends note-on, note-off and expression messages to an output
+sink as they happen.
+
+Ticks are scheduled against the time playback started rather than the end of
+the previous tick, so delays in one tick do not add up. Every tick is
+computed ahead of its deadline; the compute time and how late each tick was
+sent are collected in a PlaybackReport.
+
+Usage:
+    engine = PlaybackEngine(piece, FileSink("messages.jsonl"))
+    asyncio.run(engine.run())
+    engine.report.print_summary()
+
+A sink is any object with a send(time, messages) method, which is called
+once per tick with the piece's time in measures and a list of message
+dictionaries, and an optional close() method.
+"""
+
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from classes import Dynamic, TIMESTEP
+
+
+def dynamic_to_midi(dynamic):
+    """
+    Convert a Dynamic value to a MIDI velocity or expression value (1-127).
+    """
+    return max(1, min(127, round(dynamic / Dynamic.FFF * 126) + 1))
+
+
+def delta_to_messages(delta):
+    """
+    Convert a TickDelta to note-on, note-off and expression messages, with
+    note numbers and values as in MIDI. Notes are stopped before new ones
+    start, so an instrument changing pitch never overlaps itself.
+    """
+    messages = []
+
+    for instrument, key in delta.stopped:
+        messages.append({"type": "note_off", "instrument": instrument.name, "note": key})
+
+    for instrument, key, dynamic in delta.started:
+        messages.append({
+            "type": "note_on",
+            "instrument": instrument.name,
+            "note": key,
+            "velocity": dynamic_to_midi(dynamic),
+        })
+
+    for instrument, dynamic in delta.dynamic_changes:
+        messages.append({
+            "type": "expression",
+            "instrument": instrument.name,
+            "value": dynamic_to_midi(dynamic),
+        })
+
+    return messages
+
+
+class FileSink:
+    """
+    Writes every tick with messages as a JSON line, with the piece's time and
+    the number of seconds since playback started.
+    """
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.start_time = None
+
+    def send(self, time_in_measures, messages):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+        if len(messages) == 0:
+            return
+
+        self.file.write(json.dumps({
+            "t": time_in_measures,
+            "s": round(time.perf_counter() - self.start_time, 6),
+            "messages": messages,
+        }) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class LoopbackSink:
+    """
+    Keeps all messages in memory as (time, message) tuples, e.g. for testing.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send(self, time_in_measures, messages):
+        for message in messages:
+            self.messages.append((time_in_measures, message))
+
+
+class PlaybackReport:
+    """
+    The timing of every tick of a playback, in seconds. compute_times holds
+    how long each tick took to simulate, and lateness how long after its
+    deadline it was sent (negative values are not possible, as ticks wait for
+    their deadline).
+    """
+    def __init__(self, tick_seconds):
+        self.tick_seconds = tick_seconds
+        self.compute_times = []
+        self.lateness = []
+
+    def get_num_missed_deadlines(self):
+        return int(np.count_nonzero(np.asarray(self.lateness) > 0.001))
+
+    def print_summary(self):
+        if len(self.compute_times) == 0:
+            print("No ticks played.")
+            return
+
+        compute_times = np.asarray(self.compute_times) * 1000
+        lateness = np.asarray(self.lateness) * 1000
+        print(
+            f"{len(compute_times)} ticks of {self.tick_seconds * 1000:.1f}ms: "
+            f"compute mean {compute_times.mean():.2f}ms, "
+            f"p99 {np.percentile(compute_times, 99):.2f}ms, "
+            f"max {compute_times.max():.2f}ms; "
+            f"{self.get_num_missed_deadlines()} late by more than 1ms "
+            f"(max {lateness.max():.2f}ms)."
+        )
+
+
+class PlaybackEngine:
+    """
+    Drives a piece in real time from Piece.tempo.
+
+    @param speed:   Play this many times faster than the tempo, e.g. to
+                    test a long piece quickly.
+    """
+    def __init__(self, piece, sink, speed=1):
+        self.piece = piece
+        self.sink = sink
+        self.tick_seconds = piece.measures_to_seconds(TIMESTEP) / speed
+        self.report = PlaybackReport(self.tick_seconds)
+        self.is_stopped = False
+
+    def stop(self):
+        """
+        Stop playback after the current tick, e.g. from another task.
+        """
+        self.is_stopped = True
+
+    async def run(self, num_measures=None):
+        """
+        Play the piece from its current time until num_measures, or the end
+        of the piece, or until stop is called. Notes that are still sounding
+        at the end are stopped.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        ticks = self.piece.ticks(num_measures)
+        tick_index = 0
+        sounding = {}  # Instrument name -> note.
+
+        try:
+            while not self.is_stopped:
+                # Compute the tick ahead of its deadline, then wait for it.
+                compute_start_time = loop.time()
+                delta = next(ticks, None)
+
+                if delta is None:
+                    break
+
+                messages = delta_to_messages(delta)
+                self.report.compute_times.append(loop.time() - compute_start_time)
+                deadline = start_time + tick_index * self.tick_seconds
+                await asyncio.sleep(max(0, deadline - loop.time()))
+                self.report.lateness.append(max(0, loop.time() - deadline))
+                self.sink.send(delta.time, messages)
+                tick_index += 1
+
+                for message in messages:
+                    if message["type"] == "note_on":
+                        sounding[message["instrument"]] = message["note"]
+                    elif message["type"] == "note_off":
+                        sounding.pop(message["instrument"], None)
+        finally:
+            ticks.close()
+            self.sink.send(self.piece.time, [
+                {"type": "note_off", "instrument": name, "note": note}
+                for name, note in sounding.items()
+            ])
+
+            if hasattr(self.sink, "close"):
+                self.sink.close()
+
+        return self.report
@@ -0,0 +1,328 @@
+"""
+Renders a quick audio preview of a generated piece to a WAV file, without
+LilyPond or a synthesizer. Every InstrumentGroup gets a simple timbre, played
+from a wavetable, and every instrument's pitch and dynamic are taken from the
+simulation.
+
+Instead of synthesizing every instrument separately, the instruments playing
+the same pitch with the same timbre are summed into one amplitude envelope
+per timestep first, so the cost of rendering depends on the number of
+distinct pitches sounding at once rather than the number of players. Audio is
+rendered and written in chunks of chunk_seconds, to bound memory.
+
+Usage:
+    render_piece(piece, "preview.wav")
+
+    python preview.py <saved score folder> <wav file> [--tempo BPM]
+        [--metrics METRICS.npz]
+"""
+
+import argparse
+import re
+import time
+import wave
+
+import numpy as np
+
+from binary_score import BinaryScore, FLAG_REST
+from classes import Dynamic
+from sounding_index import SoundingIndex
+
+
+TABLE_SIZE = 4096
+# Relative amplitudes of the harmonics of each timbre. InstrumentGroups are
+# assigned timbres in this order.
+TIMBRES = [
+    [1, 0.5, 0.33, 0.25, 0.2, 0.17, 0.14, 0.12],  # Brassy: all harmonics.
+    [1, 0, 0.33, 0, 0.2, 0, 0.14],  # Hollow: odd harmonics.
+    [1, 0.3, 0.1],  # Mellow.
+    [1, 0.7, 0.5, 0.4, 0.3, 0.2, 0.1],  # Bright.
+    [1],  # Pure sine.
+]
+DECIBELS_PER_DYNAMIC = 5  # fff is 0 dB, ppp is -35 dB.
+
+
+def make_wavetable(harmonics):
+    """
+    Get one period of a waveform with the given harmonic amplitudes,
+    normalized to a peak of 1.
+    """
+    phase = np.arange(TABLE_SIZE) * (2 * np.pi / TABLE_SIZE)
+    table = np.zeros(TABLE_SIZE)
+
+    for k, amplitude in enumerate(harmonics):
+        table += amplitude * np.sin((k + 1) * phase)
+
+    return table / np.abs(table).max()
+
+
+def dynamic_to_gain(dynamics):
+    """
+    Convert an array of Dynamic values to linear amplitudes.
+    """
+    return 10 ** ((dynamics - Dynamic.FFF) * DECIBELS_PER_DYNAMIC / 20)
+
+
+def key_to_frequency(key):
+    # Pitch keys equal MIDI note numbers: Pitch(Pitch.A, 5) is A4.
+    return 440 * 2 ** ((key - 69) / 12)
+
+
+def get_pitch_keys(binary_score, num_ticks):
+    """
+    Get the pitch key (see Pitch.sort_key) of every part on every timestep,
+    with -1 for rests.
+
+    @returns:   An array of shape (number of parts, num_ticks).
+    """
+    pitch_keys = np.full((binary_score.get_num_parts(), num_ticks), -1)
+
+    for part_index in range(binary_score.get_num_parts()):
+        first, end = binary_score.get_note_range(part_index)
+        note = np.asarray(binary_score.note[first:end], dtype=np.int64)
+        octave = np.asarray(binary_score.octave[first:end], dtype=np.int64)
+        rest = (np.asarray(binary_score.flags[first:end]) & FLAG_REST) != 0
+        keys = np.repeat(
+            np.where(rest, -1, octave * 12 + note),
+            np.asarray(binary_score.duration[first:end], dtype=np.int64)
+        )[:num_ticks]
+        pitch_keys[part_index, :len(keys)] = keys
+
+    return pitch_keys
+
+
+def get_marked_dynamics(binary_score, num_ticks):
+    """
+    Get every part's dynamic on every timestep from the dynamic marks in the
+    score, for when no recorded dynamics are available. Hairpins are ignored.
+
+    @returns:   An array of shape (number of parts, num_ticks).
+    """
+    index = SoundingIndex(binary_score)
+    dynamics = np.full((binary_score.get_num_parts(), num_ticks), float(Dynamic.MP))
+    ticks = np.arange(num_ticks)
+
+    for part_index in range(binary_score.get_num_parts()):
+        first = index.dynamic_part_starts[part_index]
+        last = index.dynamic_part_starts[part_index + 1]
+
+        if last == first:
+            continue
+
+        mark = np.searchsorted(index.dynamic_tick[first:last], ticks, side="right") - 1
+        values = index.dynamic_value[first:last][np.maximum(mark, 0)]
+        dynamics[part_index] = np.where(mark >= 0, values, Dynamic.MP)
+
+    return dynamics
+
+
+def get_default_timbres(part_names):
+    """
+    Assign a timbre to each part, giving parts with the same name apart from
+    their number (e.g. "Horn 1" and "Horn 2") the same timbre.
+    """
+    groups = {}
+
+    return [
+        groups.setdefault(re.sub(r"\s*\d+$", "", name), len(groups)) % len(TIMBRES)
+        for name in part_names
+    ]
+
+
+def render(
+        binary_score,
+        path,
+        tempo,
+        dynamics=None,
+        part_timbres=None,
+        sample_rate=22050,
+        chunk_seconds=10
+    ):
+    """
+    Render a BinaryScore to a mono 16-bit WAV file.
+
+    @param tempo:           The tempo in quarter notes per minute, in 4/4.
+    @param dynamics:        Optionally, every part's Dynamic value on every
+                            timestep, as an array of shape (number of parts,
+                            number of timesteps), with NaN where a part has no
+                            dynamic. Defaults to the dynamic marks in the
+                            score.
+    @param part_timbres:    Optionally, per part, an index in TIMBRES.
+    @returns:               The length of the audio in seconds.
+    """
+    num_parts = binary_score.get_num_parts()
+    num_ticks = 0
+
+    for part_index in range(num_parts):
+        first, end = binary_score.get_note_range(part_index)
+        num_ticks = max(
+            num_ticks,
+            int(np.asarray(binary_score.duration[first:end], dtype=np.int64).sum())
+        )
+
+    if part_timbres is None:
+        part_timbres = get_default_timbres(binary_score.part_names)
+
+    if dynamics is None:
+        dynamics = get_marked_dynamics(binary_score, num_ticks)
+
+    pitch_keys = get_pitch_keys(binary_score, num_ticks)
+    gains = np.zeros((num_parts, num_ticks))
+    num_dynamic_ticks = min(num_ticks, dynamics.shape[1])
+    gains[:, :num_dynamic_ticks] = np.nan_to_num(
+        dynamic_to_gain(np.asarray(dynamics, dtype=float)[:, :num_dynamic_ticks])
+    )
+    gains[pitch_keys < 0] = 0
+
+    # Sum the gains of all parts with the same pitch and timbre into one
+    # envelope per voice.
+    voice_ids = pitch_keys * len(TIMBRES) + np.asarray(part_timbres)[:, None]
+    voices, voice_index = np.unique(
+        np.where(pitch_keys >= 0, voice_ids, -1).ravel(),
+        return_inverse=True
+    )
+    voice_index = voice_index.reshape(pitch_keys.shape)
+    envelopes = np.zeros((len(voices), num_ticks))
+    np.add.at(
+        envelopes,
+        (voice_index, np.broadcast_to(np.arange(num_ticks), voice_index.shape)),
+        gains
+    )
+    keep = (voices >= 0) & (envelopes.max(axis=1, initial=0) > 0)
+    voices, envelopes = voices[keep], envelopes[keep]
+    wavetables = [make_wavetable(harmonics) for harmonics in TIMBRES]
+    frequencies = key_to_frequency(voices // len(TIMBRES))
+    # Scale so the loudest moment uses the full range without clipping.
+    peak = envelopes.sum(axis=0).max(initial=0)
+    scale = 32767 / peak if peak > 0 else 0
+
+    seconds_per_tick = binary_score.timestep * 4 * 60 / tempo
+    samples_per_tick = sample_rate * seconds_per_tick
+    # Envelopes are interpolated between the centers of the timesteps, which
+    # softens the start and end of every note.
+    tick_centers = np.arange(num_ticks) + 0.5
+    num_samples = int(round(num_ticks * samples_per_tick))
+    chunk_size = int(chunk_seconds * sample_rate)
+
+    with wave.open(str(path), "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+
+        for chunk_start in range(0, num_samples, chunk_size):
+            samples = np.arange(chunk_start, min(chunk_start + chunk_size, num_samples))
+            ticks = samples / samples_per_tick
+            first_tick = max(int(ticks[0]) - 1, 0)
+            end_tick = min(int(ticks[-1]) + 2, num_ticks)
+            chunk = np.zeros(len(samples))
+            active = np.flatnonzero(envelopes[:, first_tick:end_tick].max(axis=1) > 0)
+
+            for voice in active:
+                envelope = np.interp(
+                    ticks,
+                    tick_centers[first_tick:end_tick],
+                    envelopes[voice, first_tick:end_tick]
+                )
+                # Index the wavetable by the phase since the start of the
+                # piece, so voices stay continuous across chunks.
+                phase = (samples * (frequencies[voice] / sample_rate)) % 1
+                table = wavetables[voices[voice] % len(TIMBRES)]
+                chunk += table[(phase * TABLE_SIZE).astype(np.int64)] * envelope
+
+            file.writeframes((chunk * scale).astype("<i2").tobytes())
+
+    return num_samples / sample_rate
+
+
+def get_recorded_dynamics(instrument_names, times, instrument_dynamics, binary_score):
+    """
+    Arrange dynamics recorded by a MetricsRecorder by part and timestep.
+
+    @returns:   An array of shape (number of parts, number of timesteps), with
+                NaN where nothing was recorded.
+    """
+    ticks = np.rint(np.asarray(times) / binary_score.timestep).astype(np.int64)
+    num_ticks = int(ticks.max()) + 1 if len(ticks) != 0 else 0
+    dynamics = np.full((binary_score.get_num_parts(), num_ticks), np.nan)
+    columns = {name: i for i, name in enumerate(instrument_names)}
+
+    for part_index, name in enumerate(binary_score.part_names):
+        column = columns.get(name)
+
+        if column is not None:
+            dynamics[part_index, ticks] = instrument_dynamics[:, column]
+
+    return dynamics
+
+
+def render_piece(piece, path, sample_rate=22050, chunk_seconds=10):
+    """
+    Render a piece after generation, with one timbre per InstrumentGroup. If
+    the piece has a MetricsRecorder, its recorded dynamics are used,
+    including fades and hairpins; otherwise the dynamic marks in the score.
+    """
+    binary_score = BinaryScore.new_from_piece(piece)
+    part_timbres = []
+    groups = {}
+
+    for texture in piece.textures:
+        for instrument_group in texture.instrument_groups:
+            timbre = groups.setdefault(instrument_group, len(groups)) % len(TIMBRES)
+            part_timbres += [timbre] * instrument_group.get_num_instruments()
+
+    dynamics = None
+    recorder = piece.metrics_recorder
+
+    if recorder is not None:
+        metrics = recorder.get_arrays()
+        dynamics = get_recorded_dynamics(
+            metrics["instrument_names"],
+            metrics["time"],
+            metrics["instrument_dynamics"],
+            binary_score
+        )
+
+    return render(
+        binary_score,
+        path,
+        piece.tempo,
+        dynamics,
+        part_timbres,
+        sample_rate,
+        chunk_seconds
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render a saved score to a WAV file."
+    )
+    parser.add_argument("score")
+    parser.add_argument("wav")
+    parser.add_argument("--tempo", type=float, default=90)
+    parser.add_argument("--metrics", help="A .npz file from MetricsRecorder.")
+    parser.add_argument("--sample-rate", type=int, default=22050)
+    args = parser.parse_args()
+    binary_score = BinaryScore.load(args.score)
+    dynamics = None
+
+    if args.metrics is not None:
+        metrics = np.load(args.metrics)
+        dynamics = get_recorded_dynamics(
+            list(metrics["instrument_names"]),
+            metrics["time"],
+            metrics["instrument_dynamics"],
+            binary_score
+        )
+
+    start_time = time.perf_counter()
+    seconds = render(binary_score, args.wav, args.tempo, dynamics, sample_rate=args.sample_rate)
+    render_seconds = time.perf_counter() - start_time
+    print(
+        f"Rendered {seconds:.1f}s of audio in {render_seconds:.2f}s "
+        f"({seconds / render_seconds:.0f}x real time)."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Filter a transition log written by classes.TransitionLog by instrument,
+instrument group, transition or time range. The log is read line by line, so
+logs of any size can be queried without loading them into memory.
+
+Usage:
+    python query_transitions.py <log> [--instrument NAME] [--group NAME]
+        [--event NAME] [--start MEASURE] [--end MEASURE]
+
+Measures are counted from 1, like MusicEvent times.
+"""
+
+import argparse
+import json
+
+from classes import TIMESTEP
+
+
+def query(path, instrument=None, group=None, event=None, start=None, end=None):
+    """
+    Yield the records in the log that match all given filters.
+
+    @param instrument:  Only yield records of the instrument with this name.
+    @param group:       Only yield records of the instrument group with this
+                        name.
+    @param event:       Only yield records of this transition, e.g.
+                        "start_playing".
+    @param start:       Only yield records at or after this measure.
+    @param end:         Only yield records before this measure.
+    """
+    start_tick = None if start is None else round((start - 1) / TIMESTEP)
+    end_tick = None if end is None else round((end - 1) / TIMESTEP)
+    # Cheap substring checks, to skip parsing most lines that cannot match.
+    quick_checks = [
+        json.dumps(value)
+        for value in (instrument, group, event)
+        if value is not None
+    ]
+
+    with open(path) as file:
+        for line in file:
+            if not all(check in line for check in quick_checks):
+                continue
+
+            record = json.loads(line)
+
+            if (
+                instrument is not None and record.get("i") != instrument or
+                group is not None and record.get("g") != group or
+                event is not None and record["e"] != event
+            ):
+                continue
+
+            # Ticks are increasing, except for music events that were
+            # scheduled before the tick at which they were executed.
+            tick = record.get("t")
+
+            if start_tick is not None and (tick is None or tick < start_tick):
+                continue
+
+            if end_tick is not None and (tick is None or tick >= end_tick):
+                if record["e"] != "music_event":
+                    break
+
+                continue
+
+            yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter a transition log.")
+    parser.add_argument("log")
+    parser.add_argument("--instrument")
+    parser.add_argument("--group")
+    parser.add_argument("--event")
+    parser.add_argument("--start", type=float)
+    parser.add_argument("--end", type=float)
+    args = parser.parse_args()
+
+    for record in query(
+        args.log,
+        args.instrument,
+        args.group,
+        args.event,
+        args.start,
+        args.end
+    ):
+        print(json.dumps(record, separators=(",", ":")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Finds the measures that changed between two generations of a piece, saved
+with binary_score.save_piece. Encoding does not change the scores (see
+LilyPondMeasure.lilypond_encode), so saves made before and after encoding can
+be compared.
+
+Every measure is hashed from its notes and events, and the measure hashes of
+each part are combined into a hash tree. Parts whose roots are equal are
+skipped entirely, and within a changed part only subtrees that differ are
+visited, so identical ranges of measures are skipped in O(log n).
+
+Usage:
+    python score_diff.py <old folder> <new folder>
+"""
+
+import argparse
+import hashlib
+import time
+
+import numpy as np
+
+from binary_score import BinaryScore
+
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MISSING = np.uint64(0)  # Hash of a measure that does not exist in a part.
+
+
+def mix(x):
+    """
+    The splitmix64 finalizer: scrambles an array of 64-bit integers.
+    """
+    x = np.asarray(x, dtype=np.uint64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def ordered_sums(hashes, starts):
+    """
+    Combine consecutive runs of hashes into one hash per run, taking the
+    position within the run into account. Run i spans starts[i]:starts[i + 1].
+    Sums wrap around, so they are computed as differences of a cumulative sum.
+    """
+    position = np.arange(len(hashes), dtype=np.uint64)
+
+    if len(hashes) != 0:
+        run_of_hash = np.searchsorted(starts, np.arange(len(hashes)), side="right") - 1
+        position -= np.asarray(starts, dtype=np.uint64)[run_of_hash]
+
+    cumulative = np.concatenate((
+        np.zeros(1, dtype=np.uint64),
+        np.cumsum(mix(hashes + position * GOLDEN), dtype=np.uint64)
+    ))
+    starts = np.asarray(starts, dtype=np.int64)
+
+    return cumulative[starts[1:]] - cumulative[starts[:-1]]
+
+
+def measure_hashes(binary_score):
+    """
+    Hash every measure of every part, independent of the order of the string
+    table, so scores of different runs can be compared.
+
+    @returns:   An array with one hash per measure of all parts.
+    """
+    string_hashes = np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(string.encode(), digest_size=8).digest(),
+                "little"
+            )
+            for string in binary_score.strings
+        ] + [0],  # Index -1 is used for events without a delay.
+        dtype=np.uint64
+    )
+    event_delay = np.asarray(binary_score.event_delay, dtype=np.int64)
+    event_hashes = mix(
+        string_hashes[np.asarray(binary_score.event_string, dtype=np.int64)] ^
+        mix(np.asarray(binary_score.event_kind, dtype=np.uint64) + np.uint64(1)) ^
+        (mix(string_hashes[event_delay]) * GOLDEN)
+    )
+    note_event_hashes = ordered_sums(event_hashes, binary_score.note_event_starts)
+    num_notes = len(note_event_hashes)
+    note_hashes = mix(
+        mix(np.asarray(binary_score.note[:num_notes], dtype=np.int64).astype(np.uint64)) ^
+        mix(np.asarray(binary_score.octave[:num_notes], dtype=np.uint64) + np.uint64(100)) ^
+        mix(np.asarray(binary_score.duration[:num_notes], dtype=np.uint64) + np.uint64(200)) ^
+        note_event_hashes
+    )
+    # Add one, so no measure hashes to MISSING by accident.
+    hashes = ordered_sums(note_hashes, binary_score.measure_note_starts)
+    return hashes | np.uint64(1)
+
+
+class HashTree:
+    """
+    A binary hash tree over the measure hashes of one part. levels[0] holds
+    the measure hashes, and every next level combines pairs of the level
+    below, with the root as the only element of the last level.
+    """
+    def __init__(self, hashes):
+        self.levels = [np.asarray(hashes, dtype=np.uint64)]
+
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+
+            if len(level) % 2 == 1:
+                level = np.concatenate((level, [MISSING]))
+
+            self.levels.append(mix(level[0::2] ^ mix(level[1::2] + GOLDEN)))
+
+    def get_root(self):
+        return self.levels[-1][0] if len(self.levels[0]) != 0 else MISSING
+
+    def changed_measures(self, other):
+        """
+        Get the indices of the measures whose hashes differ from the other
+        tree's, which must have the same number of measures.
+        """
+        if self.get_root() == other.get_root():
+            return []
+
+        changed = []
+        to_visit = [(len(self.levels) - 1, 0)]
+
+        while len(to_visit) != 0:
+            level, index = to_visit.pop()
+
+            if level == 0:
+                changed.append(index)
+                continue
+
+            for child in (2 * index + 1, 2 * index):
+                if (
+                    child < len(self.levels[level - 1]) and
+                    self.levels[level - 1][child] != other.levels[level - 1][child]
+                ):
+                    to_visit.append((level - 1, child))
+
+        return sorted(changed)
+
+
+def part_trees(binary_score, num_measures=None):
+    """
+    Build a HashTree for every part, padded with MISSING measures to
+    num_measures measures if given.
+
+    @returns:   A dictionary from part name to HashTree.
+    """
+    hashes = measure_hashes(binary_score)
+    trees = {}
+
+    for part_index, name in enumerate(binary_score.part_names):
+        first, end = binary_score.get_measure_range(part_index)
+        part_hashes = hashes[first:end]
+
+        if num_measures is not None and len(part_hashes) < num_measures:
+            part_hashes = np.concatenate((
+                part_hashes,
+                np.full(num_measures - len(part_hashes), MISSING)
+            ))
+
+        trees[name] = HashTree(part_hashes)
+
+    return trees
+
+
+def get_num_measures(binary_score):
+    starts = np.asarray(binary_score.part_measure_starts)
+    return int(np.diff(starts).max()) if len(starts) > 1 else 0
+
+
+def diff(old_score, new_score):
+    """
+    Find the changed measures of every part in two BinaryScores. Parts that
+    only exist in one of the scores have all their measures changed.
+
+    @returns:   A dictionary from part name to a sorted list of changed
+                measure numbers (counted from 1). Unchanged parts are left out.
+    """
+    num_measures = max(get_num_measures(old_score), get_num_measures(new_score))
+    old_trees = part_trees(old_score, num_measures)
+    new_trees = part_trees(new_score, num_measures)
+    empty_tree = HashTree(np.full(num_measures, MISSING))
+    changes = {}
+
+    for name in list(old_trees) + [n for n in new_trees if n not in old_trees]:
+        old_tree = old_trees.get(name, empty_tree)
+        new_tree = new_trees.get(name, empty_tree)
+        changed = old_tree.changed_measures(new_tree)
+
+        if len(changed) != 0:
+            changes[name] = [index + 1 for index in changed]
+
+    return changes
+
+
+def to_ranges(measures):
+    """
+    Summarize a sorted list of measure numbers, e.g. [1, 2, 3, 7] as "1-3, 7".
+    """
+    ranges = []
+    start = measures[0]
+
+    for previous, measure in zip(measures, measures[1:] + [None]):
+        if measure == previous + 1:
+            continue
+
+        ranges.append(str(start) if start == previous else f'{start}-{previous}')
+        start = measure
+
+    return ", ".join(ranges)
+
+
+def print_diff(changes):
+    if len(changes) == 0:
+        print("No measures changed.")
+        return
+
+    for name, measures in changes.items():
+        print(f'{name}: {len(measures)} changed ({to_ranges(measures)})')
+
+    total = sum(len(measures) for measures in changes.values())
+    print(f'{total} measures changed in {len(changes)} parts.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the measures that changed between two saved scores."
+    )
+    parser.add_argument("old")
+    parser.add_argument("new")
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    changes = diff(BinaryScore.load(args.old), BinaryScore.load(args.new))
+    print_diff(changes)
+    print(f'Compared in {time.perf_counter() - start_time:.3f}s.')
+
+
+if __name__ == "__main__":
+    main()
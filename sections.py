@@ -0,0 +1,358 @@
+"""
+Generates a piece in sections, split at user-declared boundaries such as
+rehearsal marks, with one worker process per section. The first worker
+simulates the first section and hands the state of the piece at the boundary
+to the next worker as soon as it is reached, then encodes its section while
+the next worker simulates the next one. The encoded sections are stitched
+into the same files that Piece.encode_lilypond writes, byte for byte.
+
+Only measures that can no longer change are encoded by a worker: a dynamic
+change that is still going on at a boundary may remove its hairpin from the
+measure it started in, and the first notes of a section may add a tie or a
+dynamic to the last note before the boundary. Those measures are handed over
+with the state and encoded by a later worker.
+
+The piece is sent to the workers with pickle, so the actions of its events
+must be methods of objects in the piece, as in MusicEvent(10, line.add_player),
+or module-level functions; lambdas are not supported.
+
+Usage:
+    generate_in_sections(piece, [16, 32, 48], "output")
+"""
+
+from multiprocessing import Process, Queue
+from pathlib import Path
+import time
+import traceback
+
+import classes
+from classes import (
+    LilyPondMeasureCache,
+    LilyPondScore,
+    OutputManifest,
+    TRACER,
+    TRANSITIONS,
+    write_output_file,
+)
+
+
+class MeasureBatch:
+    """
+    Measures removed from the scores of a piece to be encoded elsewhere.
+    measures maps the path of each output file (relative to the output
+    folder) to a list of measures starting at index first_measure.
+    part_filenames are the paths of the instrument parts, which may have
+    trailing empty measures removed.
+    """
+    def __init__(self, index, first_measure):
+        self.index = index
+        self.first_measure = first_measure
+        self.measures = {}
+        self.part_filenames = []
+
+
+class EncodedBatch:
+    """
+    The encoded measures of a MeasureBatch, per output file, and for the
+    instrument parts which of those measures are empty.
+    """
+    def __init__(self, index, first_measure):
+        self.index = index
+        self.first_measure = first_measure
+        self.measures = {}
+        self.empty_measures = {}
+        self.simulate_seconds = 0
+        self.encode_seconds = 0
+
+
+def get_first_open_measure(piece):
+    """
+    Get the index of the first measure that may still change when the piece
+    continues from its current time, which must be at the start of a
+    measure.
+    """
+    first_open_measure = int(piece.time) - 1
+
+    for texture in piece.textures:
+        dynamics = [texture.dynamic] + [
+            instrument.dynamic
+            for instrument_group in texture.instrument_groups
+            for instrument in instrument_group.instruments
+        ]
+
+        for dynamic in dynamics:
+            if dynamic is not None and dynamic.change_start_time is not None:
+                first_open_measure = min(
+                    first_open_measure,
+                    int(dynamic.change_start_time)
+                )
+
+    return first_open_measure
+
+
+def remove_closed_measures(piece, index, batch_index=0):
+    """
+    Remove all measures before the given index from all scores in the piece.
+
+    @returns:   A MeasureBatch with the removed measures.
+    """
+    batch = None
+
+    for texture in piece.textures:
+        if batch is None:
+            batch = MeasureBatch(batch_index, texture.score.first_measure)
+
+        # All groups of a texture share its score.
+        texture_measures = texture.score.remove_measures_before(index)
+
+        for instrument_group in texture.instrument_groups:
+            batch.measures[instrument_group.get_lilypond_filename()] = (
+                texture_measures
+            )
+
+            for instrument in instrument_group.instruments:
+                filename = instrument.get_lilypond_filename()
+                batch.measures[filename] = (
+                    instrument.score.remove_measures_before(index)
+                )
+                batch.part_filenames.append(filename)
+
+    return batch
+
+
+def encode_batch(batch):
+    """
+    Encode the measures of a MeasureBatch.
+
+    @returns:   An EncodedBatch.
+    """
+    start_time = time.perf_counter()
+    encoded_batch = EncodedBatch(batch.index, batch.first_measure)
+    cache = LilyPondMeasureCache()
+    encoded_lists = {}
+
+    for filename in batch.part_filenames:
+        encoded_batch.empty_measures[filename] = [
+            measure.is_empty() for measure in batch.measures[filename]
+        ]
+
+    for filename, measures in batch.measures.items():
+        encoded = encoded_lists.get(id(measures))
+
+        if encoded is None:
+            encoded = [measure.lilypond_encode(cache) for measure in measures]
+            encoded_lists[id(measures)] = encoded
+
+        encoded_batch.measures[filename] = encoded
+
+    encoded_batch.encode_seconds = time.perf_counter() - start_time
+
+    return encoded_batch
+
+
+def run_section(index, end_time, states, next_states, results):
+    """
+    The worker process of one section: wait for the state of the piece at
+    the start of the section, simulate until end_time, hand the state over to
+    the next section's worker and encode the measures that can no longer
+    change. The last section (end_time None) encodes all remaining measures.
+    """
+    try:
+        piece = states.get()
+
+        # An earlier section failed.
+        if piece is None:
+            if next_states is not None:
+                next_states.put(None)
+
+            return
+
+        start_time = time.perf_counter()
+        first_measure = piece.textures[0].score.first_measure
+        piece.start(end_time)
+        TRACER.flush()
+        TRANSITIONS.flush()
+
+        if end_time is None:
+            end_index = piece.num_measures
+        else:
+            end_index = max(first_measure, get_first_open_measure(piece))
+
+        batch = remove_closed_measures(piece, end_index, index)
+
+        if next_states is not None:
+            next_states.put(piece)
+
+        simulate_seconds = time.perf_counter() - start_time
+        section = encode_batch(batch)
+        section.simulate_seconds = simulate_seconds
+        results.put(section)
+    except Exception:
+        if next_states is not None:
+            next_states.put(None)
+
+        results.put(traceback.format_exc())
+
+
+def stitch_batches(
+        batches,
+        remove_trailing_empty_measures=False,
+        compress_repeats=False
+    ):
+    """
+    Join the measures of EncodedBatches, sorted by index, into the contents
+    of the output files.
+
+    @returns:   A dictionary from path (relative to the output folder) to
+                file contents.
+    """
+    measures = {}
+    empty_measures = {}
+
+    for batch in batches:
+        for filename, batch_measures in batch.measures.items():
+            measures.setdefault(filename, []).extend(batch_measures)
+
+        for filename, batch_empty in batch.empty_measures.items():
+            empty_measures.setdefault(filename, []).extend(batch_empty)
+
+    # Remove as many trailing empty measures from every instrument part as
+    # all parts have in common, like Piece.remove_trailing_empty_measures.
+    num_trailing_empty_measures = 0
+
+    if remove_trailing_empty_measures and len(empty_measures) != 0:
+        num_trailing_empty_measures = min(
+            len(empty) - next(
+                (i + 1 for i in reversed(range(len(empty))) if not empty[i]),
+                0
+            )
+            for empty in empty_measures.values()
+        )
+
+        for filename in empty_measures:
+            end = len(measures[filename]) - num_trailing_empty_measures
+            measures[filename] = measures[filename][:end]
+
+    contents = {}
+
+    for filename, file_measures in measures.items():
+        contents[filename] = (
+            "{" +
+            LilyPondScore.join_measures(file_measures, 0, compress_repeats) +
+            "}\n"
+        )
+
+    return contents
+
+
+def write_files(folder_name, contents, use_manifest=True):
+    """
+    Write the output of stitch_batches to the given folder, like
+    Piece.encode_lilypond.
+
+    @returns:   The OutputManifest, with the number of files written and
+                unchanged, or None.
+    """
+    Path(folder_name).mkdir(exist_ok=True)
+    Path(folder_name + "/group_scores").mkdir(exist_ok=True)
+    manifest = OutputManifest(folder_name) if use_manifest else None
+
+    for filename, content in contents.items():
+        write_output_file(f'{folder_name}/{filename}', content, manifest)
+
+    if manifest is not None:
+        manifest.save()
+
+    return manifest
+
+
+def generate_in_sections(
+        piece,
+        boundaries,
+        folder_name,
+        remove_trailing_empty_measures=False,
+        use_manifest=True,
+        compress_repeats=False
+    ):
+    """
+    Simulate a piece from its start in sections, one worker process per
+    section, and write the same files as piece.start() followed by
+    piece.encode_lilypond(folder_name, remove_trailing_empty_measures,
+    compress_repeats=compress_repeats). The given piece itself is not changed.
+
+    @param boundaries:  The times in measures at which sections end, as
+                        whole numbers in increasing order.
+    @returns:           A list of the sections' EncodedBatches, without
+                        their measures, for their timing statistics.
+    """
+    if piece.metrics_recorder is not None:
+        raise Exception("generate_in_sections: metrics can not be recorded.")
+
+    for boundary in boundaries:
+        if boundary % 1 != 0 or not 0 < boundary < piece.num_measures:
+            raise Exception(f"generate_in_sections: invalid boundary {boundary}.")
+
+    if list(boundaries) != sorted(set(boundaries)):
+        raise Exception("generate_in_sections: boundaries must increase.")
+
+    end_times = list(boundaries) + [None]
+    states = [Queue() for _ in end_times]
+    results = Queue()
+    TRACER.flush()
+    TRANSITIONS.flush()
+    workers = [
+        Process(
+            target=run_section,
+            args=(
+                i,
+                end_time,
+                states[i],
+                states[i + 1] if i + 1 < len(end_times) else None,
+                results
+            )
+        )
+        for i, end_time in enumerate(end_times)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    states[0].put(piece)
+    sections = []
+    errors = []
+
+    for _ in workers:
+        result = results.get()
+
+        if isinstance(result, str):
+            errors.append(result)
+        else:
+            sections.append(result)
+
+    for worker in workers:
+        worker.join()
+
+    if len(errors) != 0:
+        raise Exception(f"generate_in_sections: a section failed:\n{errors[0]}")
+
+    sections.sort(key=lambda section: section.index)
+    contents = stitch_batches(
+        sections,
+        remove_trailing_empty_measures,
+        compress_repeats
+    )
+    write_files(folder_name, contents, use_manifest)
+
+    for section in sections:
+        if not classes.HEADLESS:
+            print(
+                f"Section {section.index + 1}: simulated in "
+                f"{section.simulate_seconds:.2f}s, encoded "
+                f"{len(next(iter(section.measures.values()), []))} measures in "
+                f"{section.encode_seconds:.2f}s."
+            )
+
+        section.measures = {}
+        section.empty_measures = {}
+
+    return sections
@@ -0,0 +1,536 @@
+"""
+A batch generation service: a small HTTP server, listening on localhost only,
+that accepts piece specs (see spec.py), generates them on a bounded pool of
+worker processes and serves the LilyPond output as a zip file.
+
+Identical submissions are generated once. Results are stored in a cache
+folder by the hash of the compiled timeline and the options, so specs that
+only differ in formatting or comments share a result, and a spec that is
+submitted while an identical one is queued or running joins that job. The
+least recently used results are removed when the cache grows beyond its
+size limit. Finished, failed and cancelled jobs are forgotten after an hour
+by default, though their results stay in the cache.
+
+Usage:
+    python service.py [--port 8765] [--workers 2] [--cache-size-mb 1024]
+                      [--job-ttl 3600]
+
+    curl --data-binary @piece.toml localhost:8765/jobs
+    curl localhost:8765/jobs/<id>
+    curl -o output.zip localhost:8765/jobs/<id>/output
+    curl -X DELETE localhost:8765/jobs/<id>
+
+POST /jobs takes the spec as the request body and the query parameters
+format (toml or json, by default json if the content type is
+application/json and toml otherwise), num_measures and
+remove_trailing_empty_measures (1 to enable). Specs larger than
+MAX_SPEC_BYTES are rejected.
+"""
+
+import argparse
+from collections import OrderedDict, deque
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from urllib.parse import parse_qs, urlparse
+import uuid
+import zipfile
+
+import classes
+from classes import OutputManifest
+from spec import TIMELINE_VERSION, build_piece, compile_spec, parse_spec
+
+MAX_SPEC_BYTES = 2**20  # The largest request body POST /jobs accepts.
+
+
+class ResultCache:
+    """
+    Zip files of generated output in a folder, named by their key. When the
+    total size exceeds max_bytes, the least recently used files are removed.
+    """
+    def __init__(self, folder_name, max_bytes):
+        self.folder = Path(folder_name)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sizes = OrderedDict()  # Key -> size, least recently used first.
+        self.total_bytes = 0
+        self.evictions = 0
+
+        # Use the modification times of an earlier run, which get() updates.
+        paths = sorted(self.folder.glob("*.zip"), key=lambda path: path.stat().st_mtime)
+
+        for path in paths:
+            self.sizes[path.stem] = path.stat().st_size
+            self.total_bytes += self.sizes[path.stem]
+
+    def get_path(self, key):
+        return self.folder / f"{key}.zip"
+
+    def get(self, key):
+        """
+        Get the path of the result with the given key, marking it as used, or
+        None if it is not cached.
+        """
+        with self.lock:
+            if key not in self.sizes:
+                return None
+
+            self.sizes.move_to_end(key)
+            path = self.get_path(key)
+
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+            return path
+
+    def put(self, key):
+        """
+        Add the result that was written to get_path(key), and remove the
+        least recently used other results while the cache is too large.
+        """
+        with self.lock:
+            size = self.get_path(key).stat().st_size
+            self.total_bytes += size - self.sizes.pop(key, 0)
+            self.sizes[key] = size
+
+            while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+                old_key, old_size = self.sizes.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+
+                try:
+                    os.remove(self.get_path(old_key))
+                except OSError:
+                    pass
+
+
+def get_result_key(timeline, remove_trailing_empty_measures):
+    """
+    Get the cache key of the output of a timeline.
+    """
+    return hashlib.sha256(json.dumps([
+        TIMELINE_VERSION,
+        OutputManifest.VERSION,
+        timeline,
+        remove_trailing_empty_measures,
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def generate_zip(timeline, remove_trailing_empty_measures, path, errors):
+    """
+    The worker process of a job: generate a timeline and write its LilyPond
+    files to a zip file at the given path. Puts None on the errors queue on
+    success, or the traceback.
+    """
+    sys.stdout = open(os.devnull, "w")
+    classes.HEADLESS = True
+
+    try:
+        piece = build_piece(timeline)
+        piece.start()
+
+        with tempfile.TemporaryDirectory() as folder_name:
+            piece.encode_lilypond(
+                folder_name,
+                remove_trailing_empty_measures,
+                use_manifest=False
+            )
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+
+            with zipfile.ZipFile(temporary_path, "w", zipfile.ZIP_DEFLATED) as file:
+                for file_path in sorted(Path(folder_name).rglob("*.ly")):
+                    file.write(file_path, file_path.relative_to(folder_name))
+
+            os.replace(temporary_path, path)
+
+        errors.put(None)
+    except Exception:
+        errors.put(traceback.format_exc())
+
+
+class Job:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, key, timeline, remove_trailing_empty_measures):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.timeline = timeline
+        self.remove_trailing_empty_measures = remove_trailing_empty_measures
+        self.status = Job.QUEUED
+        self.error = None
+        self.process = None
+        self.cached = False  # Whether the result came from the cache.
+        self.finish_time = None  # When the job was done, failed or cancelled.
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "key": self.key,
+            "cached": self.cached,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on at most num_workers processes at a time, in the order they
+    were submitted. Jobs that are done, failed or cancelled are removed from
+    jobs job_ttl seconds after they finished.
+    """
+    def __init__(self, cache, num_workers, job_ttl=3600):
+        self.cache = cache
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self.active_jobs = {}  # Key -> queued or running job.
+        self.finished_jobs = deque()  # In the order they finished.
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        # Worker processes are spawned rather than forked, as forking a
+        # process with server threads may copy locks that are held.
+        self.context = multiprocessing.get_context("spawn")
+
+        for _ in range(num_workers):
+            threading.Thread(target=self.run_jobs, daemon=True).start()
+
+    def submit(self, timeline, remove_trailing_empty_measures):
+        """
+        Submit a timeline, reusing a cached result or a queued or running job
+        with the same key.
+
+        @returns:   A Job.
+        """
+        key = get_result_key(timeline, remove_trailing_empty_measures)
+
+        with self.lock:
+            self.expire_jobs()
+            job = self.active_jobs.get(key)
+
+            if job is not None:
+                return job
+
+            job = Job(key, timeline, remove_trailing_empty_measures)
+            self.jobs[job.id] = job
+
+            if self.cache.get(key) is not None:
+                job.cached = True
+                self.finish(job, Job.DONE)
+                return job
+
+            self.active_jobs[key] = job
+
+        self.pending.put(job)
+
+        return job
+
+    def get(self, job_id):
+        """
+        Get the job with the given id, or None if it is unknown or expired.
+        """
+        with self.lock:
+            self.expire_jobs()
+            return self.jobs.get(job_id)
+
+    def get_statuses(self):
+        """
+        Count the jobs that have not expired by their status.
+        """
+        statuses = {}
+
+        with self.lock:
+            self.expire_jobs()
+
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+
+        return statuses
+
+    def finish(self, job, status):
+        """
+        Set the final status of a job and start its time to live. Must be
+        called with the lock held.
+        """
+        job.status = status
+        job.finish_time = time.monotonic()
+        self.finished_jobs.append(job)
+
+    def expire_jobs(self):
+        """
+        Remove the jobs that finished more than job_ttl seconds ago. Must be
+        called with the lock held.
+        """
+        expiry_time = time.monotonic() - self.job_ttl
+
+        while (
+            len(self.finished_jobs) != 0 and
+            self.finished_jobs[0].finish_time <= expiry_time
+        ):
+            self.jobs.pop(self.finished_jobs.popleft().id, None)
+
+    def cancel(self, job):
+        """
+        Cancel a queued or running job. Other submitters of the same spec
+        share the job, so it is cancelled for them too.
+        """
+        with self.lock:
+            if job.status == Job.QUEUED:
+                self.finish(job, Job.CANCELLED)
+                self.active_jobs.pop(job.key, None)
+            elif job.status == Job.RUNNING:
+                self.finish(job, Job.CANCELLED)
+                job.process.terminate()
+
+    def run_jobs(self):
+        while True:
+            job = self.pending.get()
+
+            with self.lock:
+                if job.status != Job.QUEUED:
+                    continue
+
+                errors = self.context.Queue()
+                job.status = Job.RUNNING
+                job.process = self.context.Process(
+                    target=generate_zip,
+                    args=(
+                        job.timeline,
+                        job.remove_trailing_empty_measures,
+                        self.cache.get_path(job.key),
+                        errors
+                    )
+                )
+
+                try:
+                    job.process.start()
+                except Exception as error:
+                    job.error = f"The worker could not be started: {error}"
+                    self.finish(job, Job.FAILED)
+                    self.active_jobs.pop(job.key, None)
+                    continue
+
+            job.process.join()
+
+            try:
+                error = errors.get(timeout=1)
+            except queue.Empty:
+                error = f"The worker exited with code {job.process.exitcode}."
+
+                # Remove the partial zip file of a cancelled or crashed worker.
+                Path(f"{self.cache.get_path(job.key)}.{job.process.pid}.tmp").unlink(
+                    missing_ok=True
+                )
+
+            with self.lock:
+                if job.status == Job.RUNNING:
+                    if error is None:
+                        self.cache.put(job.key)
+                        self.finish(job, Job.DONE)
+                    else:
+                        job.error = error
+                        self.finish(job, Job.FAILED)
+
+                self.active_jobs.pop(job.key, None)
+                job.timeline = None
+                job.process = None
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the service, see the module documentation. The
+    server has a job_queue attribute.
+    """
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, job_id):
+        job = self.server.job_queue.get(job_id)
+
+        if job is None:
+            self.send_json(404, {"error": f"Unknown job {job_id}."})
+
+        return job
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path != "/jobs":
+            self.send_json(404, {"error": "Not found."})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+
+        # The body is not read if it is rejected, so the connection can't be
+        # reused.
+        if length < 0:
+            self.close_connection = True
+            self.send_json(400, {"error": "Invalid Content-Length."})
+            return
+        elif length > MAX_SPEC_BYTES:
+            self.close_connection = True
+            self.send_json(
+                413,
+                {"error": f"The spec must be at most {MAX_SPEC_BYTES} bytes."}
+            )
+            return
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        content = self.rfile.read(length)
+        default_format = (
+            "json" if self.headers.get("Content-Type") == "application/json" else "toml"
+        )
+
+        try:
+            spec_format = query.get("format", default_format)
+
+            if spec_format not in ("toml", "json"):
+                raise Exception(f"Unknown format {spec_format!r}.")
+
+            timeline = compile_spec(parse_spec(f"spec.{spec_format}", content))
+
+            if "num_measures" in query:
+                timeline["num_measures"] = int(query["num_measures"])
+        except Exception as error:
+            self.send_json(400, {"error": str(error)})
+            return
+
+        job = self.server.job_queue.submit(
+            timeline,
+            query.get("remove_trailing_empty_measures") == "1"
+        )
+        self.send_json(200 if job.status == Job.DONE else 202, job.to_json())
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.get_job(parts[1])
+
+            if job is not None:
+                self.send_json(200, job.to_json())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "output":
+            job = self.get_job(parts[1])
+
+            if job is None:
+                return
+
+            if job.status != Job.DONE:
+                self.send_json(409, {**job.to_json(), "error": f"Job {job.id} is {job.status}."})
+                return
+
+            try:
+                body = self.server.job_queue.cache.get(job.key).read_bytes()
+            except (AttributeError, OSError):
+                self.send_json(410, {"error": "The output was removed from the cache."})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parts == ["status"]:
+            job_queue = self.server.job_queue
+
+            self.send_json(200, {
+                "jobs": job_queue.get_statuses(),
+                "cache_bytes": job_queue.cache.total_bytes,
+                "cache_results": len(job_queue.cache.sizes),
+                "cache_evictions": job_queue.cache.evictions,
+            })
+        else:
+            self.send_json(404, {"error": "Not found."})
+
+    def do_DELETE(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+
+        if len(parts) != 2 or parts[0] != "jobs":
+            self.send_json(404, {"error": "Not found."})
+            return
+
+        job = self.get_job(parts[1])
+
+        if job is not None:
+            self.server.job_queue.cancel(job)
+            self.send_json(200, job.to_json())
+
+
+def create_server(
+        port=8765,
+        num_workers=2,
+        cache_folder=".service_cache",
+        cache_bytes=2**30,
+        job_ttl=3600
+    ):
+    """
+    Create the service's server on localhost. Use port 0 to pick a free port,
+    which is then in server.server_address.
+
+    @param job_ttl: The number of seconds finished jobs are kept for.
+    @returns:       A ThreadingHTTPServer, to be run with serve_forever.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), ServiceHandler)
+    server.job_queue = JobQueue(
+        ResultCache(cache_folder, cache_bytes),
+        num_workers,
+        job_ttl
+    )
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve LilyPond generation of piece specs on localhost."
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--cache", default=".service_cache")
+    parser.add_argument("--cache-size-mb", type=float, default=1024)
+    parser.add_argument(
+        "--job-ttl",
+        type=float,
+        default=3600,
+        help="The number of seconds finished jobs are kept for."
+    )
+    args = parser.parse_args()
+    server = create_server(
+        args.port,
+        args.workers,
+        args.cache,
+        int(args.cache_size_mb * 2**20),
+        args.job_ttl
+    )
+    print(f"Listening on http://127.0.0.1:{server.server_address[1]}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
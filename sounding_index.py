@@ -0,0 +1,283 @@
+"""
+An index of which instruments are sounding when, built once from the scores
+of all instruments after generation, to check chord density and balance
+without walking every score measure by measure.
+
+Usage:
+    index = SoundingIndex.new_from_piece(piece)
+    index.at(12.5)              # Everything sounding in the middle of bar 13.
+    index.between(12, 16)       # Everything sounding in bars 13 to 16.
+    index.max_simultaneous_per_pitch()
+
+Times are given in measures since the start of the piece, so measure 1 starts
+at time 0.
+"""
+
+import numpy as np
+
+from binary_score import BinaryScore, EVENT_DELAYED, EVENT_END, FLAG_REST
+from classes import Dynamic, LilyPondDuration, Pitch
+
+
+DYNAMIC_VALUES = {
+    Dynamic.value_as_string(value): value
+    for value in range(Dynamic.PPP, Dynamic.FFF + 1)
+}
+
+
+class SoundingNote:
+    """
+    A pitch sounding in one part from start to end (in measures), possibly
+    spanning several tied notes. dynamic is the last dynamic the part reached
+    at the time of the query, or None if no dynamic was marked yet.
+    """
+    def __init__(self, part_name, pitch, start, end, dynamic):
+        self.part_name = part_name
+        self.pitch = pitch
+        self.start = start
+        self.end = end
+        self.dynamic = dynamic
+
+    def __str__(self):
+        dynamic = "" if self.dynamic is None else Dynamic.value_as_string(self.dynamic)
+        return f'[{self.part_name}: {self.pitch} {dynamic} {self.start}-{self.end}]'
+
+
+class SoundingIndex:
+    """
+    Stores every sounding interval (a run of notes of the same pitch in one
+    part, without rests) in sorted arrays.
+
+    The intervals are grouped into classes of similar length, where the
+    longest interval in a class is at most twice as long as the shortest one.
+    Within a class, the intervals are sorted by start time, so the intervals
+    overlapping a query can be found with binary search: those starting
+    between the query's start minus the class's longest length and the
+    query's end. Since intervals of one part never overlap, this answers
+    point and range queries in O(log n + k) for k results.
+    """
+    def __init__(self, binary_score):
+        self.timestep = binary_score.timestep
+        self.part_names = binary_score.part_names
+        self.build_intervals(binary_score)
+        self.build_dynamics(binary_score)
+
+    def new_from_piece(piece):
+        return SoundingIndex(BinaryScore.new_from_piece(piece))
+
+    def build_intervals(self, binary_score):
+        measure_note_starts = np.asarray(binary_score.measure_note_starts)
+        part_note_starts = measure_note_starts[
+            np.asarray(binary_score.part_measure_starts)
+        ]
+        num_notes = int(part_note_starts[-1])
+        part = np.repeat(
+            np.arange(len(self.part_names)),
+            np.diff(part_note_starts)
+        )
+        note = np.asarray(binary_score.note[:num_notes], dtype=np.int64)
+        octave = np.asarray(binary_score.octave[:num_notes], dtype=np.int64)
+        tick = np.asarray(binary_score.tick[:num_notes], dtype=np.int64)
+        duration = np.asarray(binary_score.duration[:num_notes], dtype=np.int64)
+        sounding = (np.asarray(binary_score.flags[:num_notes]) & FLAG_REST) == 0
+        pitch_key = np.where(sounding, octave * 12 + note, -1)
+        run_starts = np.flatnonzero(np.concatenate((
+            [num_notes != 0],
+            (pitch_key[1:] != pitch_key[:-1]) | (part[1:] != part[:-1])
+        )))
+        run_lengths = np.zeros(0, dtype=np.int64)
+
+        if num_notes != 0:
+            run_lengths = np.add.reduceat(duration, run_starts)
+
+        keep = sounding[run_starts]
+        run_starts = run_starts[keep]
+
+        self.part = part[run_starts]
+        self.pitch_key = pitch_key[run_starts]
+        self.start = tick[run_starts]
+        self.end = self.start + run_lengths[keep]
+
+        # Group into length classes and sort each class by start time.
+        length_class = np.floor(np.log2(self.end - self.start)).astype(np.int64)
+        order = np.lexsort((self.start, length_class))
+
+        for name in ("part", "pitch_key", "start", "end"):
+            setattr(self, name, getattr(self, name)[order])
+
+        length_class = length_class[order]
+        self.classes = []
+        boundaries = np.flatnonzero(np.diff(length_class)) + 1
+
+        for first, last in zip(
+            np.concatenate(([0], boundaries)),
+            np.concatenate((boundaries, [len(length_class)]))
+        ):
+            if last > first:
+                longest = int((self.end[first:last] - self.start[first:last]).max())
+                self.classes.append((int(first), int(last), longest))
+
+    def build_dynamics(self, binary_score):
+        """
+        Collect every static dynamic mark of every part with its time in
+        ticks, sorted by part and time.
+        """
+        parts, ticks, values = [], [], []
+        measure_note_starts = binary_score.measure_note_starts
+        part_measure_starts = binary_score.part_measure_starts
+        note_event_starts = np.asarray(binary_score.note_event_starts)
+
+        for part_index in range(len(self.part_names)):
+            first_note = measure_note_starts[part_measure_starts[part_index]]
+            end_note = measure_note_starts[part_measure_starts[part_index + 1]]
+            event_range = note_event_starts[first_note:end_note + 1]
+            notes_with_events = first_note + np.flatnonzero(np.diff(event_range))
+
+            for note_index in notes_with_events:
+                tick = int(binary_score.tick[note_index])
+                duration = int(binary_score.duration[note_index])
+
+                for kind, event, delay in binary_score.get_note_events(note_index):
+                    value = DYNAMIC_VALUES.get(event)
+
+                    if value is None:
+                        continue
+
+                    event_tick = tick
+
+                    if kind == EVENT_DELAYED:
+                        delay = LilyPondDuration(delay).in_measures()
+                        event_tick += delay / self.timestep
+                    elif kind == EVENT_END:
+                        # End events are placed at 3/4 of the note.
+                        event_tick += 0.75 * duration
+
+                    parts.append(part_index)
+                    ticks.append(event_tick)
+                    values.append(value)
+
+        order = np.lexsort((ticks, parts))
+        self.dynamic_part = np.asarray(parts, dtype=np.int64)[order]
+        self.dynamic_tick = np.asarray(ticks, dtype=float)[order]
+        self.dynamic_value = np.asarray(values, dtype=np.int64)[order]
+        self.dynamic_part_starts = np.searchsorted(
+            self.dynamic_part,
+            np.arange(len(self.part_names) + 1)
+        )
+
+    def get_dynamic(self, part_index, tick):
+        first = self.dynamic_part_starts[part_index]
+        last = self.dynamic_part_starts[part_index + 1]
+        index = np.searchsorted(self.dynamic_tick[first:last], tick, side="right")
+
+        return None if index == 0 else int(self.dynamic_value[first + index - 1])
+
+    def find_overlapping(self, start_tick, end_tick):
+        """
+        Get the indices of all intervals overlapping [start_tick, end_tick],
+        where a zero-length query range finds the intervals sounding at that
+        time.
+        """
+        indices = []
+
+        for first, last, longest in self.classes:
+            low = first + np.searchsorted(
+                self.start[first:last],
+                start_tick - longest,
+                side="right"
+            )
+            high = first + np.searchsorted(
+                self.start[first:last],
+                end_tick,
+                side="right" if end_tick == start_tick else "left"
+            )
+            candidates = np.arange(low, high)
+            indices.append(candidates[self.end[candidates] > start_tick])
+
+        if len(indices) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(indices)
+
+    def to_sounding_notes(self, indices, dynamic_tick):
+        notes = []
+
+        for i in indices:
+            part_index = int(self.part[i])
+            key = int(self.pitch_key[i])
+            notes.append(SoundingNote(
+                self.part_names[part_index],
+                Pitch.shared(key % 12, key // 12),
+                int(self.start[i]) * self.timestep,
+                int(self.end[i]) * self.timestep,
+                self.get_dynamic(
+                    part_index,
+                    max(dynamic_tick, int(self.start[i]))
+                )
+            ))
+
+        return notes
+
+    def at(self, time):
+        """
+        Get all notes sounding at the given time in measures.
+
+        @returns:   A list of SoundingNotes.
+        """
+        tick = time / self.timestep
+
+        return self.to_sounding_notes(self.find_overlapping(tick, tick), tick)
+
+    def between(self, start, end):
+        """
+        Get all notes sounding at any time from start up to end (both in
+        measures). Dynamics are given at the later of start and the note's
+        start.
+
+        @returns:   A list of SoundingNotes.
+        """
+        start_tick = start / self.timestep
+
+        return self.to_sounding_notes(
+            self.find_overlapping(start_tick, end / self.timestep),
+            start_tick
+        )
+
+    def count_at(self, time):
+        """
+        Count the notes sounding at the given time, without building them.
+        """
+        tick = time / self.timestep
+
+        return len(self.find_overlapping(tick, tick))
+
+    def max_simultaneous_per_pitch(self):
+        """
+        Get the maximum number of parts sounding the same pitch at the same
+        time, for every pitch that is played.
+
+        @returns:   A dictionary from (note, octave) to the maximum number of
+                    simultaneous players.
+        """
+        if len(self.start) == 0:
+            return {}
+
+        # Sweep over start (+1) and end (-1) points per pitch. Ends sort before
+        # starts at the same time, as the intervals are half-open. Since every
+        # pitch's changes add up to zero, one running sum covers all pitches.
+        keys = np.concatenate((self.pitch_key, self.pitch_key))
+        times = np.concatenate((self.start, self.end))
+        changes = np.concatenate((
+            np.ones(len(self.start), dtype=np.int64),
+            -np.ones(len(self.end), dtype=np.int64)
+        ))
+        order = np.lexsort((changes, times, keys))
+        keys = keys[order]
+        playing = np.cumsum(changes[order])
+        group_starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        maxima = np.maximum.reduceat(playing, group_starts)
+
+        return {
+            (int(key) % 12, int(key) // 12): int(maximum)
+            for key, maximum in zip(keys[group_starts], maxima)
+        }
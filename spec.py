@@ -0,0 +1,453 @@
+"""
+Declarative piece specifications: a TOML or JSON file describing the tempo,
+instrument groups, Line textures and event timeline of a piece, which is
+compiled into Piece, Line and MusicEvent objects. See example_spec.toml.
+
+A spec is first compiled into a timeline: plain data that is validated and
+normalized, with dynamics as numbers, pitches as [note, octave] pairs and
+events sorted by time. Compiled timelines are cached in a .spec_cache folder
+next to the spec, keyed by the hash of the spec file, so repeated runs of an
+unchanged spec skip parsing and validation.
+
+Usage:
+    piece = load_piece("piece.toml")
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: only JSON specs are supported.
+    tomllib = None
+
+from classes import (
+    Dynamic,
+    InstrumentGroup,
+    Line,
+    MusicEvent,
+    Piece,
+    Pitch,
+    write_file_atomically,
+)
+
+
+# Increase whenever the format of compiled timelines changes, so cached
+# timelines of older versions are not used.
+TIMELINE_VERSION = 4
+CACHE_FOLDER = ".spec_cache"
+DYNAMICS = {
+    "ppp": Dynamic.PPP,
+    "pp": Dynamic.PP,
+    "p": Dynamic.P,
+    "mp": Dynamic.MP,
+    "mf": Dynamic.MF,
+    "f": Dynamic.F,
+    "ff": Dynamic.FF,
+    "fff": Dynamic.FFF,
+}
+
+
+def compile_dynamic(value, where):
+    if isinstance(value, str) and value in DYNAMICS:
+        return DYNAMICS[value]
+    elif isinstance(value, int) and Dynamic.PPP <= value <= Dynamic.FFF:
+        return value
+
+    raise Exception(f"{where}: invalid dynamic {value!r}.")
+
+
+def compile_pitch(value, where):
+    """
+    Compile a pitch in LilyPond notation, such as "c''", or a [note, octave]
+    pair, to a [note, octave] pair.
+    """
+    if isinstance(value, str):
+        try:
+            pitch = Pitch.new_from_lilypond_notation(value)
+        except Exception:
+            raise Exception(f"{where}: invalid pitch {value!r}.")
+
+        return [pitch.note, pitch.octave]
+    elif (
+        isinstance(value, list) and
+        len(value) == 2 and
+        all(isinstance(x, int) for x in value) and
+        0 <= value[0] <= 11
+    ):
+        return value
+
+    raise Exception(f"{where}: invalid pitch {value!r}.")
+
+
+def compile_pitches(value, where):
+    if not isinstance(value, list):
+        raise Exception(f"{where}: expected a list of pitches.")
+
+    return [compile_pitch(pitch, f"{where}[{i}]") for i, pitch in enumerate(value)]
+
+
+def compile_number(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise Exception(f"{where}: expected a number, got {value!r}.")
+
+    return value
+
+
+def compile_count(value, where):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise Exception(f"{where}: expected a whole number, got {value!r}.")
+
+    return value
+
+
+def compile_flag(value, where):
+    if not isinstance(value, bool):
+        raise Exception(f"{where}: expected true or false, got {value!r}.")
+
+    return value
+
+
+def compile_string(value, where):
+    if not isinstance(value, str):
+        raise Exception(f"{where}: expected a string, got {value!r}.")
+
+    return value
+
+
+def compile_strings(value, where):
+    if not isinstance(value, list):
+        raise Exception(f"{where}: expected a list of strings.")
+
+    return [compile_string(x, f"{where}[{i}]") for i, x in enumerate(value)]
+
+
+def compile_range(value, where):
+    if not isinstance(value, list) or len(value) != 2:
+        raise Exception(f"{where}: expected a [low, high] pair.")
+
+    return [compile_number(x, where) for x in value]
+
+
+def compile_time_signature(value, where):
+    if not isinstance(value, list) or len(value) != 2:
+        raise Exception(f"{where}: expected [beats, beat unit].")
+
+    return [compile_count(x, where) for x in value]
+
+
+# The actions events can perform, with the compile function of each of their
+# arguments. Texture actions are methods of Line, piece actions methods of
+# Piece.
+TEXTURE_ACTIONS = {
+    "add_player": [],
+    "remove_player": [],
+    "stop": [],
+    "set_density": [compile_count],
+    "set_max_playing": [compile_count],
+    "set_rest_time": [compile_number],
+    "set_fade_time": [compile_number],
+    "set_rest_time_jitter": [compile_number],
+    "link_rest_time_to_dynamic": [compile_range],
+    "set_pitches": [compile_pitches],
+    "add_pitch": [compile_pitch],
+    "add_note_event": [compile_string],
+    "add_event_after_rest": [compile_string],
+    # Start a dynamic change of the texture: target dynamic, time in measures.
+    "change_dynamic": [compile_dynamic, compile_number],
+}
+PIECE_ACTIONS = {
+    "remove_player_from_top": [],
+    "remove_player_from_bottom": [],
+    "add_note_event": [compile_string],
+    "add_event_after_rest": [compile_string],
+}
+
+
+def get_field(table, name, where, compile_function, default=None):
+    """
+    Get and compile a field of a table in the spec. Fields without a default
+    are required.
+    """
+    if name not in table:
+        if default is None:
+            raise Exception(f"{where}: missing field {name!r}.")
+
+        return default
+
+    return compile_function(table[name], f"{where}.{name}")
+
+
+def compile_spec(spec):
+    """
+    Validate a parsed spec and compile it into a timeline.
+
+    @param spec:    The contents of a spec file as a dictionary.
+    @returns:       The timeline as a dictionary of plain data.
+    """
+    timeline = {
+        "version": TIMELINE_VERSION,
+        "tempo": get_field(spec, "tempo", "spec", compile_number),
+        "time_signature": get_field(
+            spec,
+            "time_signature",
+            "spec",
+            compile_time_signature,
+            [4, 4]
+        ),
+        "num_measures": get_field(spec, "num_measures", "spec", compile_count),
+        # Optionally, the seed of the random variation of textures.
+        "seed": None if "seed" not in spec else compile_count(spec["seed"], "spec.seed"),
+        "groups": [],
+        "textures": [],
+        "events": [],
+    }
+    group_indices = {}
+
+    for key, group in spec.get("groups", {}).items():
+        where = f"groups.{key}"
+        pitch_range = None
+
+        if "pitch_range" in group:
+            pitch_range = compile_pitches(group["pitch_range"], f"{where}.pitch_range")
+
+        group_indices[key] = len(timeline["groups"])
+        timeline["groups"].append({
+            "name": get_field(group, "name", where, compile_string, key),
+            "instrument": get_field(group, "instrument", where, compile_string),
+            "pitch_range": pitch_range,
+            "max_note_length": get_field(
+                group, "max_note_length", where, compile_number, 1.5
+            ),
+            "size": get_field(group, "size", where, compile_count),
+            "number_start": get_field(group, "number_start", where, compile_count, 1),
+            "aggregate": get_field(group, "aggregate", where, compile_flag, False),
+        })
+
+    texture_indices = {}
+    used_groups = set()
+
+    for i, texture in enumerate(spec.get("textures", [])):
+        where = f"textures[{i}]"
+        key = get_field(texture, "name", where, compile_string, str(i))
+        texture_type = get_field(texture, "type", where, compile_string, "line")
+
+        if texture_type != "line":
+            raise Exception(f"{where}: unknown texture type {texture_type!r}.")
+
+        if key in texture_indices:
+            raise Exception(f"{where}: duplicate texture name {key!r}.")
+
+        groups = []
+
+        for group_key in get_field(texture, "groups", where, compile_strings):
+            if group_key not in group_indices:
+                raise Exception(f"{where}: unknown group {group_key!r}.")
+            elif group_key in used_groups:
+                raise Exception(f"{where}: group {group_key!r} is already used.")
+
+            used_groups.add(group_key)
+            groups.append(group_indices[group_key])
+
+        if len(groups) == 0:
+            raise Exception(f"{where}: a texture needs at least one group.")
+
+        texture_indices[key] = i
+        timeline["textures"].append({
+            "name": key,
+            "type": texture_type,
+            "pitches": get_field(texture, "pitches", where, compile_pitches),
+            "dynamic": get_field(texture, "dynamic", where, compile_dynamic),
+            "groups": groups,
+            "max_playing": get_field(texture, "max_playing", where, compile_count, 1),
+            "density": get_field(texture, "density", where, compile_count, 0),
+            "change_rate": get_field(texture, "change_rate", where, compile_number, 0),
+            "rest_time": get_field(texture, "rest_time", where, compile_number, 0.5),
+            "fade_time": get_field(texture, "fade_time", where, compile_number, 0.5),
+            "look_ahead": None if "look_ahead" not in texture else compile_number(
+                texture["look_ahead"], f"{where}.look_ahead"
+            ),
+            "rest_time_jitter": get_field(
+                texture, "rest_time_jitter", where, compile_number, 0
+            ),
+            "random_entry_order": get_field(
+                texture, "random_entry_order", where, compile_flag, False
+            ),
+            "random_pitches": get_field(
+                texture, "random_pitches", where, compile_flag, False
+            ),
+        })
+
+    for i, event in enumerate(spec.get("events", [])):
+        where = f"events[{i}]"
+        target = get_field(event, "texture", where, compile_string, "piece")
+        action = get_field(event, "action", where, compile_string)
+
+        if target == "piece":
+            actions = PIECE_ACTIONS
+            texture_index = None
+        elif target in texture_indices:
+            actions = TEXTURE_ACTIONS
+            texture_index = texture_indices[target]
+        else:
+            raise Exception(f"{where}: unknown texture {target!r}.")
+
+        if action not in actions:
+            raise Exception(f"{where}: unknown action {action!r} for {target}.")
+
+        args = event.get("args", [])
+
+        if not isinstance(args, list) or len(args) != len(actions[action]):
+            raise Exception(
+                f"{where}: {action} takes {len(actions[action])} arguments."
+            )
+
+        timeline["events"].append({
+            "measure": get_field(event, "measure", where, compile_number),
+            "texture": texture_index,
+            "action": action,
+            "args": [
+                compile_function(arg, f"{where}.args[{j}]")
+                for j, (compile_function, arg) in enumerate(zip(actions[action], args))
+            ],
+        })
+
+    # Sort stably, so events at the same time keep the order of the spec.
+    timeline["events"].sort(key=lambda event: event["measure"])
+
+    return timeline
+
+
+def parse_spec(path, content):
+    if Path(path).suffix == ".toml":
+        if tomllib is None:
+            raise Exception("TOML specs need Python 3.11 or newer.")
+
+        return tomllib.loads(content.decode())
+
+    return json.loads(content)
+
+
+def load_timeline(path, use_cache=True):
+    """
+    Get the compiled timeline of a spec file, from the cache if the spec did
+    not change since it was last compiled.
+    """
+    path = Path(path)
+    content = path.read_bytes()
+    key = hashlib.sha256(
+        content + f"\0{path.suffix}\0{TIMELINE_VERSION}".encode()
+    ).hexdigest()
+    cache_path = path.parent / CACHE_FOLDER / f"{key}.json"
+
+    if use_cache:
+        try:
+            with open(cache_path) as file:
+                timeline = json.load(file)
+
+            if timeline.get("version") == TIMELINE_VERSION:
+                return timeline
+        except (OSError, ValueError):
+            pass
+
+    timeline = compile_spec(parse_spec(path, content))
+
+    if use_cache:
+        cache_path.parent.mkdir(exist_ok=True)
+        write_file_atomically(str(cache_path), json.dumps(timeline))
+
+    return timeline
+
+
+def to_pitch(pair):
+    return Pitch(pair[0], pair[1])
+
+
+def build_piece(timeline):
+    """
+    Create a new Piece, with its textures and events, from a compiled
+    timeline.
+    """
+    groups = [
+        InstrumentGroup(
+            group["name"],
+            group["instrument"],
+            None if group["pitch_range"] is None else [
+                to_pitch(pitch) for pitch in group["pitch_range"]
+            ],
+            group["max_note_length"],
+            group["size"],
+            number_start=group["number_start"],
+            aggregate=group["aggregate"]
+        )
+        for group in timeline["groups"]
+    ]
+    textures = [
+        Line(
+            [to_pitch(pitch) for pitch in texture["pitches"]],
+            texture["dynamic"],
+            [groups[i] for i in texture["groups"]],
+            max_playing=texture["max_playing"],
+            change_rate=texture["change_rate"],
+            rest_time=texture["rest_time"],
+            fade_time=texture["fade_time"],
+            density=texture["density"],
+            look_ahead=texture["look_ahead"],
+            name=texture["name"],
+            seed=timeline["seed"],
+            rest_time_jitter=texture["rest_time_jitter"],
+            random_entry_order=texture["random_entry_order"],
+            random_pitches=texture["random_pitches"]
+        )
+        for texture in timeline["textures"]
+    ]
+    piece = Piece(
+        timeline["tempo"],
+        tuple(timeline["time_signature"]),
+        timeline["num_measures"],
+        [],
+        textures
+    )
+    piece.events = build_events(timeline, piece)
+
+    return piece
+
+
+def build_events(timeline, piece):
+    """
+    Create the MusicEvents of a timeline, acting on the textures of the given
+    piece, which must have been built from the same timeline.
+    """
+    events = []
+
+    for event in timeline["events"]:
+        action = event["action"]
+        args = list(event["args"])
+
+        if event["texture"] is None:
+            function = getattr(piece, action)
+        elif action == "change_dynamic":
+            function = piece.textures[event["texture"]].dynamic.start_change
+        else:
+            function = getattr(piece.textures[event["texture"]], action)
+
+        if action == "set_pitches":
+            args = [[to_pitch(pitch) for pitch in args[0]]]
+        elif action == "add_pitch":
+            args = [to_pitch(args[0])]
+        elif action == "link_rest_time_to_dynamic":
+            args = [tuple(args[0])]
+
+        events.append(
+            MusicEvent(event["measure"], function, args if len(args) != 0 else None)
+        )
+
+    return events
+
+
+def load_piece(path, use_cache=True):
+    """
+    Load a spec file and create its Piece.
+    """
+    return build_piece(load_timeline(path, use_cache))
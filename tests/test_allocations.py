@@ -0,0 +1,117 @@
+"""
+Checks that stepping a piece allocates a steady number of memory blocks per
+tick, i.e. that the retained allocations do not grow as the piece goes on,
+and that a tick retains little more than the notes it adds to the scores.
+"""
+
+import gc
+from pathlib import Path
+import sys
+import tracemalloc
+import unittest
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+from classes import TIMESTEP, Dynamic, InstrumentGroup, Line, Piece, Pitch
+
+WARM_UP_MEASURES = 4
+TICKS_PER_WINDOW = 64
+NUM_WINDOWS = 4
+# A new measure allocates a LilyPondMeasure and its list of notes per score.
+BLOCKS_PER_MEASURE = 2
+# Entries, exits and dynamic changes add events to the notes of the
+# instruments involved, which on average is well below one block per
+# instrument per tick.
+EVENT_BLOCKS_PER_INSTRUMENT = 1
+MAX_GROWTH_PER_TICK = 1
+
+
+def create_piece():
+    trumpets = InstrumentGroup("Trumpets", "Trumpet", None, 1.5, 4)
+    horns = InstrumentGroup("Horns", "Horn", None, 2, 3)
+    textures = [
+        Line(
+            [Pitch(Pitch.C, 5), Pitch(Pitch.G, 5)],
+            Dynamic.P,
+            [trumpets],
+            max_playing=2,
+            density=3
+        ),
+        Line(
+            [Pitch(Pitch.E, 4)],
+            Dynamic.MP,
+            [horns],
+            max_playing=2,
+            density=2,
+            rest_time=0.75
+        ),
+    ]
+
+    return Piece(90, (4, 4), 40, [], textures)
+
+
+def get_max_blocks_per_tick(piece):
+    """
+    Get the number of blocks a tick of the piece may retain: one note per
+    instrument and texture score, the measures they start and the events of
+    the instruments.
+    """
+    num_instruments = sum(
+        len(instrument_group.instruments)
+        for texture in piece.textures
+        for instrument_group in texture.instrument_groups
+    )
+    num_scores = num_instruments + len(piece.textures)
+
+    return (
+        num_scores * (1 + BLOCKS_PER_MEASURE * TIMESTEP) +
+        num_instruments * EVENT_BLOCKS_PER_INSTRUMENT
+    )
+
+
+def count_blocks():
+    """
+    @returns: The number of memory blocks currently traced by tracemalloc
+    """
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot()
+    return sum(statistic.count for statistic in snapshot.statistics("filename"))
+
+
+class TestAllocations(unittest.TestCase):
+    def setUp(self):
+        self.piece = create_piece()
+
+    def advance(self):
+        self.piece.step()
+        self.piece.time += TIMESTEP
+
+    def test_blocks_per_tick_stay_flat(self):
+        while self.piece.time < WARM_UP_MEASURES:
+            self.advance()
+
+        tracemalloc.start()
+        try:
+            blocks_per_tick = []
+            for _ in range(NUM_WINDOWS):
+                start_blocks = count_blocks()
+                for _ in range(TICKS_PER_WINDOW):
+                    self.advance()
+                blocks_per_tick.append(
+                    (count_blocks() - start_blocks) / TICKS_PER_WINDOW
+                )
+        finally:
+            tracemalloc.stop()
+
+        max_blocks_per_tick = get_max_blocks_per_tick(self.piece)
+
+        for blocks in blocks_per_tick:
+            self.assertLess(blocks, max_blocks_per_tick)
+        self.assertLess(
+            max(blocks_per_tick) - min(blocks_per_tick), MAX_GROWTH_PER_TICK
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+"""
+Checks LilyPondCompiler with a stub lilypond executable, so no LilyPond
+installation is needed.
+"""
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+from lilypond_compiler import (
+    CACHE_FOLDER_NAME,
+    FULL_SCORE_NAME,
+    LilyPondCompiler,
+    find_jobs,
+    write_score_files,
+)
+
+# Accepts LilyPond's -I and -o options, checks that the included files exist,
+# logs the name of every file it compiles and writes a fake PDF and MIDI
+# file. Files containing FAIL fail to compile.
+STUB = """#!{python}
+import pathlib, re, sys
+
+arguments = sys.argv[1:]
+include_paths = []
+while len(arguments) > 1:
+    if arguments[0] == "-o":
+        output = arguments[1]
+    elif arguments[0] == "-I":
+        include_paths.append(arguments[1])
+    arguments = arguments[2:]
+
+path = pathlib.Path(arguments[0])
+content = path.read_text()
+
+with open({log!r}, "a") as log:
+    log.write(path.stem + "\\n")
+
+if "FAIL" in content:
+    print("error: FAIL")
+    sys.exit(1)
+
+for name in re.findall(r'\\\\include "([^"]+)"', content):
+    if not (path.parent / name).is_file():
+        print("error: cannot find", name)
+        sys.exit(1)
+
+pathlib.Path(output + ".pdf").write_text(content)
+pathlib.Path(output + ".midi").write_text(content)
+"""
+
+PART = "{ c'1 }\n"
+HAND_WRITTEN_SCORE = '\\score { \\new Staff \\include "Horn1.ly" }\n'
+
+
+class TestLilyPondCompiler(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        folder = Path(self.folder.name)
+        self.log = folder / "calls.txt"
+        self.executable = folder / "lilypond"
+        self.executable.write_text(
+            STUB.format(python=sys.executable, log=str(self.log))
+        )
+        os.chmod(self.executable, 0o755)
+
+        self.output = folder / "output"
+        self.output.mkdir()
+
+        for name in ("Trumpet1", "Trumpet2", "Horn1"):
+            (self.output / f"{name}.ly").write_text(PART)
+
+        (self.output / "hand_written.ly").write_text(HAND_WRITTEN_SCORE)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def get_jobs(self):
+        groups = [
+            ("Trumpets", [
+                ("Trumpet 1", "Trumpet1.ly"),
+                ("Trumpet 2", "Trumpet2.ly"),
+            ]),
+            ("Horns", [("Horn 1", "Horn1.ly")]),
+        ]
+
+        return write_score_files(self.output, groups) + find_jobs(self.output)
+
+    def compile(self):
+        """
+        Compile all jobs and get the names of the jobs the stub was run for.
+        """
+        self.log.write_text("")
+        compiler = LilyPondCompiler(self.output, executable=str(self.executable))
+        self.results = {
+            result.job.name: result for result in compiler.compile(self.get_jobs())
+        }
+
+        return sorted(self.log.read_text().split())
+
+    def test_find_jobs(self):
+        names = [job.name for job in find_jobs(self.output)]
+
+        self.assertEqual(names, ["hand_written"])
+
+    def test_compile(self):
+        compiled = self.compile()
+
+        self.assertEqual(compiled, sorted([
+            "Trumpet1", "Trumpet2", "Horn1", FULL_SCORE_NAME, "hand_written"
+        ]))
+
+        for name, result in self.results.items():
+            self.assertIsNone(result.error)
+            self.assertFalse(result.from_cache)
+            self.assertEqual(
+                result.output_files,
+                [self.output / f"{name}.midi", self.output / f"{name}.pdf"]
+            )
+            self.assertTrue((self.output / f"{name}.pdf").is_file())
+
+    def test_second_run_uses_cache(self):
+        self.compile()
+        (self.output / f"{FULL_SCORE_NAME}.pdf").unlink()
+
+        self.assertEqual(self.compile(), [])
+
+        for result in self.results.values():
+            self.assertTrue(result.from_cache)
+
+        # Cached outputs are copied to the output folder again.
+        self.assertTrue((self.output / f"{FULL_SCORE_NAME}.pdf").is_file())
+
+    def test_edited_file_is_recompiled(self):
+        self.compile()
+        (self.output / "Horn1.ly").write_text("{ d'1 }\n")
+
+        # Only the files that include the edited part are compiled again.
+        self.assertEqual(
+            self.compile(),
+            sorted(["Horn1", FULL_SCORE_NAME, "hand_written"])
+        )
+        self.assertTrue(self.results["Trumpet1"].from_cache)
+        self.assertFalse(self.results["Horn1"].from_cache)
+
+    def test_failed_job(self):
+        (self.output / "hand_written.ly").write_text(
+            "\\score { FAIL }\n" + HAND_WRITTEN_SCORE
+        )
+        compiled = self.compile()
+
+        self.assertIn("hand_written", compiled)
+        self.assertIn("error: FAIL", self.results["hand_written"].error)
+        self.assertEqual(self.results["hand_written"].output_files, [])
+        self.assertIsNone(self.results["Trumpet1"].error)
+
+        # Failures are not cached, and the temporary folders are removed.
+        self.assertEqual(self.compile(), ["hand_written"])
+        self.assertEqual(
+            len(list((self.output / CACHE_FOLDER_NAME).iterdir())), 4
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
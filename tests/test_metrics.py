@@ -0,0 +1,164 @@
+"""
+Checks that MetricsRecorder records the same values as reading every
+instrument and texture on every timestep, and that recording adds less than
+10% to the time it takes to generate a piece.
+"""
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+import classes
+from classes import (
+    TIMESTEP,
+    Dynamic,
+    InstrumentGroup,
+    Line,
+    MusicEvent,
+    Piece,
+    Pitch
+)
+from metrics import MetricsRecorder
+
+NUM_MEASURES = 40
+BENCHMARK_MEASURES = 200
+BENCHMARK_RUNS = 3
+MAX_OVERHEAD = 0.1
+
+
+def create_piece(num_measures):
+    trumpets = InstrumentGroup("Trumpets", "Trumpet", None, 1.5, 4)
+    horns = InstrumentGroup("Horns", "Horn", None, 2, 12, aggregate=True)
+    high = Line(
+        [Pitch(Pitch.C, 5), Pitch(Pitch.G, 5)],
+        Dynamic.P,
+        [trumpets],
+        max_playing=2,
+        density=3,
+        name="high"
+    )
+    low = Line(
+        [Pitch(Pitch.E, 4)],
+        Dynamic.MP,
+        [horns],
+        max_playing=3,
+        density=2,
+        name="low"
+    )
+    low.link_rest_time_to_dynamic((0.25, 1))
+    events = [
+        MusicEvent(5, high.dynamic.start_change, (Dynamic.F, 4)),
+        MusicEvent(12, low.dynamic.start_change, (Dynamic.PP, 6)),
+        MusicEvent(20, high.dynamic.start_change, (Dynamic.PPP, 0)),
+    ]
+
+    return Piece(90, (4, 4), num_measures, events, [high, low])
+
+
+def read_row(piece, instruments):
+    """
+    Read the values MetricsRecorder records directly from the piece.
+    """
+    def get_dynamic(instrument):
+        return np.nan if instrument.dynamic is None else instrument.dynamic.value
+
+    return (
+        piece.time,
+        [instrument.is_playing for instrument in instruments],
+        [get_dynamic(instrument) for instrument in instruments],
+        [texture.dynamic.value for texture in piece.textures],
+        [texture.rest_time for texture in piece.textures],
+    )
+
+
+class TestMetricsRecorder(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "metrics.npz")
+        self.previous_headless = classes.HEADLESS
+        classes.HEADLESS = True
+
+    def tearDown(self):
+        classes.HEADLESS = self.previous_headless
+        self.folder.cleanup()
+
+    def test_recorded_values(self):
+        piece = create_piece(NUM_MEASURES)
+        recorder = MetricsRecorder(piece, self.path)
+        piece.metrics_recorder = recorder
+        expected = []
+        record = recorder.record
+
+        def record_and_read():
+            record()
+            expected.append(read_row(piece, recorder.instruments))
+
+        recorder.record = record_and_read
+        piece.start()
+        metrics = np.load(self.path)
+        times, playing, instrument_dynamics, texture_dynamics, rest_times = (
+            np.array(column, float) for column in zip(*expected)
+        )
+        sounding = np.stack(
+            [playing[:, :4].sum(axis=1), playing[:, 4:].sum(axis=1)], axis=1
+        )
+
+        self.assertEqual(list(metrics["texture_names"]), ["high", "low"])
+        self.assertEqual(list(metrics["group_names"]), ["Trumpets", "Horns"])
+        self.assertEqual(len(metrics["time"]), NUM_MEASURES / TIMESTEP)
+        np.testing.assert_array_equal(metrics["time"], times)
+        np.testing.assert_array_equal(metrics["group_sounding"], sounding)
+        np.testing.assert_array_equal(
+            metrics["instrument_dynamics"], instrument_dynamics
+        )
+        np.testing.assert_array_equal(
+            metrics["texture_dynamics"], texture_dynamics
+        )
+        np.testing.assert_array_equal(
+            metrics["texture_rest_times"], rest_times
+        )
+
+    def test_overhead(self):
+        """
+        Time the recorder's record and save calls within a run, which is less
+        noisy than comparing runs with and without a recorder.
+        """
+        overheads = []
+
+        for _ in range(BENCHMARK_RUNS):
+            piece = create_piece(BENCHMARK_MEASURES)
+            recorder = MetricsRecorder(piece, self.path)
+            piece.metrics_recorder = recorder
+            recording_time = 0
+            record = recorder.record
+            save = recorder.save
+
+            def timed(function):
+                def call():
+                    nonlocal recording_time
+                    start = time.perf_counter()
+                    function()
+                    recording_time += time.perf_counter() - start
+
+                return call
+
+            recorder.record = timed(record)
+            recorder.save = timed(save)
+            start = time.perf_counter()
+            piece.start()
+            total_time = time.perf_counter() - start
+            overheads.append(recording_time / (total_time - recording_time))
+
+        self.assertLess(min(overheads), MAX_OVERHEAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
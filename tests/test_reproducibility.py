@@ -0,0 +1,153 @@
+"""
+Checks that a seeded piece is generated identically whether it is generated
+serially, with --jobs, in sections, or resumed from a fork.
+"""
+
+import filecmp
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+import classes
+from sections import generate_in_sections
+from spec import load_piece
+
+SPEC = """
+tempo = 90
+time_signature = [4, 4]
+num_measures = 24
+seed = 7
+
+[groups.trumpets]
+name = "Trumpets"
+instrument = "Trumpet"
+max_note_length = 1.5
+size = 4
+
+[groups.horns]
+name = "Horns"
+instrument = "Horn"
+max_note_length = 2
+size = 3
+
+[[textures]]
+name = "high"
+pitches = ["c'", "g'"]
+dynamic = "p"
+groups = ["trumpets"]
+max_playing = 2
+density = 3
+rest_time_jitter = 0.5
+random_entry_order = true
+random_pitches = true
+
+[[textures]]
+name = "low"
+pitches = ["e"]
+dynamic = "mp"
+groups = ["horns"]
+max_playing = 2
+density = 2
+rest_time = 0.75
+look_ahead = 4
+rest_time_jitter = 0.25
+random_entry_order = true
+
+[[events]]
+measure = 5
+texture = "high"
+action = "change_dynamic"
+args = ["f", 2]
+
+[[events]]
+measure = 10
+texture = "low"
+action = "add_player"
+
+[[events]]
+measure = 15
+texture = "high"
+action = "link_rest_time_to_dynamic"
+args = [[0.25, 1.0]]
+"""
+
+IGNORED_FILES = [".encoding_manifest.json", ".measure_cache"]
+
+
+def get_differences(comparison):
+    """
+    Lists the files that differ between two output folders.
+    @param comparison: A filecmp.dircmp of the two folders
+    @returns: The names of the differing or missing files
+    """
+    differences = (
+        comparison.left_only + comparison.right_only + comparison.diff_files
+    )
+    for subfolder in comparison.subdirs.values():
+        differences += get_differences(subfolder)
+    return differences
+
+
+class TestReproducibility(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.previous_folder = os.getcwd()
+        os.chdir(self.folder.name)
+        Path("spec.toml").write_text(SPEC)
+        self.previous_headless = classes.HEADLESS
+        classes.HEADLESS = True
+
+    def tearDown(self):
+        classes.HEADLESS = self.previous_headless
+        os.chdir(self.previous_folder)
+        self.folder.cleanup()
+
+    def run_main(self, folder_name, *args):
+        subprocess.run(
+            [
+                sys.executable, str(REPO_FOLDER / "main.py"), "spec.toml",
+                "--headless", "--no-cache", "-o", folder_name, *args
+            ],
+            check=True,
+            capture_output=True
+        )
+
+    def assert_same(self, folder_name):
+        comparison = filecmp.dircmp("serial", folder_name, ignore=IGNORED_FILES)
+        self.assertEqual(get_differences(comparison), [])
+
+    def test_generation_methods_match(self):
+        self.run_main("serial")
+        self.assertTrue(list(Path("serial").glob("*.ly")))
+
+        self.run_main("jobs", "--jobs", "3")
+        self.assert_same("jobs")
+
+        piece = load_piece("spec.toml", False)
+        generate_in_sections(piece, [7, 13, 19], "sections")
+        self.assert_same("sections")
+
+        piece = load_piece("spec.toml", False)
+        piece.start(11)
+        fork = piece.fork()
+        del piece
+        fork.start()
+        fork.encode_lilypond("fork")
+        self.assert_same("fork")
+
+    def test_seed_changes_output(self):
+        self.run_main("serial")
+        Path("spec.toml").write_text(SPEC.replace("seed = 7", "seed = 8"))
+        self.run_main("reseeded")
+        comparison = filecmp.dircmp("serial", "reseeded", ignore=IGNORED_FILES)
+        self.assertNotEqual(get_differences(comparison), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
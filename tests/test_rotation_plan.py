@@ -0,0 +1,121 @@
+"""
+Checks that planning entries with look_ahead staggers the exits of the
+players, so a line has fewer gaps where none of its players sound than when
+entries are decided on every timestep, and that a rest time linked to the
+dynamic does not make the plans be made again on every timestep.
+"""
+
+from pathlib import Path
+import sys
+import unittest
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+import classes
+from classes import Dynamic, InstrumentGroup, Line, MusicEvent, Piece, Pitch
+
+NUM_MEASURES = 60
+LOOK_AHEAD = 4
+# (size, max_playing, max_note_length, rest_time) of a group of horns.
+CONFIGURATIONS = [
+    (2, 2, 2, 1.5),
+    (3, 2, 2, 1.5),
+    (4, 2, 1.5, 2),
+    (3, 3, 2, 2),
+    (4, 3, 2, 3),
+    (8, 4, 2, 1),
+]
+
+
+def create_piece(size, max_playing, max_note_length, rest_time, look_ahead):
+    horns = InstrumentGroup("Horns", "Horn", None, max_note_length, size)
+    line = Line(
+        [Pitch(Pitch.E, 4)],
+        Dynamic.MP,
+        [horns],
+        max_playing=max_playing,
+        density=size,
+        rest_time=rest_time,
+        look_ahead=look_ahead
+    )
+
+    return Piece(90, (4, 4), NUM_MEASURES, [], [line])
+
+
+def count_gaps(piece):
+    """
+    Run a piece and count the timesteps after the first entry on which none
+    of the players sound, fading out included.
+    """
+    instruments = [
+        instrument
+        for texture in piece.textures
+        for instrument_group in texture.instrument_groups
+        for instrument in instrument_group.instruments
+    ]
+    has_started = False
+    num_gaps = 0
+
+    while piece.time < piece.num_measures:
+        piece.advance()
+        is_sounding = any(instrument.is_playing for instrument in instruments)
+        has_started = has_started or is_sounding
+
+        if has_started and not is_sounding:
+            num_gaps += 1
+
+    return num_gaps
+
+
+class TestRotationPlan(unittest.TestCase):
+    def setUp(self):
+        self.previous_headless = classes.HEADLESS
+        classes.HEADLESS = True
+
+    def tearDown(self):
+        classes.HEADLESS = self.previous_headless
+
+    def test_staggered_exits_cover_gaps(self):
+        total_greedy_gaps = 0
+        total_planned_gaps = 0
+
+        for configuration in CONFIGURATIONS:
+            with self.subTest(configuration=configuration):
+                greedy_gaps = count_gaps(create_piece(*configuration, None))
+                planned_gaps = count_gaps(create_piece(*configuration, LOOK_AHEAD))
+                self.assertLessEqual(planned_gaps, greedy_gaps)
+                total_greedy_gaps += greedy_gaps
+                total_planned_gaps += planned_gaps
+
+        self.assertLess(total_planned_gaps, total_greedy_gaps / 10)
+
+    def test_rest_time_linked_to_dynamic(self):
+        piece = create_piece(3, 2, 2, 1, LOOK_AHEAD)
+        line = piece.textures[0]
+        line.link_rest_time_to_dynamic((0.25, 6))
+        piece.events = [
+            MusicEvent(10, line.dynamic.start_change, (Dynamic.FF, 20)),
+            MusicEvent(35, line.dynamic.start_change, (Dynamic.PP, 15)),
+        ]
+        num_plans = 0
+        plan_rotation = line.plan_rotation
+
+        def count_plans(*args):
+            nonlocal num_plans
+            num_plans += 1
+            return plan_rotation(*args)
+
+        line.plan_rotation = count_plans
+        rest_times = set()
+
+        while piece.time < piece.num_measures:
+            piece.advance()
+            rest_times.add(line.rest_time)
+
+        self.assertGreater(len(rest_times), 20)
+        self.assertLess(num_plans, 2 * NUM_MEASURES / LOOK_AHEAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Checks that main.py --transition-log writes a JSONL log that
+query_transitions.py can read.
+"""
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+from classes import TIMESTEP
+from query_transitions import query
+
+NUM_MEASURES = 8
+
+SPEC = f"""
+tempo = 90
+time_signature = [4, 4]
+num_measures = {NUM_MEASURES}
+
+[groups.trumpets]
+name = "Trumpets"
+instrument = "Trumpet"
+max_note_length = 1.5
+size = 3
+
+[[textures]]
+name = "high"
+pitches = ["c'", "g'"]
+dynamic = "p"
+groups = ["trumpets"]
+max_playing = 2
+density = 2
+
+[[events]]
+measure = 4
+texture = "high"
+action = "change_dynamic"
+args = ["f", 1]
+"""
+
+
+class TestTransitionLog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.previous_folder = os.getcwd()
+        os.chdir(self.folder.name)
+        Path("spec.toml").write_text(SPEC)
+        subprocess.run(
+            [
+                sys.executable, str(REPO_FOLDER / "main.py"), "spec.toml",
+                "--headless", "--no-cache", "--transition-log", "log.jsonl"
+            ],
+            check=True,
+            capture_output=True
+        )
+
+    def tearDown(self):
+        os.chdir(self.previous_folder)
+        self.folder.cleanup()
+
+    def test_log_can_be_queried(self):
+        records = list(query("log.jsonl"))
+        end_tick = round(NUM_MEASURES / TIMESTEP)
+
+        self.assertNotEqual(records, [])
+
+        for record in records:
+            self.assertIn("e", record)
+            self.assertTrue(0 <= record["t"] < end_tick)
+
+        events = {record["e"] for record in records}
+        self.assertIn("start_playing", events)
+        self.assertIn("stop_playing", events)
+        self.assertIn("music_event", events)
+
+    def test_filters(self):
+        records = list(query(
+            "log.jsonl",
+            instrument="Trumpet 1",
+            event="start_playing",
+            start=2,
+            end=6
+        ))
+
+        self.assertNotEqual(records, [])
+
+        for record in records:
+            self.assertEqual(record["i"], "Trumpet 1")
+            self.assertEqual(record["g"], "Trumpets")
+            self.assertEqual(record["e"], "start_playing")
+            self.assertTrue(
+                round(1 / TIMESTEP) <= record["t"] < round(5 / TIMESTEP)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()